@@ -0,0 +1,73 @@
+"""
+An in-process stand-in for a redis server, implementing just the commands the
+benchmarks use, so routing and fan-out overhead can be measured offline.
+"""
+from __future__ import absolute_import
+import fnmatch
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def mget(self, keys, *args):
+        return [self.data.get(key) for key in list(keys) + list(args)]
+
+    def mset(self, mapping):
+        self.data.update(mapping)
+        return True
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if key in self.data)
+
+    def hset(self, name, key, value):
+        self.data.setdefault(name, {})[key] = value
+        return 1
+
+    def hget(self, name, key):
+        return self.data.get(name, {}).get(key)
+
+    def keys(self, pattern='*'):
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    def scan(self, cursor=0, match=None, count=None):
+        return 0, self.keys(match or '*')
+
+    def dbsize(self):
+        return len(self.data)
+
+    def flushdb(self):
+        self.data.clear()
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def __getattr__(self, method):
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        return [getattr(self.server, method)(*args, **kwargs)
+                for method, args, kwargs in commands]
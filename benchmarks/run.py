@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Measure routing overhead and sharded throughput and print the results as JSON.
+
+By default the shards are in-process fakes (``benchmarks/fake.py``), which
+isolates the client side. ``--backend redis-server`` starts one local
+``redis-server`` per shard instead, to include the network round trips::
+
+    python benchmarks/run.py --shards 4 --output before.json
+    python benchmarks/run.py --shards 4 --backend redis-server --output after.json
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis  # noqa: E402
+
+from redis_shard.shard import ShardedRedis  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class RedisServers(object):
+    """Start ``count`` throwaway redis-server processes."""
+
+    def __init__(self, count):
+        self.count = count
+        self.processes = []
+        self.tmp_dir = None
+
+    def __enter__(self):
+        if shutil.which('redis-server') is None:
+            raise SystemExit("redis-server is not on the PATH")
+        self.tmp_dir = tempfile.mkdtemp()
+        servers = []
+        for i in range(self.count):
+            port = _free_port()
+            self.processes.append(subprocess.Popen(
+                ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no',
+                 '--dir', self.tmp_dir],
+                stdout=subprocess.DEVNULL))
+            servers.append({'name': 'shard%d' % i, 'host': '127.0.0.1', 'port': port, 'db': 0})
+        for server in servers:
+            client = redis.Redis(host=server['host'], port=server['port'])
+            for _ in range(100):
+                try:
+                    client.ping()
+                    break
+                except redis.ConnectionError:
+                    time.sleep(0.05)
+        return servers
+
+    def __exit__(self, *exc_info):
+        for process in self.processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def make_client(servers, backend, **options):
+    client = ShardedRedis(servers, **options)
+    if backend == 'fake':
+        from benchmarks.fake import FakeRedis
+        client.connections = dict((name, FakeRedis()) for name in client.server_names)
+    return client
+
+
+def ops_per_second(fn, items):
+    start = timer()
+    for item in items:
+        fn(item)
+    return len(items) / (timer() - start)
+
+
+def latencies(fn, items):
+    samples = []
+    for item in items:
+        start = timer()
+        fn(item)
+        samples.append(timer() - start)
+    samples.sort()
+    return {
+        'p50_us': samples[len(samples) // 2] * 1e6,
+        'p99_us': samples[int(len(samples) * 0.99)] * 1e6,
+        'mean_us': sum(samples) / len(samples) * 1e6,
+    }
+
+
+def bench_routing(servers, backend, ops, hot_keys=5000):
+    # a working set of hot_keys distinct keys, which fits the route cache
+    plain = ['user:%d:profile' % (i % hot_keys) for i in range(ops)]
+    tagged = ['session:%d:{user:%d}' % (i % hot_keys, i % 1000) for i in range(ops)]
+    results = {}
+    for cache_size in (0, 10000):
+        client = make_client(servers, backend, route_cache_size=cache_size)
+        suffix = '_cached' if cache_size else ''
+        results['plain_ops_per_sec' + suffix] = ops_per_second(client.get_server_name, plain)
+        results['tagged_ops_per_sec' + suffix] = ops_per_second(client.get_server_name, tagged)
+    client = make_client(servers, backend)
+    start = timer()
+    client.get_server_names(plain)
+    results['grouped_keys_per_sec'] = ops / (timer() - start)
+    return results
+
+
+def bench_single_command(client, ops):
+    keys = ['key:%d' % i for i in range(ops)]
+    return {
+        'set': latencies(lambda key: client.set(key, 'value'), keys),
+        'get': latencies(client.get, keys),
+    }
+
+
+def bench_fanout(client, rounds):
+    return {
+        'keys': latencies(lambda _: client.keys('key:1*'), range(rounds)),
+        'dbsize': latencies(lambda _: client.dbsize(), range(rounds)),
+        'flushdb': latencies(lambda _: client.flushdb(), range(rounds)),
+    }
+
+
+def bench_distribution(client, count):
+    counts = dict((name, 0) for name in client.server_names)
+    for name, keys in client.get_server_names('key:%d' % i for i in range(count)).items():
+        counts[name] = len(keys)
+    expected = count / len(counts)
+    return {
+        'keys': count,
+        'per_server': counts,
+        'chi_square': sum((n - expected) ** 2 / expected for n in counts.values()),
+        'max_over_min': max(counts.values()) / max(min(counts.values()), 1),
+    }
+
+
+def bench_batches(client, batch_size, rounds):
+    batches = [['batch:%d:%d' % (r, i) for i in range(batch_size)] for r in range(rounds)]
+
+    def pipelined(keys):
+        pipe = client.pipeline()
+        for key in keys:
+            pipe.set(key, 'value')
+        pipe.execute()
+
+    results = {}
+    for name, fn in [
+            ('mset', lambda keys: client.mset(dict((key, 'value') for key in keys))),
+            ('mget', client.mget),
+            ('pipeline_set', pipelined),
+            ('delete', lambda keys: client.delete(*keys))]:
+        start = timer()
+        for keys in batches:
+            fn(keys)
+        results[name + '_keys_per_sec'] = batch_size * rounds / (timer() - start)
+    return results
+
+
+def bench_threads(servers, backend, ops, threads=8):
+    """Single-key GETs from many threads sharing one client, with and without
+    auto-pipelining.
+    """
+    keys = ['key:%d' % i for i in range(ops)]
+    results = {}
+    for label, options in [('plain', {}), ('auto_pipeline', {'auto_pipeline': {}})]:
+        client = make_client(servers, backend, **options)
+        chunks = [keys[i::threads] for i in range(threads)]
+        workers = [threading.Thread(target=lambda chunk: [client.get(key) for key in chunk],
+                                    args=(chunk,)) for chunk in chunks]
+        start = timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        results[label + '_ops_per_sec'] = ops / (timer() - start)
+        client.close()
+    return results
+
+
+def run(servers, backend, ops):
+    client = make_client(servers, backend)
+    client.flushdb()
+    results = {
+        'routing': bench_routing(servers, backend, ops),
+        'single_command': bench_single_command(client, ops // 10),
+        'fanout': bench_fanout(client, 50),
+        'distribution': bench_distribution(client, ops),
+        'batches': bench_batches(client, 500, max(ops // 5000, 1)),
+        'threads': bench_threads(servers, backend, ops // 10),
+    }
+    client.flushdb()
+    client.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', choices=['fake', 'redis-server'], default='fake')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=100000,
+                        help="keys routed per routing benchmark (default: %(default)s)")
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    meta = {
+        'python': platform.python_version(),
+        'redis_py': redis.__version__,
+        'backend': args.backend,
+        'shards': args.shards,
+        'ops': args.ops,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    if args.backend == 'fake':
+        servers = [{'name': 'shard%d' % i, 'host': '127.0.0.1', 'port': 6379, 'db': i}
+                   for i in range(args.shards)]
+        results = run(servers, args.backend, args.ops)
+    else:
+        with RedisServers(args.shards) as servers:
+            results = run(servers, args.backend, args.ops)
+
+    output = json.dumps({'meta': meta, 'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+An asyncio flavour of ShardedRedis built on ``redis.asyncio`` (redis-py >= 4.2,
+python 3 only). Keys are routed exactly like ShardedRedis routes them.
+"""
+from __future__ import absolute_import
+import asyncio
+
+import redis.asyncio
+import six
+
+from redis_shard.commands import ALL_KEYS, COMMANDS, key_getter, tag_spec
+from redis_shard.exceptions import BroadcastError
+from redis_shard.pools import connection_pool, reset_after_fork, server_pool_options
+from redis_shard.resource_directory import ResourceDirectory, directory_from_servers
+from redis_shard.shard import hash_tag
+
+
+class AsyncShardedRedis(object):
+    """Like :class:`ShardedRedis`, but every command is a coroutine and
+    fan-out commands run on all servers with ``asyncio.gather``.
+    """
+
+    def __init__(self, servers, directory_class=ResourceDirectory, directory_options=None,
+                 pool_options=None):
+        self.server_names = []
+        self.connections = {}
+        self.pool_options = server_pool_options({}, pool_options)
+        for server in servers:
+            name = server['name']
+            if name in self.connections:
+                raise ValueError("server's name config must be unique")
+            self.connections[name] = redis.asyncio.Redis(connection_pool=connection_pool(
+                redis.asyncio, server['host'], server['port'], server['db'],
+                server_pool_options(server, self.pool_options)))
+            self.server_names.append(name)
+        reset_after_fork(self)
+
+        self.directory = directory_from_servers(
+            servers, directory_class, **(directory_options or {}))
+
+    def _after_fork(self):
+        """Drop in a forked child the pooled connections of the parent."""
+        for server in self.connections.values():
+            server.connection_pool.reset()
+
+    def get_server_name(self, key):
+        return self.directory.get_name(hash_tag(key))
+
+    def get_server_names(self, keys):
+        """Group ``keys`` by the name of the server they live on."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_server_name(key), []).append(key)
+        return groups
+
+    def get_server(self, key):
+        return self.connections[self.get_server_name(key)]
+
+    async def _execute(self, spec, key, args, kwargs):
+        server = self.get_server(key)
+        return await getattr(server, spec.redis_method)(*args, **kwargs)
+
+    def __getattr__(self, method):
+        if method.startswith("tag_"):
+            return _async_command(tag_spec(method)).__get__(self, type(self))
+        elif method.startswith("__"):
+            raise AttributeError(method)
+        else:
+            raise NotImplementedError("method '%s' cannot be sharded" % method)
+
+    async def _gather(self, coros):
+        """Await a ``{server_name: coroutine}`` dict concurrently and return
+        ``({server_name: result}, {server_name: exception})``.
+        """
+        names = list(coros)
+        replies = await asyncio.gather(*[coros[name] for name in names], return_exceptions=True)
+        results, errors = {}, {}
+        for name, reply in zip(names, replies):
+            if isinstance(reply, Exception):
+                errors[name] = reply
+            else:
+                results[name] = reply
+        return results, errors
+
+    async def _parallel(self, coros):
+        results, errors = await self._gather(coros)
+        if errors:
+            raise list(errors.values())[0]
+        return results
+
+    async def _multi_key_sum(self, spec, keys):
+        results = await self._parallel(dict(
+            (name, getattr(self.connections[name], spec.redis_method)(*group))
+            for name, group in self.get_server_names(keys).items()))
+        return sum(results.values())
+
+    async def map_shards(self, fn, return_exceptions=False):
+        """Await ``fn(connection)`` for every server concurrently and return
+        ``{server_name: result}``, see :meth:`ShardedRedis.map_shards`.
+        """
+        async def call(server):
+            return await fn(server)
+        results, errors = await self._gather(dict(
+            (name, call(self.connections[name])) for name in self.server_names))
+        if errors and not return_exceptions:
+            raise BroadcastError(results, errors)
+        results.update(errors)
+        return results
+
+    async def broadcast(self, method, *args, **kwargs):
+        """Run a redis command on every server concurrently and return
+        ``{server_name: result}``, see :meth:`ShardedRedis.broadcast`.
+        """
+        return_exceptions = kwargs.pop('return_exceptions', False)
+        return await self.map_shards(
+            lambda server: getattr(server, method)(*args, **kwargs),
+            return_exceptions=return_exceptions)
+
+    async def close(self):
+        await asyncio.gather(*[server.close() for server in self.connections.values()])
+
+    async def brpop(self, key, timeout=0):
+        if not isinstance(key, six.string_types):
+            raise NotImplementedError(
+                "The key must be single string;mutiple keys cannot be sharded")
+        return await self.get_server(key).brpop(key, timeout)
+
+    async def blpop(self, key, timeout=0):
+        if not isinstance(key, six.string_types):
+            raise NotImplementedError(
+                "The key must be single string;mutiple keys cannot be sharded")
+        return await self.get_server(key).blpop(key, timeout)
+
+    async def mget(self, keys, *args):
+        """Fetch many keys, with one MGET per server, returning the values in
+        the order of ``keys``.
+        """
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys.extend(args)
+        if not keys:
+            raise ValueError("method 'mget' requires at least one key")
+        for key in keys:
+            if not isinstance(key, six.string_types):
+                raise ValueError("keys must be strings, got %r" % (key,))
+        groups = self.get_server_names(keys)
+        results = await self._parallel(dict(
+            (name, self.connections[name].mget(group)) for name, group in groups.items()))
+        values = {}
+        for name, group in groups.items():
+            values.update(zip(group, results[name]))
+        return [values[key] for key in keys]
+
+    async def mset(self, mapping):
+        """Set many keys, with one MSET per server. Atomic per server only."""
+        if not mapping:
+            raise ValueError("method 'mset' requires at least one key")
+        results = await self._parallel(dict(
+            (name, self.connections[name].mset(dict((key, mapping[key]) for key in group)))
+            for name, group in self.get_server_names(list(mapping)).items()))
+        return all(results.values())
+
+    async def keys(self, key):
+        _keys = []
+        for server_keys in (await self.broadcast('keys', key)).values():
+            _keys.extend(server_keys)
+        return _keys
+
+    async def dbsize(self):
+        return sum((await self.broadcast('dbsize')).values())
+
+    async def flushdb(self):
+        await self.broadcast('flushdb')
+
+
+def _async_command(spec):
+    get_key = key_getter(spec)
+    if spec.key_position == ALL_KEYS:
+        async def command(self, *keys):
+            return await self._multi_key_sum(spec, get_key(keys))
+    else:
+        async def command(self, *args, **kwargs):
+            return await self._execute(spec, get_key(args), args, kwargs)
+    command.__name__ = spec.name
+    command.__doc__ = "Sharded ``%s``, see :class:`redis.asyncio.Redis`." % spec.redis_method
+    return command
+
+
+for _spec in COMMANDS.values():
+    setattr(AsyncShardedRedis, _spec.name, _async_command(_spec))
@@ -0,0 +1,143 @@
+"""
+Auto-pipelining: single-key commands issued concurrently by many threads are
+queued per server and sent as one pipeline, without changing the call sites.
+"""
+from __future__ import absolute_import
+import threading
+import time
+from concurrent.futures import Future
+
+from redis_shard.stats import PIPELINE
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+#: redis methods which may block the connection and are never pipelined
+BLOCKING_COMMANDS = frozenset(['blpop', 'brpop', 'brpoplpush', 'blmove', 'bzpopmin', 'bzpopmax'])
+
+
+class _ServerQueue(object):
+
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = None
+
+
+class AutoPipeliner(object):
+    """Queue commands per server and send each queue as one pipeline.
+
+    A thread per server sends its queue as soon as it holds ``max_batch``
+    commands or ``window`` seconds after the first command arrived, whichever
+    comes first. While a pipeline is on the wire new commands keep queuing, so
+    under load batches fill up without waiting. Every command gets its own
+    result or exception back.
+    """
+
+    def __init__(self, sharded_redis, max_batch=128, window=0.0002):
+        self.sharded_redis = sharded_redis
+        self.max_batch = max_batch
+        self.window = window
+        self.batches = 0
+        self.commands = 0
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _queue(self, name):
+        queue = self._queues.get(name)
+        if queue is None:
+            with self._lock:
+                queue = self._queues.get(name)
+                if queue is None:
+                    queue = _ServerQueue()
+                    queue.thread = threading.Thread(target=self._run, args=(name, queue))
+                    queue.thread.daemon = True
+                    queue.thread.start()
+                    self._queues[name] = queue
+        return queue
+
+    def submit(self, name, method, args, kwargs):
+        """Queue the redis ``method`` for server ``name`` and return a
+        :class:`concurrent.futures.Future` of its result.
+        """
+        future = Future()
+        while True:
+            queue = self._queue(name)
+            with queue.condition:
+                # closed since _queue returned it, its thread may be gone
+                if queue.closed:
+                    continue
+                queue.pending.append((method, args, kwargs, future))
+                if len(queue.pending) == 1 or len(queue.pending) >= self.max_batch:
+                    queue.condition.notify()
+            return future
+
+    def execute(self, name, method, args, kwargs):
+        return self.submit(name, method, args, kwargs).result()
+
+    def close(self):
+        """Send what is queued and stop the threads. Commands submitted later
+        start new ones.
+        """
+        with self._lock:
+            queues, self._queues = self._queues, {}
+        for queue in queues.values():
+            with queue.condition:
+                queue.closed = True
+                queue.condition.notify()
+        for queue in queues.values():
+            queue.thread.join()
+
+    def _after_fork(self):
+        # the sending threads are not copied into a forked child; commands
+        # queued in the parent are the parent's to send
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._queues = {}
+
+    def _run(self, name, queue):
+        while True:
+            with queue.condition:
+                while not queue.pending and not queue.closed:
+                    queue.condition.wait()
+                if not queue.pending:
+                    return
+                if self.window and len(queue.pending) < self.max_batch:
+                    deadline = _timer() + self.window
+                    while len(queue.pending) < self.max_batch and not queue.closed:
+                        remaining = deadline - _timer()
+                        if remaining <= 0:
+                            break
+                        queue.condition.wait(remaining)
+                batch = queue.pending[:self.max_batch]
+                del queue.pending[:self.max_batch]
+            self._flush(name, batch)
+
+    def _flush(self, name, batch):
+        sharded_redis = self.sharded_redis
+        queued = []
+        try:
+            pipe = sharded_redis.connections[name].pipeline(transaction=False)
+            for method, args, kwargs, future in batch:
+                try:
+                    getattr(pipe, method)(*args, **kwargs)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    queued.append(future)
+            results = sharded_redis._timed(
+                name, 'pipeline', PIPELINE, pipe.execute, (), {'raise_on_error': False})
+        except Exception as e:
+            for future in queued or [future for _, _, _, future in batch]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        with self._stats_lock:
+            self.batches += 1
+            self.commands += len(queued)
+        for future, result in zip(queued, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,157 @@
+"""
+Per-server circuit breakers and hedged reads, to keep one stalled server from
+holding up every request which touches it.
+"""
+from __future__ import absolute_import
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+from redis_shard.exceptions import CircuitOpenError
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """Stop sending commands to a server after ``failure_threshold``
+    consecutive connection errors or timeouts.
+
+    While the breaker is open commands fail at once with
+    :class:`CircuitOpenError`. After ``reset_timeout`` seconds it is half
+    open: one command at a time is let through as a probe, and the first
+    which succeeds closes the breaker again while a failure re-opens it.
+    Errors replied by the server, like a WRONGTYPE, show it is up.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise :class:`CircuitOpenError` unless a command may be sent now."""
+        if self.state == CLOSED:
+            return
+        with self._lock:
+            if self.state == OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            if self.state != CLOSED:
+                raise CircuitOpenError(self.name)
+
+    def record(self, error=None):
+        """Record how a command let through by :meth:`before_call` went."""
+        failed = isinstance(error, (ConnectionError, TimeoutError))
+        if not failed and self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = time.time()
+
+
+class HedgePolicy(object):
+    """Send a read to a second server when the first has not replied within
+    the ``percentile``th percentile of the last ``window`` reads of that
+    server's replicas (``default_delay`` seconds until ``min_samples`` were
+    seen, never less than ``min_delay``), and take whichever replies first.
+
+    The reads run on a thread pool of ``max_workers`` threads of its own.
+    """
+
+    def __init__(self, percentile=95, window=200, min_samples=20, default_delay=0.01,
+                 min_delay=0.001, max_workers=16):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_workers = max_workers
+        self.hedged = 0
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def close(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _after_fork(self):
+        # the threads of the executor are not copied into a forked child
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def record(self, name, duration):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append(duration)
+
+    def delay(self, name):
+        """Seconds to wait for a read of server ``name`` before hedging it."""
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None or len(samples) < self.min_samples:
+                return self.default_delay
+            ordered = sorted(samples)
+        index = min(int(len(ordered) * self.percentile / 100.0), len(ordered) - 1)
+        return max(ordered[index], self.min_delay)
+
+    def _measured(self, name, fn):
+        def call():
+            start = _timer()
+            result = fn()
+            self.record(name, _timer() - start)
+            return result
+        return call
+
+    def run(self, name, first, second):
+        """Return the first successful result of ``first()`` and, if that is
+        slow, ``second()``, raising the last error when both fail.
+        """
+        futures = [self.executor.submit(self._measured(name, first))]
+        done, _ = wait(futures, timeout=self.delay(name))
+        if not done:
+            with self._lock:
+                self.hedged += 1
+            futures.append(self.executor.submit(self._measured(name, second)))
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
@@ -0,0 +1,194 @@
+"""
+Transparent compression of the values ShardedRedis writes and reads.
+
+A compressed value is stored as ``HEADER + codec id + compressed bytes``.
+Values without the header are returned as they are, so values written before
+compression was turned on (or below the size threshold) keep working.
+"""
+from __future__ import absolute_import
+import threading
+import zlib
+
+import six
+
+try:
+    import lz4.frame
+except ImportError:  # optional
+    lz4 = None
+
+HEADER = b'\x1fRS'
+
+#: codec id of a value stored uncompressed because it starts with HEADER
+RAW = 0
+
+
+class ZlibCompressor(object):
+    """Compress with zlib at ``level``."""
+
+    codec_id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(object):
+    """Compress with the lz4 frame format, which is much faster than zlib
+    for a lower ratio. Requires the ``lz4`` package.
+    """
+
+    codec_id = 2
+
+    def __init__(self, level=0):
+        if lz4 is None:
+            raise ImportError("Lz4Compressor requires the lz4 package")
+        self.level = level
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    @staticmethod
+    def decompress(data):
+        if lz4 is None:
+            raise ImportError("reading an lz4 compressed value requires the lz4 package")
+        return lz4.frame.decompress(data)
+
+
+_DECOMPRESSORS = {
+    ZlibCompressor.codec_id: ZlibCompressor.decompress,
+    Lz4Compressor.codec_id: Lz4Compressor.decompress,
+}
+
+# redis method: how its arguments hold values
+_VALUE_ARGS = {
+    'set': 1, 'setnx': 1, 'getset': 1, 'setex': 2, 'hset': 2, 'lset': 2,
+    # the value to remove must match the stored, compressed form
+    'lrem': 2,
+}
+_VALUES_FROM = {
+    'lpush': 1, 'rpush': 1,
+}
+_MAPPING_ARGS = {
+    'hmset': 1,
+}
+
+#: redis methods whose replies hold values
+DECODED_COMMANDS = frozenset([
+    'get', 'getset', 'set', 'hget', 'hgetall', 'hmget', 'hvals',
+    'lindex', 'lrange', 'lpop', 'rpop', 'blpop', 'brpop', 'mget',
+])
+
+#: redis methods whose arguments or replies hold values
+CODED_COMMANDS = frozenset(_VALUE_ARGS) | frozenset(_VALUES_FROM) | \
+    frozenset(_MAPPING_ARGS) | DECODED_COMMANDS
+
+
+class ValueCodec(object):
+    """Compress string, hash field and list values of at least ``threshold``
+    bytes with ``compressor`` (lz4 when installed, otherwise zlib), and
+    decompress them when read back.
+
+    Values which would not shrink are stored as they are. ``stats()`` tells
+    how many bytes compression saved on each server.
+    """
+
+    def __init__(self, compressor=None, threshold=1024):
+        if compressor is None:
+            compressor = Lz4Compressor() if lz4 is not None else ZlibCompressor()
+        self.compressor = compressor
+        self.threshold = threshold
+        self._header = HEADER + six.int2byte(compressor.codec_id)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def encode(self, value, server_name=None):
+        """Return ``value`` as it should be stored."""
+        if isinstance(value, six.text_type):
+            data = value.encode('utf-8')
+        elif isinstance(value, bytes):
+            data = value
+        else:
+            return value
+        if len(data) >= self.threshold:
+            compressed = self._header + self.compressor.compress(data)
+            if len(compressed) < len(data):
+                self._record(server_name, len(data), len(compressed))
+                return compressed
+        if data.startswith(HEADER):
+            # keep it from being taken for a compressed value
+            return HEADER + six.int2byte(RAW) + data
+        return value
+
+    def decode(self, value):
+        """Return a stored ``value`` as it was written."""
+        if not isinstance(value, bytes) or not value.startswith(HEADER):
+            return value
+        codec_id = six.indexbytes(value, len(HEADER))
+        data = value[len(HEADER) + 1:]
+        if codec_id == RAW:
+            return data
+        try:
+            decompress = _DECOMPRESSORS[codec_id]
+        except KeyError:
+            raise ValueError("unknown compression codec %d" % codec_id)
+        return decompress(data)
+
+    def encode_args(self, method, args, kwargs, server_name=None):
+        """Encode the values among the arguments of the redis ``method``."""
+        if method in _VALUE_ARGS:
+            index = _VALUE_ARGS[method]
+            if len(args) > index:
+                args = args[:index] + (self.encode(args[index], server_name),) + args[index + 1:]
+        elif method in _VALUES_FROM:
+            index = _VALUES_FROM[method]
+            args = args[:index] + tuple(self.encode(arg, server_name) for arg in args[index:])
+        elif method in _MAPPING_ARGS:
+            index = _MAPPING_ARGS[method]
+            if len(args) > index:
+                args = args[:index] + (self.encode_mapping(args[index], server_name),) + \
+                    args[index + 1:]
+        if method in ('hset', 'hmset') and 'mapping' in kwargs:
+            kwargs = dict(kwargs, mapping=self.encode_mapping(kwargs['mapping'], server_name))
+        return args, kwargs
+
+    def encode_mapping(self, mapping, server_name=None):
+        return dict((k, self.encode(v, server_name)) for k, v in mapping.items())
+
+    def decode_result(self, method, result):
+        """Decode the values in a reply of the redis ``method``."""
+        if method not in DECODED_COMMANDS or result is None:
+            return result
+        if isinstance(result, list):
+            return [self.decode(value) for value in result]
+        if isinstance(result, dict):
+            return dict((k, self.decode(v)) for k, v in result.items())
+        if isinstance(result, tuple):
+            # blpop/brpop: (key, value)
+            return result[:-1] + (self.decode(result[-1]),)
+        return self.decode(result)
+
+    def _record(self, server_name, size, stored_size):
+        with self._lock:
+            stats = self._stats.get(server_name)
+            if stats is None:
+                stats = self._stats[server_name] = {
+                    'compressed': 0, 'bytes_in': 0, 'bytes_stored': 0, 'bytes_saved': 0}
+            stats['compressed'] += 1
+            stats['bytes_in'] += size
+            stats['bytes_stored'] += stored_size
+            stats['bytes_saved'] += size - stored_size
+
+    def stats(self):
+        """Return ``{server_name: counters}`` of the values compressed."""
+        with self._lock:
+            return dict((name, dict(stats)) for name, stats in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
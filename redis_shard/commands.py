@@ -0,0 +1,130 @@
+"""
+The redis commands ShardedRedis and ShardedPipeline can route, and which of
+their arguments hold the key(s) they are routed on.
+"""
+from __future__ import absolute_import
+from collections import namedtuple
+
+import six
+
+#: ``args[0]`` is the key
+FIRST_KEY = 'first_key'
+#: ``args[1]`` is the key (``hget_in``/``hset_in``)
+SECOND_KEY = 'second_key'
+#: every positional argument is a key; the command is sent to each server
+#: holding some of them and the integer replies are summed
+ALL_KEYS = 'all_keys'
+#: ``args[0]`` is a tagged key, or a list whose first item is a tagged key
+TAG_KEY = 'tag_key'
+#: the command takes no key and is always sent to the server owning QUEUE_KEY
+NO_KEY = 'no_key'
+
+QUEUE_KEY = 'queue'
+
+#: redis methods which only read data
+READ_ONLY = frozenset([
+    "get", "exists", "get_type", "type", "ttl",
+    "llen", "lrange", "lindex",
+    "scard", "sismember", "smembers",
+    "zrank", "zrange", "zrevrange", "zrangebyscore",
+    "zcard", "zscore", "zcount",
+    "hget", "hlen", "hkeys", "hvals", "hgetall", "hexists", "hmget",
+    "mget",
+])
+
+CommandSpec = namedtuple('CommandSpec', ['name', 'redis_method', 'key_position', 'readonly'])
+
+
+def _specs(key_position, names, suffix=''):
+    return [CommandSpec(name + suffix, name, key_position, name in READ_ONLY) for name in names]
+
+
+COMMANDS = dict((spec.name, spec) for spec in (
+    _specs(FIRST_KEY, [
+        "get", "set", "getset",
+        "setnx", "setex",
+        "incr", "decr",
+        "get_type", "type", "rename",
+        "expire", "ttl", "push",
+        "llen", "lrange", "ltrim", "lpush", "lpop",
+        "lindex", "pop", "lset",
+        "lrem", "sadd", "srem", "scard",
+        "sismember", "smembers",
+        "zadd", "zrem", "zincr", "zrank",
+        "zrange", "zrevrange", "zrangebyscore", "zremrangebyrank",
+        "zremrangebyscore", "zcard", "zscore", "zcount",
+        "hget", "hset", "hdel", "hincrby", "hlen",
+        "hkeys", "hvals", "hgetall", "hexists", "hmget", "hmset",
+        "publish", "rpush", "rpop",
+    ]) +
+    _specs(ALL_KEYS, ["delete", "exists", "touch", "unlink"]) +
+    _specs(SECOND_KEY, ["hget", "hset"], suffix="_in") +
+    _specs(NO_KEY, ["blpop", "rpush"], suffix="_in")
+))
+
+
+def tag_spec(name):
+    """Return the spec of a ``tag_<redis method>`` command."""
+    redis_method = name[len("tag_"):]
+    return CommandSpec(name, redis_method, TAG_KEY, redis_method in READ_ONLY)
+
+
+def _first_key(spec):
+    def get_key(args):
+        if args and isinstance(args[0], six.string_types):
+            return args[0]
+        raise ValueError("method '%s' requires a key param as the first argument" % spec.name)
+    return get_key
+
+
+def _second_key(spec):
+    def get_key(args):
+        if len(args) > 1 and isinstance(args[1], six.string_types):
+            return args[1]
+        raise ValueError("method '%s' requires a key param as the second argument" % spec.name)
+    return get_key
+
+
+def _tag_key(spec):
+    def get_key(args):
+        key = args[0]
+        if isinstance(key, list):
+            key = key[0]
+        if isinstance(key, six.string_types) and '{' in key:
+            return key
+        raise ValueError("method '%s' requires tag key params as its arguments" % spec.name)
+    return get_key
+
+
+def _all_keys(spec):
+    def get_keys(args):
+        if not args:
+            raise ValueError("method '%s' requires at least one key" % spec.name)
+        for key in args:
+            if not isinstance(key, six.string_types):
+                raise ValueError("keys must be strings, got %r" % (key,))
+        return args
+    return get_keys
+
+
+def _no_key(spec):
+    def get_key(args):
+        return QUEUE_KEY
+    return get_key
+
+
+_key_getters = {
+    FIRST_KEY: _first_key,
+    SECOND_KEY: _second_key,
+    TAG_KEY: _tag_key,
+    ALL_KEYS: _all_keys,
+    NO_KEY: _no_key,
+}
+
+
+def key_getter(spec):
+    """Return a function taking a command's positional arguments and returning
+    the key it routes on (the tuple of keys for ALL_KEYS commands), raising
+    ValueError if the arguments do not hold one.
+    """
+    return _key_getters[spec.key_position](spec)
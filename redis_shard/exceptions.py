@@ -0,0 +1,28 @@
+from __future__ import absolute_import
+from redis.exceptions import ConnectionError, RedisError
+
+
+class BroadcastError(RedisError):
+    """Raised when a command sent to several servers fails on some of them.
+
+    ``results`` maps the server names which succeeded to their results and
+    ``errors`` maps the ones which failed to the exception they raised.
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        super(BroadcastError, self).__init__(
+            "command failed on %s" % ", ".join(
+                "%s (%r)" % (name, error) for name, error in sorted(errors.items())))
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a command to a server whose circuit breaker
+    is open, i.e. which failed repeatedly and is left alone for a while.
+    """
+
+    def __init__(self, server_name):
+        self.server_name = server_name
+        super(CircuitOpenError, self).__init__(
+            "circuit breaker of server '%s' is open" % server_name)
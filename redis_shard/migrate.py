@@ -0,0 +1,169 @@
+"""
+Move keys to the server they belong on after the ``servers`` config changed.
+
+Every server of the old config is scanned in parallel. Keys which the new
+config puts on another server are copied there with DUMP/PTTL/RESTORE in
+pipelined batches and then deleted from the old server. While this runs,
+clients should be built with the new config and ``previous=`` set to a client
+over the old one, so the first read or write of a key not yet moved moves
+it.
+
+From the command line, with both configs as JSON files::
+
+    python -m redis_shard.migrate old_servers.json new_servers.json \\
+        --checkpoint progress.json --max-keys-per-second 5000
+
+A config file holds either the list of servers or an object with
+``servers`` and ``directory_options`` keys, the latter selecting a
+:class:`SlotResourceDirectory`.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from redis_shard.resource_directory import ResourceDirectory, SlotResourceDirectory
+from redis_shard.shard import ShardedRedis
+
+logger = logging.getLogger(__name__)
+
+
+class _Throttle(object):
+    """Sleep as needed to keep to ``rate`` keys per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.count = 0
+
+    def wait(self, count):
+        if not self.rate:
+            return
+        self.count += count
+        delay = self.start + self.count / float(self.rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Migrator(object):
+    """Move the keys of ``old`` which ``new`` routes to another server.
+
+    Both are :class:`ShardedRedis` clients; servers with the same name in both
+    are taken to be the same server. ``max_keys_per_second`` throttles each
+    old server separately. With ``checkpoint_path`` the scan cursor of every
+    old server is saved after each page, and a later run resumes from it.
+    Unless ``replace`` is set a key which already exists on its new server
+    (because a client writing to it moved it there first) is not
+    overwritten; the old copy is dropped.
+    """
+
+    def __init__(self, old, new, batch_size=500, scan_count=1000, max_keys_per_second=None,
+                 checkpoint_path=None, replace=False):
+        self.old = old
+        self.new = new
+        self.batch_size = batch_size
+        self.scan_count = scan_count
+        self.max_keys_per_second = max_keys_per_second
+        self.checkpoint_path = checkpoint_path
+        self.replace = replace
+        self._lock = threading.Lock()
+        self.progress = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.progress, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.checkpoint_path)
+
+    def run(self):
+        """Migrate every old server and return the progress of each."""
+        self.old._parallel(dict(
+            (name, functools.partial(self.migrate_server, name))
+            for name in self.old.server_names))
+        return self.progress
+
+    def migrate_server(self, name):
+        with self._lock:
+            state = self.progress.setdefault(
+                name, {'cursor': 0, 'done': False, 'scanned': 0, 'moved': 0})
+        if state['done']:
+            return state
+        source = self.old.connections[name]
+        throttle = _Throttle(self.max_keys_per_second)
+        cursor = state['cursor']
+        while True:
+            cursor, keys = source.scan(cursor, count=self.scan_count)
+            misplaced = [key for key in keys if self.new.get_server_name(key) != name]
+            moved = 0
+            for start in range(0, len(misplaced), self.batch_size):
+                batch = misplaced[start:start + self.batch_size]
+                moved += self.move_keys(source, batch)
+                throttle.wait(len(batch))
+            with self._lock:
+                state['cursor'] = cursor
+                state['done'] = not cursor
+                state['scanned'] += len(keys)
+                state['moved'] += moved
+                self._save_checkpoint()
+            if not cursor:
+                logger.info("%s: done, moved %d of %d keys", name, state['moved'], state['scanned'])
+                return state
+
+    def move_keys(self, source, keys):
+        """Move ``keys`` from ``source`` to their new servers and return how
+        many were moved.
+        """
+        return self.new._move_keys(source, keys, self.replace)
+
+
+def _load_client(path):
+    with open(path) as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        return ShardedRedis(config['servers'], directory_class=SlotResourceDirectory,
+                            directory_options=config.get('directory_options'))
+    return ShardedRedis(config, directory_class=ResourceDirectory)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move keys to the redis server they belong on after resharding.")
+    parser.add_argument('old_config', help="JSON file with the old servers config")
+    parser.add_argument('new_config', help="JSON file with the new servers config")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="keys moved per pipeline (default: %(default)s)")
+    parser.add_argument('--scan-count', type=int, default=1000,
+                        help="COUNT hint of each SCAN call (default: %(default)s)")
+    parser.add_argument('--max-keys-per-second', type=int, default=None,
+                        help="throttle for each old server (default: unthrottled)")
+    parser.add_argument('--checkpoint', default=None,
+                        help="file to save progress to and resume from")
+    parser.add_argument('--replace', action='store_true',
+                        help="overwrite keys which already exist on their new server")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    migrator = Migrator(
+        _load_client(args.old_config), _load_client(args.new_config),
+        batch_size=args.batch_size, scan_count=args.scan_count,
+        max_keys_per_second=args.max_keys_per_second,
+        checkpoint_path=args.checkpoint, replace=args.replace)
+    progress = migrator.run()
+    for name, state in sorted(progress.items()):
+        print("%s: moved %d of %d keys" % (name, state['moved'], state['scanned']))
+
+
+if __name__ == '__main__':
+    main()
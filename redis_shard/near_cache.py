@@ -0,0 +1,235 @@
+"""
+An in-process cache of read results kept in front of ShardedRedis.
+
+Writes made through the client invalidate the keys they touch. Writes made by
+other clients are only seen once the entry expires, unless
+:class:`InvalidationTracker` subscribes to the invalidation messages of Redis 6
+client-side caching (``CLIENT TRACKING ... BCAST``) on every server.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import six
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+#: the redis methods whose results are cached
+CACHED_COMMANDS = frozenset(['get', 'hget', 'hgetall'])
+
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+_missing = object()
+
+
+def arg_keys(args):
+    """Return every string among a command's arguments, including inside
+    lists: the keys it may write to.
+    """
+    keys = []
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            keys.extend(a for a in arg if isinstance(a, six.string_types))
+        elif isinstance(arg, six.string_types):
+            keys.append(arg)
+    return keys
+
+
+def _copy(value):
+    return dict(value) if isinstance(value, dict) else value
+
+
+class NearCache(object):
+    """A bounded LRU cache of command results, each kept for at most ``ttl``
+    seconds (forever when None).
+
+    Entries are indexed by the redis key they were read from so every cached
+    result of a key is dropped at once. Writes invalidate their keys both
+    before and after they are sent (see :meth:`writing`), and a result read
+    while any key was being invalidated is not stored, so a read racing a
+    write cannot put the old value back.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self):
+        """Token to pass to :meth:`set` for a result about to be read."""
+        return self._generation
+
+    def get(self, key, command, args):
+        """Return ``(result, True)``, or ``(None, False)`` when nothing is cached."""
+        entry_key = (key, command, args)
+        with self._lock:
+            entry = self._entries.get(entry_key, _missing)
+            if entry is not _missing:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    # most recently used entries live at the end
+                    del self._entries[entry_key]
+                    self._entries[entry_key] = entry
+                    self.hits += 1
+                    return _copy(value), True
+                self._remove(entry_key)
+            self.misses += 1
+            return None, False
+
+    def set(self, key, command, args, value, generation):
+        entry_key = (key, command, args)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries.pop(entry_key, None)
+            # hgetall results are dicts the caller may change
+            self._entries[entry_key] = (_copy(value), expires)
+            self._keys.setdefault(key, set()).add(entry_key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_key):
+        del self._entries[entry_key]
+        entry_keys = self._keys[entry_key[0]]
+        entry_keys.discard(entry_key)
+        if not entry_keys:
+            del self._keys[entry_key[0]]
+
+    def invalidate(self, *keys):
+        """Drop every cached result of ``keys``."""
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                for entry_key in self._keys.pop(key, ()):
+                    del self._entries[entry_key]
+                    self.invalidations += 1
+
+    def invalidate_args(self, args):
+        """Drop the cached results of every key which may be among a write
+        command's arguments.
+        """
+        self.invalidate(*arg_keys(args))
+
+    @contextmanager
+    def writing(self, keys):
+        """Invalidate ``keys`` around a write to them. A read overlapping the
+        write may get the old value; invalidating again once the write is
+        done drops it, or keeps it from being stored.
+        """
+        self.invalidate(*keys)
+        try:
+            yield
+        finally:
+            self.invalidate(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def _after_fork(self):
+        # the lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+        self.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+        }
+
+
+class InvalidationTracker(object):
+    """Subscribe to the key invalidation messages of every server in
+    ``connections`` and drop those keys from ``near_cache``.
+
+    For each server one connection subscribes to ``__redis__:invalidate`` and
+    another turns on ``CLIENT TRACKING ... BCAST``, redirecting the messages for
+    keys starting with any of ``prefixes`` (all keys by default) to the first.
+    A thread per server reads them; if its connection breaks the whole cache
+    is cleared, since messages may have been missed, and tracking restarts.
+    """
+
+    def __init__(self, near_cache, connections, prefixes=None, retry_interval=1.0):
+        self.near_cache = near_cache
+        self.connections = connections
+        self.prefixes = list(prefixes or [])
+        self.retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for name, server in self.connections.items():
+            t = threading.Thread(target=self._run, args=(name, server))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _connect(self, server, connections):
+        pool = server.connection_pool
+        subscriber = pool.connection_class(**pool.connection_kwargs)
+        connections.append(subscriber)
+        subscriber.send_command('CLIENT', 'ID')
+        client_id = subscriber.read_response()
+        subscriber.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+        subscriber.read_response()
+        tracker = pool.connection_class(**pool.connection_kwargs)
+        connections.append(tracker)
+        args = ['CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST']
+        for prefix in self.prefixes:
+            args.extend(['PREFIX', prefix])
+        tracker.send_command(*args)
+        tracker.read_response()
+        return subscriber
+
+    def _run(self, name, server):
+        while not self._stop.is_set():
+            connections = []
+            try:
+                subscriber = self._connect(server, connections)
+                while not self._stop.is_set():
+                    if subscriber.can_read(timeout=self.retry_interval):
+                        self.handle_message(subscriber.read_response())
+            except RedisError as e:
+                logger.warning("invalidation tracking on %s failed: %r", name, e)
+                self.near_cache.clear()
+                self._stop.wait(self.retry_interval)
+            finally:
+                for connection in connections:
+                    connection.disconnect()
+
+    def handle_message(self, message):
+        kind, keys = message[0], message[2]
+        if kind not in (b'message', 'message'):
+            return
+        if keys is None:
+            # the server was flushed
+            self.near_cache.clear()
+            return
+        self.near_cache.invalidate(*[
+            key.decode('utf-8', 'replace') if isinstance(key, bytes) else key for key in keys])
@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+import functools
+
+from redis.exceptions import NoScriptError
+
+from redis_shard.commands import ALL_KEYS, COMMANDS, READ_ONLY, key_getter, tag_spec
+from redis_shard.near_cache import arg_keys
+from redis_shard.stats import COMMAND, PIPELINE
+
+
+class ShardedPipeline(object):
+    """Buffer sharded commands and send them as one redis pipeline per server.
+
+    Commands are routed exactly like the ones on :class:`ShardedRedis`
+    (including ``tag_*`` and ``hget_in``/``hset_in``). ``execute`` sends the
+    per-server pipelines concurrently and returns the results in the order the
+    commands were issued. With ``transaction=True`` each server's batch is
+    wrapped in MULTI/EXEC; there is no atomicity across servers.
+
+    A server's batch made only of reads is sent to one of the server's
+    replicas, if it has any, unless the pipeline is a transaction, was created
+    with ``primary_only=True`` or is executed inside
+    :meth:`ShardedRedis.primary_only`.
+    """
+
+    def __init__(self, sharded_redis, transaction=False, primary_only=False):
+        self.sharded_redis = sharded_redis
+        self.transaction = transaction
+        self.primary_only = primary_only
+        self.command_stack = []
+        # keys the queued writes may change, invalidated around execute
+        self.written_keys = []
+        # keys the queued writes touch, moved off previous servers first
+        self.migrated_keys = []
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        self.command_stack = []
+        self.written_keys = []
+        self.migrated_keys = []
+
+    def _queue(self, spec, key, args, kwargs):
+        if not spec.readonly:
+            if self.sharded_redis.previous is not None:
+                self.migrated_keys.extend(self.sharded_redis._command_keys(spec, key, args))
+            if self.sharded_redis.near_cache is not None:
+                self.written_keys.extend(arg_keys(args))
+        name = self.sharded_redis.get_server_name(key)
+        codec = self.sharded_redis.codec
+        if codec is not None:
+            args, kwargs = codec.encode_args(spec.redis_method, args, kwargs, name)
+        self.command_stack.append((name, spec.redis_method, args, kwargs))
+        return self
+
+    def __getattr__(self, method):
+        if method.startswith("tag_"):
+            return _pipeline_command(tag_spec(method)).__get__(self, type(self))
+        elif method.startswith("__"):
+            raise AttributeError(method)
+        else:
+            raise NotImplementedError("method '%s' cannot be sharded" % method)
+
+    def _replica_set(self, name, commands, primary_only):
+        if self.transaction or primary_only:
+            return None
+        if not all(method in READ_ONLY for _, method, _, _ in commands):
+            return None
+        return self.sharded_redis.replicas.get(name)
+
+    def _load_scripts(self, name, shas):
+        """Load on server ``name`` the scripts of ``shas`` it does not have,
+        as a server which restarted or ran SCRIPT FLUSH answers NOSCRIPT.
+        """
+        sharded_redis = self.sharded_redis
+        server = sharded_redis.connections[name]
+        shas = sorted(shas)
+        found = sharded_redis._timed(name, 'script_exists', COMMAND, server.script_exists,
+                                     tuple(shas), {})
+        for sha, exists in zip(shas, found):
+            script = sharded_redis.scripts[sha]
+            if exists:
+                script.loaded.add(name)
+            else:
+                script.loaded.discard(name)
+                script.load(name)
+
+    def _execute_server(self, name, commands, primary_only=False):
+        sharded_redis = self.sharded_redis
+        shas = set(args[0] for _, method, args, _ in commands if method == 'evalsha')
+        if shas:
+            self._load_scripts(name, shas)
+        replica_set = self._replica_set(name, commands, primary_only)
+
+        def execute(server_name, server):
+            pipe = server.pipeline(transaction=self.transaction)
+            for _, method, args, kwargs in commands:
+                getattr(pipe, method)(*args, **kwargs)
+            return sharded_redis._timed(
+                server_name, 'pipeline', PIPELINE, pipe.execute, (), {'raise_on_error': False})
+
+        primary = sharded_redis.connections[name]
+        if replica_set is None:
+            return execute(name, primary)
+        return replica_set.call(primary, execute)
+
+    def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+        written_keys, self.written_keys = self.written_keys, []
+        migrated_keys, self.migrated_keys = self.migrated_keys, []
+        by_server = {}
+        for index, (name, method, args, kwargs) in enumerate(stack):
+            by_server.setdefault(name, []).append((index, method, args, kwargs))
+        if not by_server:
+            return []
+        self.sharded_redis._migrate_keys(migrated_keys)
+
+        # the servers' pipelines run in other threads, so look at
+        # ShardedRedis.primary_only here
+        primary_only = self.primary_only or self.sharded_redis.reading_from_primary
+        results = [None] * len(stack)
+        with self.sharded_redis._invalidating(written_keys):
+            responses = self.sharded_redis._parallel(dict(
+                (name, functools.partial(self._execute_server, name, commands, primary_only))
+                for name, commands in by_server.items()))
+
+        codec = self.sharded_redis.codec
+        for name, commands in by_server.items():
+            for (index, method, args, _), response in zip(commands, responses[name]):
+                if isinstance(response, NoScriptError):
+                    # flushed since SCRIPT EXISTS; loaded again next time
+                    self.sharded_redis.scripts[args[0]].loaded.discard(name)
+                if codec is not None and not isinstance(response, Exception):
+                    response = codec.decode_result(method, response)
+                results[index] = response
+        if raise_on_error:
+            for response in results:
+                if isinstance(response, Exception):
+                    raise response
+        return results
+
+
+def _pipeline_command(spec):
+    get_key = key_getter(spec)
+    if spec.key_position == ALL_KEYS:
+        def command(self, *keys):
+            # a queued command gets one reply, so all its keys must share a server
+            names = self.sharded_redis.get_server_names(get_key(keys))
+            if len(names) > 1:
+                raise ValueError(
+                    "method '%s' in a pipeline requires keys on the same server" % spec.name)
+            return self._queue(spec, keys[0], keys, {})
+    else:
+        def command(self, *args, **kwargs):
+            return self._queue(spec, get_key(args), args, kwargs)
+    command.__name__ = spec.name
+    command.__doc__ = "Queue a sharded ``%s``, see :class:`redis.Redis`." % spec.redis_method
+    return command
+
+
+for _spec in COMMANDS.values():
+    setattr(ShardedPipeline, _spec.name, _pipeline_command(_spec))
@@ -0,0 +1,72 @@
+"""
+Connection pools of the servers, configured per server and reset in forked
+child processes.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import weakref
+
+logger = logging.getLogger(__name__)
+
+#: keys of a server entry (or of ``pool_options``) passed on to its pool
+POOL_OPTIONS = (
+    'max_connections', 'socket_timeout', 'socket_connect_timeout', 'socket_keepalive',
+    'socket_keepalive_options', 'health_check_interval', 'blocking_pool', 'pool_timeout',
+)
+
+
+def server_pool_options(server, defaults=None):
+    """Return the pool options of the ``server`` entry, on top of ``defaults``."""
+    options = dict(defaults or {})
+    options.update((key, server[key]) for key in POOL_OPTIONS if key in server)
+    unknown = set(options) - set(POOL_OPTIONS)
+    if unknown:
+        raise ValueError("unknown pool options %s" % ", ".join(sorted(unknown)))
+    return options
+
+
+def connection_pool(module, host, port, db, options):
+    """Return a connection pool of ``module`` (``redis`` or ``redis.asyncio``)
+    for the server at ``host:port``.
+
+    No connection is made until a command needs one. With ``blocking_pool``
+    set, a caller finding all ``max_connections`` connections in use waits up
+    to ``pool_timeout`` seconds for one instead of getting an error.
+    """
+    options = dict(options)
+    blocking = options.pop('blocking_pool', False)
+    timeout = options.pop('pool_timeout', None)
+    if blocking:
+        if timeout is not None:
+            options['timeout'] = timeout
+        return module.BlockingConnectionPool(host=host, port=port, db=db, **options)
+    if timeout is not None:
+        raise ValueError("pool_timeout requires blocking_pool")
+    return module.ConnectionPool(host=host, port=port, db=db, **options)
+
+
+# the live clients reset in forked children
+_clients = weakref.WeakSet()
+
+
+def reset_after_fork(obj):
+    """Call ``obj._after_fork()`` in every child process forked from now on,
+    for as long as ``obj`` lives. Does nothing on Pythons without
+    ``os.register_at_fork``, where redis-py still resets its pools lazily.
+    """
+    _clients.add(obj)
+
+
+def _after_fork_in_child():
+    for obj in list(_clients):
+        try:
+            obj._after_fork()
+        except Exception:
+            # one client failing must not leave the others shared
+            logger.exception("resetting %r after fork failed", obj)
+
+
+if hasattr(os, 'register_at_fork'):
+    # once for all clients, as fork hooks can never be removed
+    os.register_at_fork(after_in_child=_after_fork_in_child)
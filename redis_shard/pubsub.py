@@ -0,0 +1,221 @@
+"""
+Publish/subscribe over all servers from one thread.
+"""
+from __future__ import absolute_import
+import logging
+import time
+
+try:
+    import selectors
+except ImportError:  # python 2
+    import selectors34 as selectors
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedPubSub(object):
+    """Subscribe to channels on the servers ``publish`` sends them to, and to
+    patterns on every server, reading the messages of all of them from one
+    selector.
+
+    Each server gets a :class:`redis.client.PubSub` the first time one of its
+    channels is subscribed to. ``get_messages`` returns the messages already
+    received by any of them, waiting up to ``timeout`` seconds for the first.
+    A server whose connection breaks is reconnected at most every
+    ``reconnect_interval`` seconds, and redis-py subscribes it again to its
+    channels and patterns.
+
+    >>> p = client.pubsub()
+    >>> p.subscribe('news', 'alerts')
+    >>> p.psubscribe('user:*')
+    >>> for message in p.listen():
+    ...     handle(message)
+    """
+
+    def __init__(self, sharded_redis, ignore_subscribe_messages=False, reconnect_interval=1.0):
+        self.sharded_redis = sharded_redis
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.reconnect_interval = reconnect_interval
+        #: ``{server_name: redis.client.PubSub}``
+        self.pubsubs = {}
+        self._selector = selectors.DefaultSelector()
+        self._sockets = {}
+        # servers which may have messages left in their read buffer
+        self._buffered = set()
+        self._broken = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _pubsub(self, name):
+        pubsub = self.pubsubs.get(name)
+        if pubsub is None:
+            pubsub = self.pubsubs[name] = self.sharded_redis.connections[name].pubsub(
+                ignore_subscribe_messages=self.ignore_subscribe_messages)
+        return pubsub
+
+    def _by_server(self, channels, handlers):
+        groups = {}
+        for channel in channels:
+            groups.setdefault(self.sharded_redis.get_server_name(channel), ([], {}))[0].append(
+                channel)
+        for channel, handler in handlers.items():
+            groups.setdefault(self.sharded_redis.get_server_name(channel), ([], {}))[1][
+                channel] = handler
+        return groups
+
+    @property
+    def subscribed(self):
+        return any(pubsub.subscribed for pubsub in self.pubsubs.values())
+
+    def subscribe(self, *channels, **handlers):
+        """Subscribe to ``channels`` on the server of each, with the same
+        arguments as :meth:`redis.client.PubSub.subscribe`.
+        """
+        for name, (server_channels, server_handlers) in self._by_server(
+                _flatten(channels), handlers).items():
+            self._pubsub(name).subscribe(*server_channels, **server_handlers)
+
+    def unsubscribe(self, *channels):
+        """Unsubscribe from ``channels``, or from every channel when none are given."""
+        if not channels:
+            for pubsub in self.pubsubs.values():
+                if pubsub.channels:
+                    pubsub.unsubscribe()
+            return
+        for name, (server_channels, _) in self._by_server(_flatten(channels), {}).items():
+            if name in self.pubsubs:
+                self.pubsubs[name].unsubscribe(*server_channels)
+
+    def psubscribe(self, *patterns, **handlers):
+        """Subscribe to ``patterns`` on every server, since a matching
+        channel may be on any of them.
+        """
+        for name in self.sharded_redis.server_names:
+            self._pubsub(name).psubscribe(*patterns, **handlers)
+
+    def punsubscribe(self, *patterns):
+        for pubsub in self.pubsubs.values():
+            if pubsub.patterns:
+                pubsub.punsubscribe(*patterns)
+
+    def _register(self):
+        """Keep the selector watching the current socket of every server,
+        reconnecting the broken ones.
+        """
+        now = time.time()
+        for name, pubsub in self.pubsubs.items():
+            connection = pubsub.connection
+            if connection is None:
+                continue
+            sock = getattr(connection, '_sock', None)
+            if sock is None and now - self._broken.get(name, 0) >= self.reconnect_interval:
+                try:
+                    # redis-py subscribes the new connection again
+                    connection.connect()
+                    sock = connection._sock
+                    self._broken.pop(name, None)
+                except (ConnectionError, TimeoutError) as e:
+                    logger.warning("reconnecting pubsub of %s failed: %r", name, e)
+                    self._broken[name] = now
+            registered = self._sockets.get(name)
+            if registered is sock:
+                continue
+            if registered is not None:
+                try:
+                    self._selector.unregister(registered)
+                except (KeyError, ValueError):
+                    pass
+            if sock is not None:
+                self._selector.register(sock, selectors.EVENT_READ, name)
+                self._sockets[name] = sock
+            else:
+                self._sockets.pop(name, None)
+
+    def _ready(self, timeout):
+        self._register()
+        if self._buffered:
+            return list(self._buffered)
+        if self._broken:
+            # wake up in time to reconnect
+            timeout = self.reconnect_interval if timeout is None else min(
+                timeout, self.reconnect_interval)
+        if not self._sockets:
+            if timeout:
+                time.sleep(timeout)
+            return []
+        return [key.data for key, _ in self._selector.select(timeout)]
+
+    def _read(self, name, messages, max_messages):
+        self._buffered.discard(name)
+        pubsub = self.pubsubs[name]
+        try:
+            while len(messages) < max_messages:
+                if not pubsub.connection.can_read(timeout=0):
+                    return
+                # not get_message, which skips reading once the last
+                # channel is unsubscribed and would leave its reply unread
+                message = pubsub.handle_message(pubsub.parse_response(block=False, timeout=0))
+                if message is not None:
+                    messages.append(message)
+            self._buffered.add(name)
+        except (ConnectionError, TimeoutError) as e:
+            logger.warning("pubsub of %s disconnected: %r", name, e)
+            pubsub.connection.disconnect()
+            self._broken[name] = 0
+
+    def get_messages(self, max_messages=100, timeout=0.0):
+        """Return up to ``max_messages`` messages from any server, waiting up
+        to ``timeout`` seconds (forever when None) for one to arrive.
+        """
+        if not self.pubsubs:
+            raise RuntimeError("pubsub is not subscribed to anything")
+        messages = []
+        deadline = None if timeout is None else time.time() + timeout
+        while not messages:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            for name in self._ready(remaining):
+                self._read(name, messages, max_messages)
+                if len(messages) >= max_messages:
+                    break
+            if deadline is not None and time.time() >= deadline:
+                break
+        return messages
+
+    def get_message(self, timeout=0.0):
+        """Return the next message, or None when none arrived within
+        ``timeout`` seconds.
+        """
+        messages = self.get_messages(1, timeout)
+        return messages[0] if messages else None
+
+    def listen(self, max_messages=100):
+        """Yield messages as they arrive while subscribed to anything."""
+        while self.subscribed:
+            for message in self.get_messages(max_messages, timeout=self.reconnect_interval):
+                yield message
+
+    def close(self):
+        for pubsub in self.pubsubs.values():
+            pubsub.close()
+        self.pubsubs = {}
+        self._sockets = {}
+        self._buffered = set()
+        self._broken = {}
+        self._selector.close()
+        self._selector = selectors.DefaultSelector()
+
+
+def _flatten(channels):
+    flat = []
+    for channel in channels:
+        if isinstance(channel, (list, tuple)):
+            flat.extend(channel)
+        else:
+            flat.append(channel)
+    return flat
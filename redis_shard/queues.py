@@ -0,0 +1,118 @@
+"""
+A work queue spread over every server, instead of the single ``queue`` list
+``rpush_in``/``blpop_in`` use.
+"""
+from __future__ import absolute_import
+import functools
+import itertools
+import threading
+
+
+class ShardedQueue(object):
+    """One logical FIFO queue made of a list on each server of
+    ``sharded_redis``.
+
+    The lists are named ``{<name>:<n>}``, with ``n`` picked so each hashes to
+    a different server. Producers spread items over them in turn, or by
+    ``key`` to keep the items of one key in order. Consumers pop from all of
+    them, starting from a different list on every call so none is starved,
+    taking up to ``count`` items per LPOP (Redis 6.2). Items from different
+    lists come out in no particular order.
+
+    >>> jobs = ShardedQueue(client, 'jobs')
+    >>> jobs.put('job-1', 'job-2')
+    >>> jobs.get(count=10)
+    [b'job-1', b'job-2']
+    >>> jobs.depths()
+    {'server1': 0, 'server2': 0}
+    """
+
+    def __init__(self, sharded_redis, name, max_probes=10000):
+        self.sharded_redis = sharded_redis
+        self.name = name
+        #: ``{server_name: list key}``
+        self.keys = self._find_keys(max_probes)
+        self._server_names = list(sharded_redis.server_names)
+        self._put_counter = itertools.count()
+        self._get_counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _find_keys(self, max_probes):
+        keys = {}
+        server_names = self.sharded_redis.server_names
+        for n in range(max_probes):
+            key = '{%s:%d}' % (self.name, n)
+            keys.setdefault(self.sharded_redis.get_server_name(key), key)
+            if len(keys) == len(server_names):
+                return keys
+        raise ValueError("no list of queue '%s' maps to servers %s" % (
+            self.name, ", ".join(sorted(set(server_names) - set(keys)))))
+
+    def __len__(self):
+        return sum(self.depths().values())
+
+    def _next_key(self):
+        with self._lock:
+            n = next(self._put_counter)
+        return self.keys[self._server_names[n % len(self._server_names)]]
+
+    def put(self, *values, **kwargs):
+        """Append ``values`` to the next list in turn, or to the list on the
+        server of ``key`` when given.
+        """
+        key = kwargs.pop('key', None)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments %s" % ", ".join(sorted(kwargs)))
+        if not values:
+            raise ValueError("method 'put' requires at least one value")
+        if key is None:
+            list_key = self._next_key()
+        else:
+            list_key = self.keys[self.sharded_redis.get_server_name(key)]
+        return self.sharded_redis.rpush(list_key, *values)
+
+    def put_many(self, values):
+        """Spread ``values`` over all the lists, with one pipelined RPUSH per
+        list.
+        """
+        batches = {}
+        for value in values:
+            batches.setdefault(self._next_key(), []).append(value)
+        if not batches:
+            return
+        pipe = self.sharded_redis.pipeline()
+        for list_key, batch in batches.items():
+            pipe.rpush(list_key, *batch)
+        pipe.execute()
+
+    def get(self, count=1, timeout=None):
+        """Pop up to ``count`` items, trying the lists in turn from a
+        different one each call. When all are empty and ``timeout`` is not
+        None, wait up to ``timeout`` seconds (forever when 0) for one item.
+        """
+        with self._lock:
+            start = next(self._get_counter)
+        server_names = self._server_names
+        items = []
+        for i in range(len(server_names)):
+            list_key = self.keys[server_names[(start + i) % len(server_names)]]
+            popped = self.sharded_redis.lpop(list_key, count - len(items))
+            if popped:
+                items.extend(popped)
+                if len(items) >= count:
+                    break
+        if not items and timeout is not None:
+            item = self.sharded_redis.blpop(
+                [self.keys[name] for name in server_names], timeout)
+            if item is not None:
+                items.append(item[1])
+        return items
+
+    def depths(self):
+        """Return ``{server_name: length of its list}``."""
+        return self.sharded_redis._parallel(dict(
+            (name, functools.partial(self.sharded_redis.llen, list_key))
+            for name, list_key in self.keys.items()))
+
+    def clear(self):
+        self.sharded_redis.delete(*self.keys.values())
@@ -0,0 +1,127 @@
+"""
+Read replicas of a shard. A server config may list ``replicas``; read-only
+commands for keys on that server are then sent to one of them, picked by a
+selector, while writes keep going to the server itself.
+"""
+from __future__ import absolute_import
+import functools
+import itertools
+import threading
+import time
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class RoundRobinSelector(object):
+    """Take the replicas in turn."""
+
+    def __init__(self, count):
+        self.count = count
+        self._counter = itertools.count()
+
+    def select(self):
+        return next(self._counter) % self.count
+
+    def record(self, index, duration):
+        pass
+
+
+class LatencySelector(object):
+    """Take the replica with the lowest recent latency, an exponentially
+    weighted moving average giving the latest sample a weight of ``alpha``.
+
+    Replicas without samples are tried first, and every ``probe_every``th read
+    goes to the next replica in turn so a replica which was slow once gets a
+    chance to show it has recovered.
+    """
+
+    def __init__(self, count, alpha=0.2, probe_every=100):
+        self.count = count
+        self.alpha = alpha
+        self.probe_every = probe_every
+        self.latencies = [None] * count
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def select(self):
+        n = next(self._counter)
+        if self.probe_every and n % self.probe_every == self.probe_every - 1:
+            return (n // self.probe_every) % self.count
+        best, best_latency = 0, None
+        for index, latency in enumerate(self.latencies):
+            if latency is None:
+                return index
+            if best_latency is None or latency < best_latency:
+                best, best_latency = index, latency
+        return best
+
+    def record(self, index, duration):
+        with self._lock:
+            latency = self.latencies[index]
+            if latency is None:
+                self.latencies[index] = duration
+            else:
+                self.latencies[index] = latency + self.alpha * (duration - latency)
+
+
+SELECTORS = {
+    'round_robin': RoundRobinSelector,
+    'latency': LatencySelector,
+}
+
+
+class ReplicaSet(object):
+    """The replicas of the server ``name``.
+
+    ``replicas`` is a list of ``(replica_name, connection)`` pairs and
+    ``selector`` a key of :data:`SELECTORS` or a class taking the number of
+    replicas. A read which cannot reach its replica is retried on the primary,
+    and the replica is charged ``failure_penalty`` seconds of latency.
+    """
+
+    def __init__(self, name, replicas, selector='round_robin', failure_penalty=1.0):
+        if not replicas:
+            raise ValueError("server '%s' has an empty replicas list" % name)
+        self.name = name
+        self.names = [replica_name for replica_name, _ in replicas]
+        self.connections = [connection for _, connection in replicas]
+        if not isinstance(selector, type):
+            try:
+                selector = SELECTORS[selector]
+            except KeyError:
+                raise ValueError("unknown replica selector %r" % (selector,))
+        self.selector = selector(len(self.connections))
+        self.failure_penalty = failure_penalty
+
+    def _call_replica(self, index, fn):
+        start = _timer()
+        try:
+            result = fn(self.names[index], self.connections[index])
+        except (ConnectionError, TimeoutError):
+            self.selector.record(index, self.failure_penalty)
+            raise
+        self.selector.record(index, _timer() - start)
+        return result
+
+    def call(self, primary, fn, hedge=None):
+        """Return ``fn(name, connection)`` for a replica, falling back to
+        ``fn(self.name, primary)`` when the replica is unreachable.
+
+        With a :class:`redis_shard.breaker.HedgePolicy` a slow read is also
+        sent to the next replica, or to ``primary`` when there is only one.
+        """
+        index = self.selector.select()
+        read = functools.partial(self._call_replica, index, fn)
+        if hedge is not None:
+            if len(self.connections) > 1:
+                other = functools.partial(
+                    self._call_replica, (index + 1) % len(self.connections), fn)
+            else:
+                other = functools.partial(fn, self.name, primary)
+            read = functools.partial(hedge.run, self.name, read, other)
+        try:
+            return read()
+        except (ConnectionError, TimeoutError):
+            return fn(self.name, primary)
@@ -1,5 +1,42 @@
 from __future__ import absolute_import
 import hashlib
+import struct
+
+import six
+
+_unpack_hash = struct.Struct('>Q').unpack_from
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """CRC16-CCITT (XMODEM), the checksum Redis Cluster maps keys to slots with."""
+    crc = 0
+    for byte in six.iterbytes(data):
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xff]
+    return crc
+
+
+def sha1_hash(data):
+    # the first 8 bytes of the digest, read as a big-endian integer
+    return _unpack_hash(hashlib.sha1(data).digest())[0]
+
+
+HASH_FUNCTIONS = {
+    'sha1': sha1_hash,
+    'crc16': crc16,
+}
 
 
 class ResourceDirectory(object):
@@ -12,8 +49,72 @@ class ResourceDirectory(object):
         self.resource_names = resource_names
 
     def _hash(self, key):
-        hashed = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
-        return int(hashed, 16) % self.num_resources
+        if isinstance(key, six.text_type):
+            key = key.encode('utf-8')
+        return sha1_hash(key) % self.num_resources
 
     def get_name(self, key):
         return self.resource_names[self._hash(key)]
+
+
+class SlotResourceDirectory(ResourceDirectory):
+    """Map keys to resources through a precomputed table of ``num_slots``
+    slots: a key hashes to a slot and the slot's entry names its resource.
+
+    Slots are dealt out in proportion to ``weights`` (one per resource,
+    default 1) using smooth weighted round-robin. With equal weights slot
+    ``i`` goes to resource ``i % num_resources``, so in ``sha1`` mode keys land
+    where :class:`ResourceDirectory` puts them whenever ``num_slots`` is a
+    multiple of the number of resources. ``crc16`` mode hashes keys to the
+    same slots as Redis Cluster does.
+    """
+
+    def __init__(self, resource_names, weights=None, num_slots=16384, hash_mode='sha1'):
+        super(SlotResourceDirectory, self).__init__(resource_names)
+        if hash_mode not in HASH_FUNCTIONS:
+            raise ValueError("hash_mode must be one of %s" % ", ".join(sorted(HASH_FUNCTIONS)))
+        if weights is None:
+            weights = [1] * self.num_resources
+        if len(weights) != self.num_resources:
+            raise ValueError("there must be one weight per resource")
+        if any(weight <= 0 for weight in weights):
+            raise ValueError("weights must be positive")
+        if num_slots < self.num_resources:
+            raise ValueError("num_slots must be at least the number of resources")
+        self.num_slots = num_slots
+        self.weights = list(weights)
+        self.hash_mode = hash_mode
+        self._slot_hash = HASH_FUNCTIONS[hash_mode]
+        self.slots = self._assign_slots()
+
+    def _assign_slots(self):
+        total = sum(self.weights)
+        current = [0] * self.num_resources
+        slots = []
+        for _ in range(self.num_slots):
+            for i, weight in enumerate(self.weights):
+                current[i] += weight
+            chosen = current.index(max(current))
+            current[chosen] -= total
+            slots.append(self.resource_names[chosen])
+        return slots
+
+    def get_slot(self, key):
+        if isinstance(key, six.text_type):
+            key = key.encode('utf-8')
+        return self._slot_hash(key) % self.num_slots
+
+    def get_name(self, key):
+        return self.slots[self.get_slot(key)]
+
+
+def directory_from_servers(servers, directory_class=ResourceDirectory, **options):
+    """Build a directory over the names of a ``servers`` config, passing the
+    servers' ``weight`` entries on when any is set.
+    """
+    names = [server['name'] for server in servers]
+    if any('weight' in server for server in servers):
+        if directory_class is ResourceDirectory:
+            raise ValueError("server weights require a SlotResourceDirectory")
+        options['weights'] = [server.get('weight', 1) for server in servers]
+    return directory_class(names, **options)
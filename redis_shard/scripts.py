@@ -0,0 +1,82 @@
+"""
+Lua scripts run with EVALSHA on the server owning their keys.
+"""
+from __future__ import absolute_import
+import hashlib
+
+import six
+from redis.exceptions import NoScriptError
+
+from redis_shard.commands import CommandSpec, FIRST_KEY
+from redis_shard.pipeline import ShardedPipeline
+from redis_shard.stats import COMMAND
+
+_EVALSHA = CommandSpec('evalsha', 'evalsha', FIRST_KEY, False)
+
+
+class ShardedScript(object):
+    """A Lua script registered with :meth:`ShardedRedis.register_script`.
+
+    Calling it runs EVALSHA on the server its keys live on, so all its keys
+    must map to the same server (give them the same ``{tag}``). A server which
+    answers NOSCRIPT is sent the script with SCRIPT LOAD and the call retried;
+    other servers are left alone. In a pipeline, the scripts are checked with
+    SCRIPT EXISTS, and loaded where missing, when the pipeline is executed.
+
+    >>> incr_max = client.register_script(INCR_MAX_LUA)
+    >>> incr_max(keys=['{user:1}:visits'], args=[100])
+    """
+
+    def __init__(self, sharded_redis, script):
+        self.sharded_redis = sharded_redis
+        self.script = script
+        if isinstance(script, six.text_type):
+            script = script.encode('utf-8')
+        self.sha = hashlib.sha1(script).hexdigest()
+        # servers the script is known to be loaded on
+        self.loaded = set()
+
+    def __call__(self, keys=(), args=(), client=None):
+        """Run the script, or queue it on ``client`` when that is a
+        :class:`ShardedPipeline`.
+        """
+        keys, args = tuple(keys), tuple(args)
+        name = self.get_server_name(keys)
+        command_args = (self.sha, len(keys)) + keys + args
+        if isinstance(client, ShardedPipeline):
+            # the pipeline makes sure the script is loaded when it is executed
+            self.sharded_redis.scripts.setdefault(self.sha, self)
+            return client._queue(_EVALSHA, keys[0], command_args, {})
+
+        sharded_redis = self.sharded_redis
+        sharded_redis._migrate_keys(keys)
+        server = sharded_redis.connections[name]
+        with sharded_redis._invalidating(keys):
+            try:
+                result = sharded_redis._timed(
+                    name, 'evalsha', COMMAND, server.evalsha, command_args, {})
+            except NoScriptError:
+                self.loaded.discard(name)
+                self.load(name)
+                result = sharded_redis._timed(
+                    name, 'evalsha', COMMAND, server.evalsha, command_args, {})
+        self.loaded.add(name)
+        return result
+
+    def get_server_name(self, keys):
+        """Return the name of the server owning ``keys``."""
+        if not keys:
+            raise ValueError("a sharded script requires at least one key")
+        names = self.sharded_redis.get_server_names(keys)
+        if len(names) > 1:
+            raise ValueError(
+                "the keys of a sharded script must be on the same server, got %s" % ", ".join(
+                    "%s on %s" % (keys, name) for name, keys in sorted(names.items())))
+        return next(iter(names))
+
+    def load(self, name):
+        """Load the script on server ``name``."""
+        self.sharded_redis._timed(name, 'script_load', COMMAND,
+                                  self.sharded_redis.connections[name].script_load,
+                                  (self.script,), {})
+        self.loaded.add(name)
@@ -0,0 +1,217 @@
+"""
+Set and sorted set operations over keys on different servers, computed by the
+client. ShardedRedis sends them to the server itself when all their keys are
+on one server.
+
+Members are streamed with SSCAN/ZSCAN ``chunk_size`` at a time:
+
+- intersections and differences walk the first (for intersections the
+  smallest) key and look each chunk up in the other keys with
+  SMISMEMBER/ZMSCORE (Redis 6.2), so only a chunk is held in memory;
+- ``*store`` variants write each chunk to a temporary key on the
+  destination's server as they go, and rename it over the destination at
+  the end. Unions are merged by the server (SADD, or ZADD to a copy of each
+  key then ZUNIONSTORE), so the client holds no more than a chunk per key.
+"""
+from __future__ import absolute_import
+import functools
+import uuid
+
+from redis_shard.stats import FANOUT
+
+AGGREGATES = ('SUM', 'MIN', 'MAX')
+
+
+def key_weights(keys):
+    """Return ``[(key, weight)]`` of ``keys``, a list or ``{key: weight}``."""
+    if isinstance(keys, dict):
+        return list(keys.items())
+    return [(key, 1) for key in keys]
+
+
+class SetOperations(object):
+    """Client-side set operations of ``sharded_redis``."""
+
+    def __init__(self, sharded_redis, chunk_size=1000):
+        self.sharded_redis = sharded_redis
+        self.chunk_size = chunk_size
+
+    def _call(self, key, method, *args, **kwargs):
+        name = self.sharded_redis.get_server_name(key)
+        server = self.sharded_redis.connections[name]
+        return self.sharded_redis._timed(
+            name, method, FANOUT, getattr(server, method), args, kwargs)
+
+    def _scan(self, key, sorted_set=False):
+        """Yield chunks of the members of ``key``, with their scores when
+        ``sorted_set`` is set.
+        """
+        method = 'zscan' if sorted_set else 'sscan'
+        cursor = 0
+        while True:
+            cursor, members = self._call(key, method, key, cursor, count=self.chunk_size)
+            if members:
+                yield members
+            if not cursor:
+                return
+
+    def _parallel(self, fns):
+        return self.sharded_redis._parallel(dict(enumerate(fns)))
+
+    def _temp_key(self, destination):
+        """Return an unused-looking key on the server of ``destination``."""
+        sharded_redis = self.sharded_redis
+        name = sharded_redis.get_server_name(destination)
+        while True:
+            key = 'redis-shard:tmp:%s' % uuid.uuid4().hex
+            if sharded_redis.get_server_name(key) == name:
+                return key
+
+    def _finish_store(self, temp_key, destination, sorted_set):
+        """Move ``temp_key`` over ``destination`` and return its size."""
+        size = self._call(temp_key, 'zcard' if sorted_set else 'scard', temp_key)
+        if size:
+            self._call(temp_key, 'rename', temp_key, destination)
+        else:
+            self._call(destination, 'delete', destination)
+        return size
+
+    def _store(self, destination, sorted_set, write):
+        """Have ``write(temp_key)`` fill a temporary key, then move it over
+        ``destination``.
+        """
+        temp_key = self._temp_key(destination)
+        try:
+            write(temp_key)
+            return self._finish_store(temp_key, destination, sorted_set)
+        except Exception:
+            self._call(temp_key, 'delete', temp_key)
+            raise
+
+    # sets
+
+    def _filtered_chunks(self, first, others, keep_if_in_all):
+        """Yield chunks of the members of ``first`` which are in all of
+        ``others`` (``keep_if_in_all``) or in none of them.
+        """
+        for members in self._scan(first):
+            if others:
+                found = self._parallel([
+                    functools.partial(self._call, key, 'smismember', key, members)
+                    for key in others])
+                if keep_if_in_all:
+                    members = [m for i, m in enumerate(members)
+                               if all(found[k][i] for k in found)]
+                else:
+                    members = [m for i, m in enumerate(members)
+                               if not any(found[k][i] for k in found)]
+            if members:
+                yield members
+
+    def _smallest_first(self, keys, method, items=None):
+        """Return ``items`` (``keys`` by default) ordered by the size of
+        their key, as told by ``method``.
+        """
+        sizes = self._parallel([functools.partial(self._call, key, method, key) for key in keys])
+        items = keys if items is None else items
+        return [items[i] for i in sorted(range(len(keys)), key=lambda i: sizes[i])]
+
+    def sinter(self, keys):
+        ordered = self._smallest_first(keys, 'scard')
+        result = set()
+        for members in self._filtered_chunks(ordered[0], ordered[1:], True):
+            result.update(members)
+        return result
+
+    def sdiff(self, keys):
+        result = set()
+        for members in self._filtered_chunks(keys[0], keys[1:], False):
+            result.update(members)
+        return result
+
+    def sunion(self, keys):
+        result = set()
+        for key in keys:
+            for members in self._scan(key):
+                result.update(members)
+        return result
+
+    def _sadd_all(self, chunks):
+        def write(temp_key):
+            for members in chunks:
+                self._call(temp_key, 'sadd', temp_key, *members)
+        return write
+
+    def sinterstore(self, destination, keys):
+        ordered = self._smallest_first(keys, 'scard')
+        return self._store(destination, False, self._sadd_all(
+            self._filtered_chunks(ordered[0], ordered[1:], True)))
+
+    def sdiffstore(self, destination, keys):
+        return self._store(destination, False, self._sadd_all(
+            self._filtered_chunks(keys[0], keys[1:], False)))
+
+    def sunionstore(self, destination, keys):
+        def write(temp_key):
+            # each key is streamed into the temporary key by a thread of its own
+            self._parallel([
+                functools.partial(self._copy_members, key, temp_key) for key in keys])
+        return self._store(destination, False, write)
+
+    def _copy_members(self, key, temp_key):
+        for members in self._scan(key):
+            self._call(temp_key, 'sadd', temp_key, *members)
+
+    # sorted sets
+
+    def zunionstore(self, destination, key_weights, aggregate=None):
+        aggregate = _aggregate(aggregate)
+
+        def write(temp_key):
+            # each key is copied with its weight to a temporary key of its own,
+            # which ZADD keeps right when ZSCAN returns a member twice, and the
+            # server merges the copies
+            copies = [self._temp_key(destination) for _ in key_weights]
+            try:
+                self._parallel([
+                    functools.partial(self._copy_scores, key, weight, copy)
+                    for (key, weight), copy in zip(key_weights, copies)])
+                self._call(temp_key, 'zunionstore', temp_key, copies, aggregate=aggregate)
+            finally:
+                self._call(temp_key, 'delete', *copies)
+        return self._store(destination, True, write)
+
+    def _copy_scores(self, key, weight, copy):
+        for members in self._scan(key, sorted_set=True):
+            self._call(copy, 'zadd', copy, dict(
+                (member, score * weight) for member, score in members))
+
+    def zinterstore(self, destination, key_weights, aggregate=None):
+        aggregate = _aggregate(aggregate)
+        ordered = self._smallest_first([key for key, _ in key_weights], 'zcard', key_weights)
+        (first, first_weight), others = ordered[0], ordered[1:]
+        combine = {'SUM': sum, 'MIN': min, 'MAX': max}[aggregate]
+
+        def write(temp_key):
+            for members in self._scan(first, sorted_set=True):
+                names = [member for member, _ in members]
+                scores = self._parallel([
+                    functools.partial(self._call, key, 'zmscore', key, names)
+                    for key, _ in others])
+                mapping = {}
+                for i, (member, score) in enumerate(members):
+                    other_scores = [scores[k][i] for k in range(len(others))]
+                    if all(s is not None for s in other_scores):
+                        mapping[member] = combine(
+                            [score * first_weight] +
+                            [s * weight for s, (_, weight) in zip(other_scores, others)])
+                if mapping:
+                    self._call(temp_key, 'zadd', temp_key, mapping)
+        return self._store(destination, True, write)
+
+
+def _aggregate(aggregate):
+    aggregate = (aggregate or 'SUM').upper()
+    if aggregate not in AGGREGATES:
+        raise ValueError("aggregate must be one of %s" % ", ".join(AGGREGATES))
+    return aggregate
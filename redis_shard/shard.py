@@ -1,153 +1,896 @@
 from __future__ import absolute_import
+import logging
 import re
+import threading
+import time
+from contextlib import contextmanager
 import redis
 import six
-from redis_shard.resource_directory import ResourceDirectory
+from six.moves import queue
+from redis_shard.autopipeline import BLOCKING_COMMANDS, AutoPipeliner
+from redis_shard.breaker import CircuitBreaker
+from redis_shard.codecs import CODED_COMMANDS
+from redis_shard.commands import ALL_KEYS, COMMANDS, FIRST_KEY, TAG_KEY, key_getter, tag_spec
+from redis_shard.exceptions import BroadcastError, CircuitOpenError
+from redis_shard.near_cache import CACHED_COMMANDS, InvalidationTracker, arg_keys
+from redis_shard.replicas import ReplicaSet
+from redis_shard.resource_directory import ResourceDirectory, directory_from_servers
+from redis_shard.pipeline import ShardedPipeline
+from redis_shard.pools import connection_pool, reset_after_fork, server_pool_options
+from redis_shard.pubsub import ShardedPubSub
+from redis_shard.scripts import ShardedScript
+from redis_shard.setops import SetOperations, key_weights
+from redis_shard.stats import BLOCKING, COMMAND, FANOUT, CommandEvent, payload_size
 import functools
+from concurrent.futures import ThreadPoolExecutor
 
-_findhash = re.compile(r'.*{(.*)}.*', re.I)
+try:
+    from functools import lru_cache
+except ImportError:  # python 2
+    lru_cache = None
+
+logger = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+_glob_chars = re.compile(r'[*?\[\\]')
+_scan_done = object()
+
+#: seconds between the CLIENT UNBLOCKs sent to a pop still blocked
+UNBLOCK_INTERVAL = 0.05
+
+
+def hash_tag(key):
+    """Return the part of ``key`` used for routing: the content of the first
+    ``{...}`` if it is not empty, otherwise the whole key (as Redis Cluster does).
+    """
+    if isinstance(key, six.text_type):
+        start = key.find(u'{')
+        end = key.find(u'}', start + 1) if start != -1 else -1
+    else:
+        start = key.find(b'{')
+        end = key.find(b'}', start + 1) if start != -1 else -1
+    if end > start + 1:
+        return key[start + 1:end]
+    return key
 
 
 class ShardedRedis(object):
 
-    def __init__(self, servers):
+    def __init__(self, servers, executor=None, max_workers=None, route_cache_size=0,
+                 directory_class=ResourceDirectory, directory_options=None, previous=None,
+                 listeners=None, near_cache=None, replica_selector='round_robin',
+                 circuit_breaker=None, breaker_fallback=None, hedge=None, auto_pipeline=None,
+                 codec=None, pool_options=None):
         self.server_names = []
         self.connections = {}
-        VERSION = tuple(map(int, redis.__version__.split('.')))
-        if VERSION < (2,4,0):
-            self.pool = redis.ConnectionPool()
-        else:
-            self.pool = None
+        # {sha: ShardedScript} of the scripts registered
+        self.scripts = {}
+        # {server_name: ReplicaSet} of the servers configured with replicas
+        self.replicas = {}
+        self._local = threading.local()
+        self.max_workers = max_workers
+        # callables given a redis_shard.stats.CommandEvent for every command sent
+        self.listeners = list(listeners or [])
+        # a redis_shard.near_cache.NearCache serving repeated reads from memory
+        self.near_cache = near_cache
+        self._invalidation_tracker = None
+        # CircuitBreaker options; when set every server and replica gets one
+        self.circuit_breaker = circuit_breaker
+        # {server_name: CircuitBreaker}, filled in on first use
+        self.breakers = {}
+        # called with (command, key, error) when a single-key command hits an
+        # open breaker, returning the command's result instead of raising
+        self.breaker_fallback = breaker_fallback
+        # a redis_shard.breaker.HedgePolicy for reads of servers with replicas
+        self.hedge = hedge
+        # a redis_shard.codecs.ValueCodec compressing the values written
+        self.codec = codec
+        # AutoPipeliner options; when set single-key commands sent to the
+        # primary servers are batched with those of other threads
+        self.auto_pipeliner = None
+        if auto_pipeline is not None:
+            self.auto_pipeliner = AutoPipeliner(self, **auto_pipeline)
+        # pool options of every server, which server entries override
+        self.pool_options = server_pool_options({}, pool_options)
+        # the client over the servers as they were before resharding, which
+        # keys are moved off on first use while they are being migrated
+        self.previous = previous
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._executor_lock = threading.Lock()
 
         for server in servers:
             name = server['name']
             if name in self.connections:
                 raise ValueError("server's name config must be unique")
-            self.connections[name] = redis.Redis(
-                    host=server['host'], port=server['port'],
-                    db=server['db'],connection_pool=self.pool)
+            options = server_pool_options(server, self.pool_options)
+            self.connections[name] = redis.Redis(connection_pool=connection_pool(
+                redis, server['host'], server['port'], server['db'], options))
             self.server_names.append(name)
+            if 'replicas' in server:
+                self.replicas[name] = ReplicaSet(name, [
+                    (replica.get('name', '%s:replica%d' % (name, i)), redis.Redis(
+                        connection_pool=connection_pool(
+                            redis, replica['host'], replica['port'],
+                            replica.get('db', server['db']),
+                            server_pool_options(replica, options))))
+                    for i, replica in enumerate(server['replicas'])], selector=replica_selector)
+        reset_after_fork(self)
 
-        self.directory = ResourceDirectory(self.server_names)
+        self.directory = directory_from_servers(
+            servers, directory_class, **(directory_options or {}))
+        if route_cache_size and lru_cache is not None:
+            # remember the server name of the most recently routed keys
+            self.get_server_name = lru_cache(maxsize=route_cache_size)(self.get_server_name)
 
     def get_server_name(self, key):
-        g = _findhash.match(key)
-        if g is not None and len(g.groups()) > 0:
-            key = g.groups()[0]
-        name = self.directory.get_name(key)
-        return name
+        return self.directory.get_name(hash_tag(key))
+
+    def get_server_names(self, keys):
+        """Group ``keys`` by the name of the server they live on."""
+        groups = {}
+        get_server_name = self.get_server_name
+        for key in keys:
+            name = get_server_name(key)
+            if name in groups:
+                groups[name].append(key)
+            else:
+                groups[name] = [key]
+        return groups
 
     def get_server(self,key):
         name = self.get_server_name(key)
         return self.connections[name]
 
-    def __wrap(self, method, *args, **kwargs):
+    def _execute(self, spec, key, args, kwargs):
+        send = self._send
+        if self.codec is not None and spec.redis_method in CODED_COMMANDS:
+            args, kwargs = self.codec.encode_args(
+                spec.redis_method, args, kwargs, self.get_server_name(key))
+            send = self._send_decoded
+        cache = self.near_cache
+        if cache is None:
+            return send(spec, key, args, kwargs)
+        if not spec.readonly:
+            with cache.writing(arg_keys(args)):
+                return send(spec, key, args, kwargs)
+        if (spec.redis_method not in CACHED_COMMANDS or spec.key_position != FIRST_KEY
+                or kwargs):
+            return send(spec, key, args, kwargs)
+        result, found = cache.get(key, spec.redis_method, args)
+        if not found:
+            generation = cache.generation
+            result = send(spec, key, args, kwargs)
+            cache.set(key, spec.redis_method, args, result, generation)
+        return result
+
+    def _send_decoded(self, spec, key, args, kwargs):
+        return self.codec.decode_result(spec.redis_method, self._send(spec, key, args, kwargs))
+
+    def _send(self, spec, key, args, kwargs):
+        moved = []
+        if self.previous is not None:
+            keys = self._command_keys(spec, key, args)
+            if not spec.readonly:
+                self._migrate_keys(keys)
+            else:
+                moved = [k for k in keys if self._moved(k)]
+        replica_set = None
+        if spec.readonly and self.replicas and not self.reading_from_primary:
+            replica_set = self.replicas.get(self.get_server_name(key))
         try:
-            key = args[0]
-            assert isinstance(key, six.string_types)
-        except:
-            raise ValueError("method '%s' requires a key param as the first argument" % method)
+            if moved:
+                result = self._read_moved(spec, key, moved, args, kwargs)
+            elif replica_set is not None:
+                result = replica_set.call(self.get_server(key), lambda name, server: self._timed(
+                    name, spec.name, COMMAND, getattr(server, spec.redis_method), args, kwargs),
+                    self.hedge)
+            else:
+                result = self._send_primary(spec, key, args, kwargs)
+        except CircuitOpenError as e:
+            if self.breaker_fallback is None:
+                raise
+            return self.breaker_fallback(spec.name, key, e)
+        return result
+
+    def _read_moved(self, spec, key, moved, args, kwargs):
+        """Run a read of the ``moved`` keys, which resharding moves, on
+        their new server together with an EXISTS of them. Unless they all
+        exist there, they are moved off the ``previous`` servers first and
+        the read is run again.
+        """
+        name = self.get_server_name(key)
+        pipe = self.connections[name].pipeline()
+        pipe.exists(*moved)
+        getattr(pipe, spec.redis_method)(*args, **kwargs)
+        found, result = self._timed(name, spec.name, COMMAND, pipe.execute, (), {})
+        if found == len(moved) or not self._migrate_keys(moved):
+            return result
+        return self._send_primary(spec, key, args, kwargs)
+
+    def _send_primary(self, spec, key, args, kwargs):
+        if self.auto_pipeliner is not None and spec.redis_method not in BLOCKING_COMMANDS:
+            return self.auto_pipeliner.execute(
+                self.get_server_name(key), spec.redis_method, args, kwargs)
         server = self.get_server(key)
-        f = getattr(server, method)
-        return f(*args, **kwargs)
-
-    def __wrap_tag(self,method,*args,**kwargs):
-        key = args[0]
-        if isinstance(key, six.string_types) and '{' in key:
-            server = self.get_server(key)
-        elif isinstance(key, list) and '{' in key[0]:
-            server = self.get_server(key[0])
+        if self.listeners or self.circuit_breaker is not None:
+            kind = BLOCKING if spec.redis_method in BLOCKING_COMMANDS else COMMAND
+            return self._timed(self.get_server_name(key), spec.name, kind,
+                               getattr(server, spec.redis_method), args, kwargs)
         else:
-            raise ValueError("method '%s' requires tag key params as its arguments" % method)
-        method = method.lstrip("tag_")
-        f = getattr(server, method)
-        return f(*args, **kwargs)
-
-    def __hop_in(self, method, *args, **kwargs):
-        '''
-        '''
+            return getattr(server, spec.redis_method)(*args, **kwargs)
+
+    def _read_server(self, name, method, kind, args, primary_only=False):
+        """Run the read ``method`` for server ``name`` on one of its replicas,
+        or on the server itself when it has none or ``primary_only`` is set.
+        """
+        def call(server_name, server):
+            return self._timed(server_name, method, kind, getattr(server, method), args, {})
+        primary = self.connections[name]
+        replica_set = None if primary_only else self.replicas.get(name)
+        if replica_set is None:
+            return call(name, primary)
+        return replica_set.call(primary, call)
+
+    def _breaker(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers.setdefault(
+                name, CircuitBreaker(name, **self.circuit_breaker))
+        return breaker
+
+    def _timed(self, name, command, kind, fn, args, kwargs):
+        """Call ``fn``, telling the listeners and the circuit breaker of
+        server ``name`` how it went. Blocking commands are left out of the
+        breaker: one blocking as its half-open probe would shut out every
+        other command until it returns.
+        """
+        breaker = None
+        if self.circuit_breaker is not None and kind != BLOCKING:
+            breaker = self._breaker(name)
+            breaker.before_call()
+        elif not self.listeners:
+            return fn(*args, **kwargs)
+        error = result = None
+        start = _timer()
         try:
-            key = args[1]
-            assert isinstance(key, six.string_types)
-        except:
-            raise ValueError("method '%s' requires a key param as the second argument" % method)
-        server = self.get_server(key)
-        if method == "hget_in":
-            method = "hget"
-        elif method == "hset_in":
-            method = "hset"
-        else:
-            raise RuntimeError("you can't be here")
-        f = getattr(server, method)
-        return f(*args, **kwargs)
-
-    def __qop_in(self, method, *args, **kwargs):
-        '''
-        '''
-        key = "queue"
-        server = self.get_server(key)
-        if method == "rpush_in":
-            method = "rpush"
-        elif method == "blpop_in":
-            method = "blpop"
+            result = fn(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if breaker is not None:
+                breaker.record(error)
+            if self.listeners:
+                event = CommandEvent(name, command, kind, _timer() - start, error,
+                                     sum(payload_size(arg) for arg in args), payload_size(result))
+                for listener in self.listeners:
+                    listener(event)
+
+    @contextmanager
+    def _invalidating(self, keys):
+        """Invalidate the near cache entries of ``keys`` around a write."""
+        if self.near_cache is None or not keys:
+            yield
         else:
-            raise RuntimeError("you can't be here")
-        f = getattr(server, method)
-        return f(*args, **kwargs)
+            with self.near_cache.writing(keys):
+                yield
+
+    @property
+    def reading_from_primary(self):
+        """Whether reads in this thread skip the replicas, see :meth:`primary_only`."""
+        return getattr(self._local, 'primary_only', False)
+
+    @contextmanager
+    def primary_only(self):
+        """Send the reads made in this thread inside the block to the primary
+        servers, e.g. to read back what was just written::
+
+            client.set('foo', 1)
+            with client.primary_only():
+                client.get('foo')
+        """
+        previous = self.reading_from_primary
+        self._local.primary_only = True
+        try:
+            yield self
+        finally:
+            self._local.primary_only = previous
+
+    def _command_keys(self, spec, key, args):
+        """Return the keys a command routed on ``key`` reads or writes:
+        every argument of ALL_KEYS commands, and every argument of ``tag_*``
+        commands sharing the hash tag of ``key``.
+        """
+        if spec.key_position == ALL_KEYS:
+            return list(args)
+        if spec.key_position == TAG_KEY:
+            tag = hash_tag(key)
+            return [k for k in arg_keys(args) if hash_tag(k) == tag and k != tag]
+        return [key]
+
+    def _moved(self, key):
+        """Whether resharding moves ``key`` off the server ``previous`` has it on."""
+        return self.previous.get_server_name(key) != self.get_server_name(key)
+
+    def _migrate_keys(self, keys):
+        """Move those of ``keys`` which ``previous`` may still hold on
+        another server to their server, before they are written to, so a
+        write never starts a partial copy of a key. Return how many were
+        moved.
+        """
+        if self.previous is None:
+            return 0
+        moved = [key for key in keys if self._moved(key)]
+        return sum(self._move_keys(self.previous.connections[name], group)
+                   for name, group in self.previous.get_server_names(moved).items())
+
+    def _move_keys(self, source, keys, replace=False):
+        """Move ``keys`` from the server ``source`` to theirs with
+        DUMP/PTTL/RESTORE and return how many were moved. Unless ``replace``
+        is set a key already on its server is kept there.
+        """
+        pipe = source.pipeline()
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+
+        by_server = {}
+        for key, data, pttl in zip(keys, replies[::2], replies[1::2]):
+            if data is None or pttl == -2:
+                # deleted or expired since
+                continue
+            by_server.setdefault(self.get_server_name(key), []).append(
+                (key, max(pttl, 0), data))
+
+        moved = []
+        for name, entries in by_server.items():
+            pipe = self.connections[name].pipeline(transaction=False)
+            for key, ttl, data in entries:
+                pipe.restore(key, ttl, data, replace=replace)
+            for (key, _, _), reply in zip(entries, pipe.execute(raise_on_error=False)):
+                if isinstance(reply, redis.ResponseError) and str(reply).startswith('BUSYKEY'):
+                    logger.debug("%s already exists on %s, keeping it", key, name)
+                elif isinstance(reply, Exception):
+                    raise reply
+                moved.append(key)
+        if moved:
+            source.delete(*moved)
+        return len(moved)
 
     def __getattr__(self, method):
-        if method in [
-            "get", "set", "getset",
-            "setnx", "setex",
-            "incr", "decr", "exists",
-            "delete", "get_type", "type", "rename",
-            "expire", "ttl", "push",
-            "llen", "lrange", "ltrim","lpush","lpop",
-            "lindex", "pop", "lset",
-            "lrem", "sadd", "srem", "scard",
-            "sismember", "smembers",
-            "zadd", "zrem", "zincr","zrank",
-            "zrange", "zrevrange", "zrangebyscore","zremrangebyrank",
-            "zremrangebyscore", "zcard", "zscore","zcount",
-            "hget", "hset", "hdel", "hincrby", "hlen",
-            "hkeys", "hvals", "hgetall", "hexists", "hmget", "hmset",
-            "publish","rpush","rpop"
-            ]:
-            return functools.partial(self.__wrap, method)
-        elif method.startswith("tag_"):
-            return functools.partial(self.__wrap_tag, method)
-        elif method in ["hget_in", "hset_in"]:
-            return functools.partial(self.__hop_in, method)
-        elif method in ["blpop_in", "rpush_in"]:
-            return functools.partial(self.__qop_in, method)
+        if method.startswith("tag_"):
+            return _tag_command(method).__get__(self, type(self))
+        elif method.startswith("__"):
+            raise AttributeError(method)
         else:
             raise NotImplementedError("method '%s' cannot be sharded" % method)
 
+    def _group_keys(self, keys):
+        """Group ``keys`` by server name, remembering each key's position."""
+        groups = {}
+        for index, key in enumerate(keys):
+            if not isinstance(key, six.string_types):
+                raise ValueError("keys must be strings, got %r" % (key,))
+            groups.setdefault(self.get_server_name(key), []).append((index, key))
+        return groups
+
+    @property
+    def executor(self):
+        """The executor running per-server work concurrently. Unless one was
+        passed in, a thread pool with ``max_workers`` threads (one per server
+        by default) is created on first use.
+        """
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers or max(len(self.server_names), 1))
+        return self._executor
+
+    def close(self):
+        """Shut down the executor, if this client created it, and the
+        threads of hedged reads and auto-pipelining. An executor passed in
+        is left running and kept.
+        """
+        if self._owns_executor:
+            executor, self._executor = self._executor, None
+            if executor is not None:
+                executor.shutdown()
+        if self.hedge is not None:
+            self.hedge.close()
+        if self.auto_pipeliner is not None:
+            self.auto_pipeliner.close()
+
+    def _after_fork(self):
+        """Drop in a forked child what belongs to the parent: pooled
+        connections, threads and the near cache, which the parent's
+        invalidation tracker no longer keeps up to date.
+        """
+        for server in self.connections.values():
+            server.connection_pool.reset()
+        for replica_set in self.replicas.values():
+            for server in replica_set.connections:
+                server.connection_pool.reset()
+        self._executor_lock = threading.Lock()
+        if self._owns_executor:
+            self._executor = None
+        if self.hedge is not None:
+            self.hedge._after_fork()
+        if self.auto_pipeliner is not None:
+            self.auto_pipeliner._after_fork()
+        if self.near_cache is not None:
+            self.near_cache._after_fork()
+            tracker = self._invalidation_tracker
+            if tracker is not None:
+                self._invalidation_tracker = InvalidationTracker(
+                    self.near_cache, self.connections, tracker.prefixes).start()
+
+    def _gather(self, tasks):
+        """Run a ``{server_name: callable}`` dict concurrently and return
+        ``({server_name: result}, {server_name: exception})``.
+        """
+        results, errors = {}, {}
+        if len(tasks) <= 1:
+            futures = None
+        else:
+            futures = dict((name, self.executor.submit(task)) for name, task in tasks.items())
+        for name, task in tasks.items():
+            try:
+                results[name] = task() if futures is None else futures[name].result()
+            except Exception as e:
+                errors[name] = e
+        return results, errors
+
+    def _parallel(self, tasks):
+        """Like ``_gather`` but re-raises the first exception raised."""
+        results, errors = self._gather(tasks)
+        if errors:
+            raise list(errors.values())[0]
+        return results
+
+    def map_shards(self, fn, return_exceptions=False):
+        """Call ``fn(connection)`` for every server concurrently and return
+        ``{server_name: result}``. If any call fails a :class:`BroadcastError`
+        holding every result and exception is raised, unless
+        ``return_exceptions`` is true, in which case the exceptions are
+        returned in place of the results.
+        """
+        command = getattr(fn, '__name__', 'map_shards')
+        results, errors = self._gather(dict(
+            (name, functools.partial(
+                self._timed, name, command, FANOUT, fn, (self.connections[name],), {}))
+            for name in self.server_names))
+        if errors and not return_exceptions:
+            raise BroadcastError(results, errors)
+        results.update(errors)
+        return results
+
+    def broadcast(self, method, *args, **kwargs):
+        """Run a redis command on every server concurrently and return
+        ``{server_name: result}``, e.g. ``client.broadcast('info', 'memory')``.
+        Accepts ``return_exceptions`` like :meth:`map_shards`.
+        """
+        return_exceptions = kwargs.pop('return_exceptions', False)
+
+        def command(server):
+            return getattr(server, method)(*args, **kwargs)
+        command.__name__ = str(method)
+        return self.map_shards(command, return_exceptions=return_exceptions)
+
+    def _multi_key_sum(self, spec, keys):
+        # a key on a previous server counts for exists too
+        moved = self._migrate_keys(keys)
+        groups = self.get_server_names(keys)
+        if spec.readonly:
+            # the replicas may not have the keys just moved yet
+            primary_only = self.reading_from_primary or moved > 0
+            return sum(self._parallel(dict(
+                (name, functools.partial(self._read_server, name, spec.redis_method, FANOUT,
+                                         group, primary_only))
+                for name, group in groups.items())).values())
+        tasks = dict(
+            (name, functools.partial(
+                self._timed, name, spec.name, FANOUT,
+                getattr(self.connections[name], spec.redis_method), group, {}))
+            for name, group in groups.items())
+        with self._invalidating(keys):
+            return sum(self._parallel(tasks).values())
+
+    def track_invalidations(self, prefixes=None):
+        """Have every server tell the near cache about keys changed by other
+        clients, using Redis 6 client-side caching in broadcast mode,
+        optionally only for keys starting with one of ``prefixes``.
+        """
+        if self.near_cache is None:
+            raise ValueError("invalidation tracking requires a near_cache")
+        self.stop_tracking_invalidations()
+        self._invalidation_tracker = InvalidationTracker(
+            self.near_cache, self.connections, prefixes).start()
+        return self._invalidation_tracker
+
+    def stop_tracking_invalidations(self):
+        tracker, self._invalidation_tracker = self._invalidation_tracker, None
+        if tracker is not None:
+            tracker.stop()
+
+    def pipeline(self, transaction=False, primary_only=False):
+        """Return a :class:`ShardedPipeline` which buffers sharded commands
+        and sends them as one redis pipeline per server on ``execute``.
+        A server's pipeline holding only reads goes to one of its replicas
+        unless ``primary_only`` is set.
+        """
+        return ShardedPipeline(self, transaction=transaction, primary_only=primary_only)
+
+    def pubsub(self, **kwargs):
+        """Return a :class:`ShardedPubSub` subscribing to each channel on
+        its server and reading all servers from one thread.
+        """
+        return ShardedPubSub(self, **kwargs)
+
+    def register_script(self, script):
+        """Return a :class:`ShardedScript` running the Lua ``script`` with
+        EVALSHA on the server owning its keys.
+        """
+        sharded_script = ShardedScript(self, script)
+        return self.scripts.setdefault(sharded_script.sha, sharded_script)
+
+    def preload_scripts(self):
+        """Load every registered script on every server, the servers in
+        parallel with one pipeline each.
+        """
+        scripts = list(self.scripts.values())
+        if not scripts:
+            return
+
+        def script_load(server):
+            pipe = server.pipeline(transaction=False)
+            for script in scripts:
+                pipe.script_load(script.script)
+            return pipe.execute()
+        self.map_shards(script_load)
+        for script in scripts:
+            script.loaded.update(self.server_names)
 
     #########################################
     ###  some methods implement as needed ###
     ########################################
 
-    def brpop(self,key, timeout=0):
-        if not isinstance(key, six.string_types):
-            raise NotImplementedError("The key must be single string;mutiple keys cannot be sharded")
-        server = self.get_server(key)
-        return server.brpop(key,timeout)
+    def brpop(self, key, timeout=0):
+        """Pop from the tail of the first non-empty list of ``key``, a key or
+        a list of keys which may be on different servers, see :meth:`blpop`.
+        """
+        return self._blocking_pop('brpop', 'rpush', key, timeout)
 
-    def blpop(self,key, timeout=0):
-        if not isinstance(key, six.string_types):
-            raise NotImplementedError("The key must be single string;mutiple keys cannot be sharded")
-        server = self.get_server(key)
-        return server.blpop(key,timeout)
+    def blpop(self, key, timeout=0):
+        """Pop from the head of the first non-empty list of ``key``, a key or
+        a list of keys which may be on different servers, blocking for at
+        most ``timeout`` seconds (forever when 0).
+
+        Keys on different servers are waited on at the same time, one BLPOP
+        per server. The first item to arrive is returned at once, and a
+        background thread cancels the other BLPOPs with CLIENT UNBLOCK and
+        pushes back where it came from any item popped in the meantime. Only
+        the order among keys of the same server is kept.
+        """
+        return self._blocking_pop('blpop', 'lpush', key, timeout)
+
+    def _blocking_pop(self, command, push_back, keys, timeout):
+        if isinstance(keys, six.string_types):
+            keys = [keys]
+        elif not isinstance(keys, (list, tuple)) or not all(
+                isinstance(key, six.string_types) for key in keys):
+            raise NotImplementedError("The key must be a string or a list of strings")
+        if not keys:
+            raise ValueError("method '%s' requires at least one key" % command)
+        self._migrate_keys(keys)
+        groups = self.get_server_names(keys)
+        if len(groups) == 1:
+            server = self.get_server(keys[0])
+            server_keys = keys[0] if len(keys) == 1 else keys
+            if self.listeners or self.circuit_breaker is not None:
+                result = self._timed(self.get_server_name(keys[0]), command, BLOCKING,
+                                     getattr(server, command), (server_keys, timeout), {})
+            else:
+                result = getattr(server, command)(server_keys, timeout)
+        else:
+            result = self._blocking_pop_servers(command, push_back, groups, timeout)
+        if self.codec is not None:
+            return self.codec.decode_result(command, result)
+        return result
+
+    def _blocking_client(self, name):
+        """Return a client holding a connection of its own to server ``name``,
+        so the command it blocks on can be cancelled by client id.
+        """
+        return redis.Redis(connection_pool=self.connections[name].connection_pool,
+                           single_connection_client=True)
+
+    def _blocking_pop_servers(self, command, push_back, groups, timeout):
+        replies = queue.Queue()
+        client_ids = {}
+
+        def pop(name, client, server_keys):
+            try:
+                reply = (name, self._timed(name, command, BLOCKING, getattr(client, command),
+                                           (server_keys, timeout), {}), None)
+            except Exception as e:
+                reply = (name, None, e)
+            finally:
+                client.close()
+            replies.put(reply)
+
+        clients = {}
+        try:
+            for name in groups:
+                clients[name] = self._blocking_client(name)
+                client_ids[name] = clients[name].client_id()
+        except Exception:
+            for client in clients.values():
+                client.close()
+            raise
+        for name, server_keys in groups.items():
+            t = threading.Thread(target=pop, args=(name, clients[name], server_keys))
+            t.daemon = True
+            t.start()
+
+        pending = set(client_ids)
+        try:
+            while pending:
+                name, item, e = replies.get()
+                pending.discard(name)
+                if e is not None:
+                    raise e
+                if item is not None:
+                    return item
+            return None
+        finally:
+            if pending:
+                # return at once and leave the other pops to a thread of their own
+                t = threading.Thread(target=self._cancel_pops, args=(
+                    push_back, replies, dict((n, client_ids[n]) for n in pending)))
+                t.daemon = True
+                t.start()
+
+    def _cancel_pops(self, push_back, replies, client_ids):
+        """Cancel the pops of ``client_ids`` until each has replied, pushing
+        back the items they popped. A CLIENT UNBLOCK reaching a connection
+        before its BLPOP does nothing, so it is sent again until then.
+        """
+        pending = dict(client_ids)
+        while pending:
+            self._unblock(pending)
+            try:
+                name, item, _ = replies.get(timeout=UNBLOCK_INTERVAL)
+            except queue.Empty:
+                continue
+            del pending[name]
+            if item is not None:
+                getattr(self.connections[name], push_back)(item[0], item[1])
+
+    def _unblock(self, client_ids):
+        for name, client_id in client_ids.items():
+            try:
+                self.connections[name].client_unblock(client_id)
+            except redis.RedisError:
+                # the blocked connection times out on its own
+                pass
+
+    def mget(self, keys, *args):
+        """Fetch many keys, with one MGET per server, returning the values in
+        the order of ``keys``.
+        """
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys.extend(args)
+        if not keys:
+            raise ValueError("method 'mget' requires at least one key")
+        groups = self._group_keys(keys)
+        primary_only = self.reading_from_primary
+        tasks = dict(
+            (name, functools.partial(self._read_server, name, 'mget', FANOUT,
+                                     ([key for _, key in group],), primary_only))
+            for name, group in groups.items())
+        values = [None] * len(keys)
+        for name, result in self._parallel(tasks).items():
+            for (index, _), value in zip(groups[name], result):
+                values[index] = value
+        if self.codec is not None:
+            values = self.codec.decode_result('mget', values)
+        if self.previous is not None:
+            missing = [index for index, value in enumerate(values)
+                       if value is None and self._moved(keys[index])]
+            if missing:
+                previous_values = self.previous.mget([keys[index] for index in missing])
+                for index, value in zip(missing, previous_values):
+                    values[index] = value
+        return values
+
+    def mset(self, mapping):
+        """Set many keys, with one MSET per server. Atomic per server only."""
+        if not mapping:
+            raise ValueError("method 'mset' requires at least one key")
+        groups = self._group_keys(list(mapping))
+        encode = self.codec.encode if self.codec is not None else lambda value, name: value
+        tasks = dict(
+            (name, functools.partial(self._timed, name, 'mset', FANOUT, self.connections[name].mset,
+                                     (dict((key, encode(mapping[key], name)) for _, key in group),),
+                                     {}))
+            for name, group in groups.items())
+        with self._invalidating(list(mapping)):
+            return all(self._parallel(tasks).values())
+
+    def _set_operation(self, method, destination, keys, aggregate=None):
+        """Run the set ``method`` on the server of ``keys`` (a list or
+        ``{key: weight}``) and ``destination`` when they are all on one,
+        otherwise compute it with :class:`SetOperations`.
+        """
+        if not keys:
+            raise ValueError("method '%s' requires at least one key" % method)
+        names = self.get_server_names(
+            list(keys) + ([destination] if destination is not None else []))
+        with self._invalidating([destination] if destination is not None else []):
+            return self._run_set_operation(method, names, destination, keys, aggregate)
+
+    def _run_set_operation(self, method, names, destination, keys, aggregate):
+        if len(names) > 1:
+            operations = SetOperations(self)
+            if method.startswith('z'):
+                return getattr(operations, method)(destination, key_weights(keys), aggregate)
+            keys = [key for key, _ in key_weights(keys)]
+            if destination is None:
+                return getattr(operations, method)(keys)
+            return getattr(operations, method)(destination, keys)
+        name = next(iter(names))
+        args = (keys,) if destination is None else (destination, keys)
+        kwargs = {'aggregate': aggregate} if method.startswith('z') else {}
+        return self._timed(name, method, COMMAND, getattr(self.connections[name], method),
+                           args, kwargs)
+
+    def sinter(self, keys, *args):
+        """Members of every set of ``keys``, which may be on different servers."""
+        return self._set_operation('sinter', None, _key_list(keys, args))
+
+    def sunion(self, keys, *args):
+        """Members of any set of ``keys``, which may be on different servers."""
+        return self._set_operation('sunion', None, _key_list(keys, args))
+
+    def sdiff(self, keys, *args):
+        """Members of the first set of ``keys`` which are in none of the others."""
+        return self._set_operation('sdiff', None, _key_list(keys, args))
+
+    def sinterstore(self, dest, keys, *args):
+        return self._set_operation('sinterstore', dest, _key_list(keys, args))
+
+    def sunionstore(self, dest, keys, *args):
+        return self._set_operation('sunionstore', dest, _key_list(keys, args))
+
+    def sdiffstore(self, dest, keys, *args):
+        return self._set_operation('sdiffstore', dest, _key_list(keys, args))
+
+    def zunionstore(self, dest, keys, aggregate=None):
+        """Store the union of the sorted sets ``keys`` (a list, or a dict of
+        weights) in ``dest``, adding up scores unless ``aggregate`` is MIN or
+        MAX. The keys may be on different servers.
+        """
+        return self._set_operation('zunionstore', dest, keys, aggregate)
+
+    def zinterstore(self, dest, keys, aggregate=None):
+        """Like :meth:`zunionstore` for the members in every sorted set."""
+        return self._set_operation('zinterstore', dest, keys, aggregate)
 
     def keys(self,key):
         _keys = []
-        for server_name in self.server_names:
-            server = self.connections[server_name]
-            _keys.extend(server.keys(key))
+        for server_keys in self.broadcast('keys', key).values():
+            _keys.extend(server_keys)
         return _keys
 
+    def dbsize(self):
+        return sum(self.broadcast('dbsize').values())
+
+    def _scan_server(self, name, results, stop, scan_kwargs):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        try:
+            server = self.connections[name]
+            cursor = 0
+            while not stop.is_set():
+                cursor, keys = server.scan(cursor, **scan_kwargs)
+                for key in keys:
+                    put(key)
+                if not cursor:
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            put(_scan_done)
+
+    def scan_iter(self, match=None, count=None, _type=None, buffer_size=1000):
+        """Iterate over matching keys with SCAN, running the cursors of all
+        servers concurrently and yielding keys as they arrive. At most
+        ``buffer_size`` keys are held in memory. When ``match`` starts with a
+        literal hash tag (``'user{foo}*'``) only the server owning it is
+        scanned; a glob before the tag (``'*{foo}*'``) may match keys with
+        another tag, so every server is.
+        """
+        scan_kwargs = {}
+        if match is not None:
+            scan_kwargs['match'] = match
+        if count is not None:
+            scan_kwargs['count'] = count
+        if _type is not None:
+            scan_kwargs['_type'] = _type
+
+        server_names = self.server_names
+        if match is not None:
+            tag = hash_tag(match)
+            # the part up to the end of the tag, which keys matching have too
+            literal = match[:match.find('{') + 1 + len(tag)]
+            if tag != match and not _glob_chars.search(literal):
+                server_names = [self.get_server_name(match)]
+
+        results = queue.Queue(maxsize=buffer_size)
+        stop = threading.Event()
+        for name in server_names:
+            t = threading.Thread(target=self._scan_server,
+                                 args=(name, results, stop, scan_kwargs))
+            t.daemon = True
+            t.start()
+        try:
+            pending = len(server_names)
+            while pending:
+                item = results.get()
+                if item is _scan_done:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
     def flushdb(self):
-        for server_name in self.server_names:
-            server = self.connections[server_name]
-            server.flushdb()
+        self.broadcast('flushdb')
+        if self.near_cache is not None:
+            self.near_cache.clear()
+
+
+def _key_list(keys, args):
+    keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+    keys.extend(args)
+    if not keys:
+        raise ValueError("at least one key is required")
+    return keys
+
+
+def _sharded_command(spec):
+    get_key = key_getter(spec)
+    if spec.key_position == ALL_KEYS:
+        def command(self, *keys):
+            return self._multi_key_sum(spec, get_key(keys))
+    else:
+        def command(self, *args, **kwargs):
+            return self._execute(spec, get_key(args), args, kwargs)
+    command.__name__ = spec.name
+    command.__doc__ = "Sharded ``%s``, see :class:`redis.Redis`." % spec.redis_method
+    return command
+
+
+_tag_commands = {}
+
+
+def _tag_command(name):
+    command = _tag_commands.get(name)
+    if command is None:
+        command = _tag_commands[name] = _sharded_command(tag_spec(name))
+    return command
+
+
+for _spec in COMMANDS.values():
+    setattr(ShardedRedis, _spec.name, _sharded_command(_spec))
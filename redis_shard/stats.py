@@ -0,0 +1,136 @@
+"""
+Per-server instrumentation. ShardedRedis calls each of its ``listeners`` with
+a :class:`CommandEvent` after every command it sends; :class:`ShardStats` is a
+listener which aggregates them. With no listeners nothing is measured.
+"""
+from __future__ import absolute_import
+import bisect
+import threading
+from collections import namedtuple
+
+import six
+
+#: ``kind`` of a single-key command
+COMMAND = 'command'
+#: ``kind`` of one server's part of a command sent to many servers
+FANOUT = 'fanout'
+#: ``kind`` of a blocking pop
+BLOCKING = 'blocking'
+#: ``kind`` of one server's part of a pipeline
+PIPELINE = 'pipeline'
+
+CommandEvent = namedtuple('CommandEvent', [
+    'server_name', 'command', 'kind', 'duration', 'error', 'bytes_out', 'bytes_in'])
+
+
+def payload_size(value):
+    """Bytes in ``value`` when it is a string or a flat list/tuple/dict of
+    strings, ignoring everything else.
+    """
+    if isinstance(value, (bytes, six.text_type)):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.keys()) + list(value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(len(v) for v in value if isinstance(v, (bytes, six.text_type)))
+    return 0
+
+
+class LatencyHistogram(object):
+    """Count durations in fixed buckets, from 50us up to 10s."""
+
+    #: upper bound of each bucket in seconds; the last bucket is unbounded
+    BOUNDS = (
+        0.00005, 0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    )
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def record(self, duration):
+        self.counts[bisect.bisect_left(self.BOUNDS, duration)] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the ``p``th percentile (0-100),
+        ``float('inf')`` past the last bound and None when empty.
+        """
+        if not self.total:
+            return None
+        rank = self.total * p / 100.0
+        seen = 0
+        for bound, count in zip(self.BOUNDS + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return float('inf')
+
+
+class _CommandStats(object):
+    __slots__ = ('calls', 'errors', 'bytes_out', 'bytes_in', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency = LatencyHistogram()
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'p50': self.latency.percentile(50),
+            'p99': self.latency.percentile(99),
+        }
+
+
+class ShardStats(object):
+    """Listener counting calls, errors, bytes and latency per server, command
+    and kind.
+
+    >>> stats = ShardStats()
+    >>> client = ShardedRedis(servers, listeners=[stats])
+    >>> stats.snapshot()['server1']['get']['command']['p99']
+    0.001
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, event):
+        key = (event.server_name, event.command, event.kind)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _CommandStats()
+            stats.calls += 1
+            if event.error is not None:
+                stats.errors += 1
+            stats.bytes_out += event.bytes_out
+            stats.bytes_in += event.bytes_in
+            stats.latency.record(event.duration)
+
+    def histogram(self, server_name, command, kind=COMMAND):
+        with self._lock:
+            stats = self._stats.get((server_name, command, kind))
+            return stats.latency if stats is not None else None
+
+    def snapshot(self):
+        """Return ``{server_name: {command: {kind: counters}}}``."""
+        with self._lock:
+            snapshot = {}
+            for (server_name, command, kind), stats in self._stats.items():
+                snapshot.setdefault(server_name, {}).setdefault(command, {})[kind] = \
+                    stats.snapshot()
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
@@ -26,7 +26,12 @@ setup(
     packages=["redis_shard"],
     include_package_data=True,
     zip_safe=False,
-    install_requires=['redis', 'six'],
+    entry_points={
+        'console_scripts': ['redis-shard-migrate = redis_shard.migrate:main'],
+    },
+    install_requires=['redis', 'six', 'futures; python_version < "3"',
+                      'selectors34; python_version < "3"'],
+    extras_require={'lz4': ['lz4']},
     classifiers=[
         "Programming Language :: Python",
         "Operating System :: OS Independent",
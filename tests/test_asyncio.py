@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+
+from unittest import TestCase, skipIf
+
+import six
+from redis.exceptions import ConnectionError
+
+from redis_shard.exceptions import BroadcastError
+from .mock import call
+
+try:
+    import asyncio
+    from unittest.mock import AsyncMock
+    from redis_shard.asyncio import AsyncShardedRedis
+except ImportError:
+    AsyncShardedRedis = None
+
+
+@skipIf(AsyncShardedRedis is None, "requires python 3.8 and redis.asyncio")
+class AsyncShardedRedisTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'password': '', 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'password': '', 'db': 0},
+            {'name': 'r3', 'host': 'localhost', 'port': 3, 'password': '', 'db': 0},
+            {'name': 'r4', 'host': 'localhost', 'port': 4, 'password': '', 'db': 0},
+        ]
+        self.sharded_redis = AsyncShardedRedis(servers)
+        self.mock_servers = dict(
+            (name, AsyncMock()) for name in ['r1', 'r2', 'r3', 'r4'])
+        self.sharded_redis.connections = self.mock_servers
+
+    def run_coro(self, coro):
+        return asyncio.run(coro)
+
+    def test_pool_options(self):
+        import redis.asyncio
+        sharded_redis = AsyncShardedRedis(
+            [{'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0,
+              'blocking_pool': True, 'max_connections': 4}],
+            pool_options={'socket_timeout': 1.0})
+        pool = sharded_redis.connections['r1'].connection_pool
+        self.assertIsInstance(pool, redis.asyncio.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 4)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 1.0)
+
+    def test_after_fork(self):
+        from redis_shard import pools
+        sharded_redis = AsyncShardedRedis([{'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0}])
+        self.assertIn(sharded_redis, pools._clients)
+        pool = sharded_redis.connections['r1'].connection_pool
+        connection = pool.make_connection()
+        pool._in_use_connections.add(connection)
+        sharded_redis._after_fork()
+        self.assertEqual(pool._created_connections, 0)
+        self.assertNotIn(connection, pool._in_use_connections)
+
+    def test_routes_like_sharded_redis(self):
+        from redis_shard.shard import ShardedRedis
+        sync_redis = ShardedRedis([{'name': name, 'host': 'localhost', 'port': 1, 'db': 0}
+                                   for name in ['r1', 'r2', 'r3', 'r4']])
+        for key in ['key%s' % i for i in range(20)] + ['a{key1}b']:
+            self.assertEqual(self.sharded_redis.get_server_name(key),
+                             sync_redis.get_server_name(key))
+
+    def test_wrapped_method(self):
+        server = self.mock_servers[self.sharded_redis.get_server_name('test_key')]
+        server.get.return_value = 'value'
+        result = self.run_coro(self.sharded_redis.get('test_key', kwarg1=1))
+        self.assertEqual(result, 'value')
+        self.assertEqual(server.get.mock_calls, [call('test_key', kwarg1=1)])
+
+    def test_wrapped_get_without_key(self):
+        expected_rx = r'method \'get\' requires a key param as the first argument'
+        with six.assertRaisesRegex(self, ValueError, expected_rx):
+            self.run_coro(self.sharded_redis.get())
+
+    def test_wrapped_tag_method(self):
+        server = self.mock_servers[self.sharded_redis.get_server_name('foo')]
+        server.mget.return_value = ['1', '2']
+        result = self.run_coro(self.sharded_redis.tag_mget(['a{foo}', 'b{foo}']))
+        self.assertEqual(result, ['1', '2'])
+
+    def test_unsupported_method(self):
+        with six.assertRaisesRegex(self, NotImplementedError, r"cannot be sharded"):
+            self.sharded_redis.unsupported_method
+
+    def test_mget(self):
+        for mock_server in self.mock_servers.values():
+            mock_server.mget.side_effect = lambda keys: ['v_' + k for k in keys]
+        keys = ['key%s' % i for i in range(20)]
+        result = self.run_coro(self.sharded_redis.mget(keys))
+        self.assertEqual(result, ['v_' + k for k in keys])
+
+    def test_delete(self):
+        for mock_server in self.mock_servers.values():
+            mock_server.delete.side_effect = lambda *keys: len(keys)
+        keys = ['key%s' % i for i in range(20)]
+        self.assertEqual(self.run_coro(self.sharded_redis.delete(*keys)), 20)
+
+    def test_keys(self):
+        for name, mock_server in self.mock_servers.items():
+            mock_server.keys.return_value = ['key_' + name]
+        result = self.run_coro(self.sharded_redis.keys('*'))
+        self.assertEqual(sorted(result), ['key_r1', 'key_r2', 'key_r3', 'key_r4'])
+
+    def test_broadcast_collects_errors(self):
+        for mock_server in self.mock_servers.values():
+            mock_server.dbsize.return_value = 1
+        error = ConnectionError('boom')
+        self.mock_servers['r2'].dbsize.side_effect = error
+        with self.assertRaises(BroadcastError) as ctx:
+            self.run_coro(self.sharded_redis.dbsize())
+        self.assertEqual(ctx.exception.errors, {'r2': error})
+
+    def test_blpop(self):
+        server = self.mock_servers[self.sharded_redis.get_server_name('test_key')]
+        server.blpop.return_value = ('test_key', 'value')
+        result = self.run_coro(self.sharded_redis.blpop('test_key', 5))
+        self.assertEqual(result, ('test_key', 'value'))
+        self.assertEqual(server.blpop.mock_calls, [call('test_key', 5)])
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import threading
+from unittest import TestCase
+
+from redis import Redis
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError, ResponseError
+
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock
+
+
+class AutoPipelineTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ]
+        self.sharded_redis = ShardedRedis(
+            servers, auto_pipeline={'max_batch': 4, 'window': 0.05})
+        self.auto_pipeliner = self.sharded_redis.auto_pipeliner
+        self.mock_servers = {}
+        self.pipes = []
+        for name in ['r1', 'r2']:
+            mock_server = Mock(spec=Redis)
+            mock_server.pipeline.side_effect = self._mock_pipe
+            self.mock_servers[name] = mock_server
+        self.sharded_redis.connections = self.mock_servers
+        self.name = self.sharded_redis.get_server_name('key1')
+
+    def tearDown(self):
+        self.sharded_redis.close()
+
+    def _mock_pipe(self, transaction=True):
+        pipe = Mock(spec=Pipeline)
+        # reply with the key of each queued command
+        pipe.execute.side_effect = lambda raise_on_error: [
+            ResponseError('WRONGTYPE') if c[1][0] == 'bad' else c[1][0]
+            for c in pipe.mock_calls if c[0] != 'execute']
+        self.pipes.append(pipe)
+        return pipe
+
+    def test_full_batch_is_one_pipeline(self):
+        futures = [self.auto_pipeliner.submit(self.name, 'get', ('k%d' % i,), {})
+                   for i in range(4)]
+        self.assertEqual([f.result() for f in futures], ['k0', 'k1', 'k2', 'k3'])
+        self.assertEqual(len(self.pipes), 1)
+        self.assertEqual(self.pipes[0].mock_calls[:4], [call.get('k%d' % i) for i in range(4)])
+        self.mock_servers[self.name].pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual((self.auto_pipeliner.batches, self.auto_pipeliner.commands), (1, 4))
+
+    def test_window_flushes_partial_batch(self):
+        self.assertEqual(self.sharded_redis.get('key1'), 'key1')
+        self.assertEqual(len(self.pipes), 1)
+
+    def test_concurrent_callers(self):
+        keys = ['key%d' % i for i in range(40)]
+        results = {}
+
+        def get(key):
+            results[key] = self.sharded_redis.get(key)
+        threads = [threading.Thread(target=get, args=(key,)) for key in keys]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, dict((key, key) for key in keys))
+        self.assertLess(len(self.pipes), len(keys))
+        for name, mock_server in self.mock_servers.items():
+            for pipe_call in mock_server.pipeline.mock_calls:
+                self.assertEqual(pipe_call, call(transaction=False))
+
+    def test_errors_go_to_their_caller(self):
+        futures = [self.auto_pipeliner.submit(self.name, 'get', (key,), {})
+                   for key in ['a', 'bad', 'c', 'd']]
+        self.assertEqual(futures[0].result(), 'a')
+        self.assertIsInstance(futures[1].exception(), ResponseError)
+        self.assertEqual(futures[3].result(), 'd')
+
+    def test_failed_pipeline_fails_every_caller(self):
+        self.mock_servers[self.name].pipeline.side_effect = None
+        self.mock_servers[self.name].pipeline.return_value.execute.side_effect = ConnectionError()
+        futures = [self.auto_pipeliner.submit(self.name, 'get', ('k%d' % i,), {})
+                   for i in range(4)]
+        for future in futures:
+            self.assertIsInstance(future.exception(), ConnectionError)
+
+    def test_blocking_commands_are_not_pipelined(self):
+        self.sharded_redis.blpop_in()
+        self.assertTrue(self.mock_servers[self.sharded_redis.get_server_name('queue')].blpop.called)
+        self.assertEqual(self.pipes, [])
+
+    def test_close_sends_queued_commands(self):
+        self.auto_pipeliner.window = 10
+        future = self.auto_pipeliner.submit(self.name, 'get', ('key1',), {})
+        self.auto_pipeliner.close()
+        self.assertEqual(future.result(), 'key1')
+        # and a later command starts over
+        self.auto_pipeliner.window = 0
+        self.assertEqual(self.sharded_redis.get('key1'), 'key1')
+
+    def test_submit_racing_close(self):
+        auto_pipeliner = self.auto_pipeliner
+        auto_pipeliner.window = 0
+        stale = auto_pipeliner._queue(self.name)
+        queue = auto_pipeliner._queue
+
+        def racing_close(name):
+            # close() runs between looking the queue up and queuing on it
+            auto_pipeliner._queue = queue
+            auto_pipeliner.close()
+            return stale
+        auto_pipeliner._queue = racing_close
+        future = auto_pipeliner.submit(self.name, 'get', ('key1',), {})
+        self.assertEqual(future.result(timeout=1), 'key1')
+        self.assertEqual(stale.pending, [])
@@ -0,0 +1,200 @@
+from __future__ import absolute_import
+
+import threading
+from unittest import TestCase
+
+import six
+from redis import Redis
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+from redis_shard.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, HedgePolicy
+from redis_shard.exceptions import CircuitOpenError
+from redis_shard.shard import ShardedRedis
+from .mock import Mock, patch
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('r1', failure_threshold=3, reset_timeout=10)
+
+    def fail(self, count, error=None):
+        for _ in range(count):
+            self.breaker.before_call()
+            self.breaker.record(error or ConnectionError())
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.breaker.before_call()
+        self.breaker.record()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail(1, TimeoutError())
+        self.assertEqual(self.breaker.state, OPEN)
+        with six.assertRaisesRegex(self, CircuitOpenError, "server 'r1' is open"):
+            self.breaker.before_call()
+
+    def test_reply_errors_are_not_failures(self):
+        self.fail(5, ResponseError('WRONGTYPE'))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probe(self):
+        with patch('redis_shard.breaker.time') as mock_time:
+            mock_time.time.return_value = 100
+            self.fail(3)
+            mock_time.time.return_value = 111
+            self.breaker.before_call()
+            self.assertEqual(self.breaker.state, HALF_OPEN)
+            # one probe at a time
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.before_call()
+            self.breaker.record()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_call()
+
+    def test_failed_probe_reopens(self):
+        with patch('redis_shard.breaker.time') as mock_time:
+            mock_time.time.return_value = 100
+            self.fail(3)
+            mock_time.time.return_value = 111
+            self.fail(1)
+            self.assertEqual(self.breaker.state, OPEN)
+            mock_time.time.return_value = 115
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.before_call()
+
+
+class ShardedBreakerTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ]
+        self.fallbacks = []
+        self.sharded_redis = ShardedRedis(
+            servers, circuit_breaker={'failure_threshold': 2},
+            breaker_fallback=lambda command, key, error: self.fallbacks.append(
+                (command, key, error.server_name)))
+        self.mock_servers = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2'])
+        self.sharded_redis.connections = self.mock_servers
+        self.name = self.sharded_redis.get_server_name('key1')
+        self.mock_servers[self.name].get.side_effect = ConnectionError()
+
+    def test_fast_fail_with_fallback(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.sharded_redis.get('key1')
+        self.assertEqual(self.sharded_redis.breakers[self.name].state, OPEN)
+        self.sharded_redis.get('key1')
+        self.assertEqual(self.mock_servers[self.name].get.call_count, 2)
+        self.assertEqual(self.fallbacks, [('get', 'key1', self.name)])
+
+    def test_fast_fail_without_fallback(self):
+        self.sharded_redis.breaker_fallback = None
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.sharded_redis.get('key1')
+        with self.assertRaises(CircuitOpenError):
+            self.sharded_redis.set('key1', 1)
+
+    def test_other_servers_are_unaffected(self):
+        other = next(k for k in ('key%d' % i for i in range(100))
+                     if self.sharded_redis.get_server_name(k) != self.name)
+        for _ in range(3):
+            try:
+                self.sharded_redis.get('key1')
+            except ConnectionError:
+                pass
+        self.sharded_redis.get(other)
+        self.assertEqual(self.fallbacks, [('get', 'key1', self.name)])
+
+    def test_blocking_pop_is_not_a_probe(self):
+        breaker = self.sharded_redis._breaker(self.name)
+        breaker.state, breaker._opened_at = OPEN, 0
+        server = self.mock_servers[self.name]
+        server.get.side_effect = None
+        server.get.return_value = b'v'
+        # while the pop blocks, other commands can still probe the server
+        server.blpop.side_effect = lambda key, timeout: (b'key1', self.sharded_redis.get('key1'))
+        self.assertEqual(self.sharded_redis.blpop('key1', timeout=0), (b'key1', b'v'))
+        self.assertEqual(breaker.state, CLOSED)
+        server.blpop.side_effect = ConnectionError()
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                self.sharded_redis.blpop('key1')
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_fanout_reports_open_breaker(self):
+        self.sharded_redis._breaker(self.name).state = OPEN
+        self.sharded_redis.breakers[self.name]._opened_at = float('inf')
+        results = self.sharded_redis.broadcast('dbsize', return_exceptions=True)
+        self.assertIsInstance(results[self.name], CircuitOpenError)
+        self.assertFalse(self.mock_servers[self.name].dbsize.called)
+
+
+class HedgePolicyTests(TestCase):
+    def setUp(self):
+        self.hedge = HedgePolicy(min_samples=4, default_delay=0.01, min_delay=0.001)
+
+    def tearDown(self):
+        self.hedge.close()
+
+    def test_delay_follows_percentile(self):
+        self.assertEqual(self.hedge.delay('r1'), 0.01)
+        for duration in [0.002, 0.004, 0.003, 0.05]:
+            self.hedge.record('r1', duration)
+        self.assertEqual(self.hedge.delay('r1'), 0.05)
+        self.hedge.percentile = 50
+        self.assertEqual(self.hedge.delay('r1'), 0.004)
+
+    def test_fast_read_is_not_hedged(self):
+        second = Mock()
+        self.assertEqual(self.hedge.run('r1', lambda: 'first', second), 'first')
+        self.assertFalse(second.called)
+        self.assertEqual(self.hedge.hedged, 0)
+
+    def test_slow_read_is_hedged(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return 'slow'
+        try:
+            self.assertEqual(self.hedge.run('r1', slow, lambda: 'hedge'), 'hedge')
+        finally:
+            release.set()
+        self.assertEqual(self.hedge.hedged, 1)
+
+    def test_hedge_failure_waits_for_first(self):
+        def slow():
+            threading.Event().wait(0.05)
+            return 'slow'
+
+        def broken():
+            raise ConnectionError()
+        self.assertEqual(self.hedge.run('r1', slow, broken), 'slow')
+
+    def test_both_fail(self):
+        def broken():
+            raise ConnectionError()
+        with self.assertRaises(ConnectionError):
+            self.hedge.run('r1', broken, broken)
+
+
+class ShardedHedgeTests(TestCase):
+    def test_hedged_replica_read(self):
+        servers = [{'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0,
+                    'replicas': [{'host': 'localhost', 'port': 11},
+                                 {'host': 'localhost', 'port': 12}]}]
+        hedge = HedgePolicy(default_delay=0.01)
+        sharded_redis = ShardedRedis(servers, hedge=hedge)
+        slow, fast = Mock(spec=Redis), Mock(spec=Redis)
+        release = threading.Event()
+        slow.get.side_effect = lambda key: release.wait(5) and b'slow'
+        fast.get.return_value = b'fast'
+        sharded_redis.replicas['r1'].connections = [slow, fast]
+        try:
+            self.assertEqual(sharded_redis.get('key1'), b'fast')
+        finally:
+            release.set()
+            sharded_redis.close()
+        self.assertEqual(hedge.hedged, 1)
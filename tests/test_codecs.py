@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import zlib
+from unittest import TestCase
+
+import six
+from redis import Redis
+
+from redis_shard.codecs import HEADER, Lz4Compressor, ValueCodec, ZlibCompressor, lz4
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock
+
+BIG = b'{"name": "' + b'x' * 2000 + b'"}'
+
+
+class ValueCodecTests(TestCase):
+    def setUp(self):
+        self.codec = ValueCodec(ZlibCompressor(), threshold=100)
+
+    def test_round_trip(self):
+        stored = self.codec.encode(BIG, 'r1')
+        self.assertTrue(stored.startswith(HEADER + b'\x01'))
+        self.assertEqual(zlib.decompress(stored[4:]), BIG)
+        self.assertEqual(self.codec.decode(stored), BIG)
+        self.assertEqual(self.codec.decode(self.codec.encode(BIG.decode('utf-8'))), BIG)
+
+    def test_small_and_non_string_values_are_kept(self):
+        self.assertEqual(self.codec.encode(b'small'), b'small')
+        self.assertEqual(self.codec.encode(42), 42)
+        self.assertEqual(self.codec.decode(b'small'), b'small')
+
+    def test_incompressible_values_are_kept(self):
+        data = bytes(bytearray(range(256)))
+        self.assertEqual(self.codec.encode(data), data)
+
+    def test_values_looking_like_headers_are_escaped(self):
+        tricky = HEADER + b'\x01abc'
+        stored = self.codec.encode(tricky)
+        self.assertNotEqual(stored, tricky)
+        self.assertEqual(self.codec.decode(stored), tricky)
+
+    def test_unknown_codec(self):
+        with six.assertRaisesRegex(self, ValueError, "unknown compression codec 9"):
+            self.codec.decode(HEADER + b'\x09abc')
+
+    def test_lz4_is_optional(self):
+        if lz4 is None:
+            with self.assertRaises(ImportError):
+                Lz4Compressor()
+            self.assertIsInstance(ValueCodec().compressor, ZlibCompressor)
+        else:
+            codec = ValueCodec(Lz4Compressor(), threshold=100)
+            self.assertEqual(self.codec.decode(codec.encode(BIG)), BIG)
+
+    def test_encode_args(self):
+        encode = self.codec.encode
+        self.assertEqual(self.codec.encode_args('setex', ('k', 10, BIG), {}),
+                         (('k', 10, encode(BIG)), {}))
+        self.assertEqual(self.codec.encode_args('rpush', ('k', BIG, b'a'), {}),
+                         (('k', encode(BIG), b'a'), {}))
+        self.assertEqual(self.codec.encode_args('hset', ('k',), {'mapping': {'f': BIG}}),
+                         (('k',), {'mapping': {'f': encode(BIG)}}))
+        self.assertEqual(self.codec.encode_args('incr', ('k', 1), {}), (('k', 1), {}))
+
+    def test_decode_result(self):
+        stored = self.codec.encode(BIG)
+        self.assertEqual(self.codec.decode_result('lrange', [stored, b'a']), [BIG, b'a'])
+        self.assertEqual(self.codec.decode_result('hgetall', {b'f': stored}), {b'f': BIG})
+        self.assertEqual(self.codec.decode_result('blpop', (b'k', stored)), (b'k', BIG))
+        self.assertEqual(self.codec.decode_result('keys', [stored]), [stored])
+
+    def test_stats(self):
+        stored = self.codec.encode(BIG, 'r1')
+        self.codec.encode(b'small', 'r1')
+        self.assertEqual(self.codec.stats(), {'r1': {
+            'compressed': 1, 'bytes_in': len(BIG), 'bytes_stored': len(stored),
+            'bytes_saved': len(BIG) - len(stored)}})
+
+
+class ShardedCodecTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ]
+        self.codec = ValueCodec(ZlibCompressor(), threshold=100)
+        self.sharded_redis = ShardedRedis(servers, codec=self.codec)
+        self.mock_servers = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2'])
+        self.sharded_redis.connections = self.mock_servers
+        self.name = self.sharded_redis.get_server_name('key1')
+        self.server = self.mock_servers[self.name]
+        self.stored = self.codec.encode(BIG)
+        self.codec.reset()
+
+    def test_set_and_get(self):
+        self.sharded_redis.set('key1', BIG)
+        self.server.set.assert_called_once_with('key1', self.stored)
+        self.server.get.return_value = self.stored
+        self.assertEqual(self.sharded_redis.get('key1'), BIG)
+        self.assertEqual(list(self.codec.stats()), [self.name])
+
+    def test_old_values_are_read_as_they_are(self):
+        self.server.get.return_value = b'plain'
+        self.assertEqual(self.sharded_redis.get('key1'), b'plain')
+
+    def test_hash_and_list_values(self):
+        self.sharded_redis.hset('key1', 'f', BIG)
+        self.server.hset.assert_called_once_with('key1', 'f', self.stored)
+        self.server.hgetall.return_value = {b'f': self.stored}
+        self.assertEqual(self.sharded_redis.hgetall('key1'), {b'f': BIG})
+        self.sharded_redis.rpush('key1', BIG)
+        self.server.rpush.assert_called_once_with('key1', self.stored)
+        self.server.lrange.return_value = [self.stored]
+        self.assertEqual(self.sharded_redis.lrange('key1', 0, -1), [BIG])
+        self.sharded_redis.lrem('key1', 0, BIG)
+        self.server.lrem.assert_called_once_with('key1', 0, self.stored)
+
+    def test_mset_and_mget(self):
+        for mock_server in self.mock_servers.values():
+            mock_server.mget.side_effect = lambda keys: [self.stored for _ in keys]
+        self.sharded_redis.mset({'key1': BIG})
+        self.server.mset.assert_called_once_with({'key1': self.stored})
+        self.assertEqual(self.sharded_redis.mget(['key1', 'key2']), [BIG, BIG])
+
+    def test_pipeline(self):
+        pipe_mock = self.server.pipeline.return_value
+        pipe_mock.execute.return_value = [True, self.stored]
+        pipe = self.sharded_redis.pipeline()
+        pipe.set('key1', BIG).get('key1')
+        self.assertEqual(pipe.execute(), [True, BIG])
+        self.assertEqual(pipe_mock.mock_calls[0], call.set('key1', self.stored))
+
+    def test_blocking_pop(self):
+        self.server.blpop.return_value = (b'key1', self.stored)
+        self.assertEqual(self.sharded_redis.blpop('key1'), (b'key1', BIG))
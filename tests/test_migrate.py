@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from redis_shard.migrate import Migrator, main
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock, patch
+
+
+def _servers(names):
+    return [{'name': name, 'host': 'localhost', 'port': i, 'db': 0}
+            for i, name in enumerate(names)]
+
+
+class MigratorTests(TestCase):
+    def setUp(self):
+        self.old = ShardedRedis(_servers(['r1', 'r2']))
+        self.new = ShardedRedis(_servers(['r1', 'r2', 'r3']))
+        self.mock_servers = {}
+        for name in ['r1', 'r2', 'r3']:
+            mock_server = Mock(spec=Redis)
+            # a pipeline per call: both old servers may restore to r3 at once
+            mock_server.pipeline.side_effect = (
+                lambda transaction=True, name=name: self._mock_pipe(name))
+            self.mock_servers[name] = mock_server
+        self.old.connections = dict((n, self.mock_servers[n]) for n in ['r1', 'r2'])
+        self.new.connections = self.mock_servers
+        keys = ['key%s' % i for i in range(40)]
+        self.keys = dict(
+            (name, [key for key in keys if self.old.get_server_name(key) == name])
+            for name in ['r1', 'r2'])
+        for name in ['r1', 'r2']:
+            self.mock_servers[name].scan.side_effect = self._scan(self.keys[name])
+        self.restored = []
+        # {server_name: fn(pipe)} replacing _pipe_replies
+        self.replies = {}
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _scan(self, keys):
+        # two pages per server
+        def scan(cursor, count):
+            half = len(keys) // 2
+            return (1, keys[:half]) if cursor == 0 else (0, keys[half:])
+        return scan
+
+    def _mock_pipe(self, name):
+        mock_pipe = Mock()
+        replies = self.replies.get(name, self._pipe_replies)
+        mock_pipe.execute.side_effect = lambda raise_on_error=True: replies(mock_pipe)
+        return mock_pipe
+
+    def _pipe_replies(self, pipe):
+        replies = []
+        for name, args, kwargs in pipe.mock_calls:
+            if name == 'dump':
+                replies.append(b'data:' + args[0].encode('utf-8'))
+            elif name == 'pttl':
+                replies.append(-1)
+            elif name == 'restore':
+                self.restored.append(args + (kwargs['replace'],))
+                replies.append(True)
+        return replies
+
+    def moved_keys(self):
+        return [k for k in range(40)
+                if self.new.get_server_name('key%s' % k) != self.old.get_server_name('key%s' % k)]
+
+    def test_moves_misplaced_keys(self):
+        progress = Migrator(self.old, self.new, batch_size=3).run()
+        expected = ['key%s' % k for k in self.moved_keys()]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(r[0] for r in self.restored), sorted(expected))
+        for key, ttl, data, replace in self.restored:
+            self.assertEqual((ttl, data, replace), (0, b'data:' + key.encode('utf-8'), False))
+        deleted = [k for name in ['r1', 'r2']
+                   for c in self.mock_servers[name].delete.mock_calls for k in c[1]]
+        self.assertEqual(sorted(deleted), sorted(expected))
+        self.assertEqual(sum(state['moved'] for state in progress.values()), len(expected))
+        self.assertEqual(sum(state['scanned'] for state in progress.values()), 40)
+        self.assertTrue(all(state['done'] for state in progress.values()))
+
+    def test_busy_key_is_kept(self):
+        busy = ResponseError('BUSYKEY Target key name already exists.')
+        self.replies['r3'] = lambda pipe: [busy for c in pipe.mock_calls if c[0] == 'restore']
+        Migrator(self.old, self.new).run()
+        deleted = [k for name in ['r1', 'r2']
+                   for c in self.mock_servers[name].delete.mock_calls for k in c[1]]
+        self.assertEqual(len(deleted), len(self.moved_keys()))
+
+    def test_restore_error_is_raised(self):
+        self.replies['r3'] = lambda pipe: [ResponseError('OOM')]
+        with self.assertRaises(ResponseError):
+            Migrator(self.old, self.new).run()
+        for name in ['r1', 'r2']:
+            self.assertFalse(self.mock_servers[name].delete.called)
+
+    def test_checkpoint_resume(self):
+        path = os.path.join(self.tmp_dir, 'progress.json')
+        with open(path, 'w') as f:
+            json.dump({'r1': {'cursor': 0, 'done': True, 'scanned': 0, 'moved': 0},
+                       'r2': {'cursor': 1, 'done': False, 'scanned': 0, 'moved': 0}}, f)
+        Migrator(self.old, self.new, checkpoint_path=path).run()
+        self.assertFalse(self.mock_servers['r1'].scan.called)
+        self.assertEqual(self.mock_servers['r2'].scan.mock_calls, [call(1, count=1000)])
+        with open(path) as f:
+            self.assertEqual(json.load(f)['r2']['done'], True)
+
+    def test_throttle(self):
+        with patch('redis_shard.migrate.time') as mock_time:
+            mock_time.time.return_value = 0
+            Migrator(self.old, self.new, batch_size=1, max_keys_per_second=10).run()
+        self.assertTrue(mock_time.sleep.called)
+
+    def test_main(self):
+        old_path = os.path.join(self.tmp_dir, 'old.json')
+        new_path = os.path.join(self.tmp_dir, 'new.json')
+        with open(old_path, 'w') as f:
+            json.dump(_servers(['r1', 'r2']), f)
+        with open(new_path, 'w') as f:
+            json.dump({'servers': _servers(['r1', 'r2', 'r3']),
+                       'directory_options': {'hash_mode': 'crc16'}}, f)
+        with patch('redis_shard.migrate.Migrator') as mock_migrator:
+            mock_migrator.return_value.run.return_value = {}
+            main([old_path, new_path, '--batch-size', '10'])
+        old, new = mock_migrator.call_args[0]
+        self.assertEqual(old.server_names, ['r1', 'r2'])
+        self.assertEqual(new.directory.hash_mode, 'crc16')
+        self.assertEqual(mock_migrator.call_args[1]['batch_size'], 10)
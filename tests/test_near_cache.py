@@ -0,0 +1,171 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from redis_shard.near_cache import InvalidationTracker, NearCache
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock, patch
+
+
+class NearCacheTests(TestCase):
+    def test_get_and_set(self):
+        cache = NearCache()
+        self.assertEqual(cache.get('key1', 'get', ('key1',)), (None, False))
+        cache.set('key1', 'get', ('key1',), b'value', cache.generation)
+        self.assertEqual(cache.get('key1', 'get', ('key1',)), (b'value', True))
+        self.assertEqual(cache.get('key1', 'hget', ('key1', 'f')), (None, False))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'invalidations': 0, 'size': 1})
+
+    def test_lru_eviction(self):
+        cache = NearCache(max_size=2)
+        for key in ['a', 'b']:
+            cache.set(key, 'get', (key,), key, cache.generation)
+        cache.get('a', 'get', ('a',))
+        cache.set('c', 'get', ('c',), 'c', cache.generation)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b', 'get', ('b',)), (None, False))
+        self.assertEqual(cache.get('a', 'get', ('a',)), ('a', True))
+
+    def test_ttl(self):
+        cache = NearCache(ttl=10)
+        with patch('redis_shard.near_cache.time') as mock_time:
+            mock_time.time.return_value = 100
+            cache.set('a', 'get', ('a',), 'a', cache.generation)
+            mock_time.time.return_value = 109
+            self.assertEqual(cache.get('a', 'get', ('a',)), ('a', True))
+            mock_time.time.return_value = 111
+            self.assertEqual(cache.get('a', 'get', ('a',)), (None, False))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = NearCache()
+        cache.set('a', 'hget', ('a', 'f1'), 1, cache.generation)
+        cache.set('a', 'hget', ('a', 'f2'), 2, cache.generation)
+        cache.set('b', 'get', ('b',), 3, cache.generation)
+        cache.invalidate_args(('a', 'f1', 5))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.invalidations, 2)
+
+    def test_stale_read_is_not_stored(self):
+        cache = NearCache()
+        generation = cache.generation
+        cache.invalidate('a')
+        cache.set('a', 'get', ('a',), 'old', generation)
+        self.assertEqual(len(cache), 0)
+
+
+class ShardedNearCacheTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ]
+        self.cache = NearCache()
+        self.sharded_redis = ShardedRedis(servers, near_cache=self.cache)
+        self.mock_servers = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2'])
+        self.sharded_redis.connections = self.mock_servers
+        self.server = self.mock_servers[self.sharded_redis.get_server_name('key1')]
+        self.server.get.return_value = b'value'
+
+    def test_repeated_reads_are_cached(self):
+        self.assertEqual(self.sharded_redis.get('key1'), b'value')
+        self.assertEqual(self.sharded_redis.get('key1'), b'value')
+        self.assertEqual(self.server.get.mock_calls, [call('key1')])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_uncached_reads(self):
+        self.sharded_redis.smembers('key1')
+        self.sharded_redis.smembers('key1')
+        self.assertEqual(len(self.server.smembers.mock_calls), 2)
+
+    def test_writes_invalidate(self):
+        self.sharded_redis.get('key1')
+        self.sharded_redis.set('key1', b'new')
+        self.sharded_redis.get('key1')
+        self.assertEqual(len(self.server.get.mock_calls), 2)
+
+    def test_multi_key_writes_invalidate(self):
+        for mock_server in self.mock_servers.values():
+            mock_server.delete.return_value = 1
+        self.sharded_redis.get('key1')
+        self.sharded_redis.delete('key1', 'key2')
+        self.assertEqual(len(self.cache), 0)
+        self.sharded_redis.get('key1')
+        self.sharded_redis.mset({'key1': 1})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_pipeline_writes_invalidate(self):
+        self.server.pipeline.return_value.execute.return_value = [True]
+        pipe = self.sharded_redis.pipeline().set('key1', 1)
+        # read after queuing, before the write is sent
+        self.sharded_redis.get('key1')
+        self.assertEqual(len(self.cache), 1)
+        pipe.execute()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_read_racing_write_is_dropped(self):
+        def slow_set(key, value):
+            # a read overlapping the write gets the old value
+            self.assertEqual(self.sharded_redis.get('key1'), b'value')
+            self.server.get.return_value = value
+            return True
+        self.server.set.side_effect = slow_set
+        self.sharded_redis.set('key1', b'new')
+        self.assertEqual(self.sharded_redis.get('key1'), b'new')
+
+    def test_cached_dict_is_copied(self):
+        self.server.hgetall.return_value = {b'f': b'1'}
+        self.sharded_redis.hgetall('key1')[b'f'] = b'changed'
+        self.sharded_redis.hgetall('key1')[b'g'] = b'added'
+        self.assertEqual(self.sharded_redis.hgetall('key1'), {b'f': b'1'})
+
+    def test_track_invalidations_requires_cache(self):
+        self.sharded_redis.near_cache = None
+        with self.assertRaises(ValueError):
+            self.sharded_redis.track_invalidations()
+
+
+class InvalidationTrackerTests(TestCase):
+    def setUp(self):
+        self.cache = NearCache()
+        self.cache.set('a', 'get', ('a',), 1, self.cache.generation)
+        self.cache.set('b', 'get', ('b',), 2, self.cache.generation)
+        self.tracker = InvalidationTracker(self.cache, {})
+
+    def test_invalidate_message(self):
+        self.tracker.handle_message([b'message', b'__redis__:invalidate', [b'a']])
+        self.assertEqual(self.cache.get('a', 'get', ('a',)), (None, False))
+        self.assertEqual(self.cache.get('b', 'get', ('b',)), (2, True))
+
+    def test_flush_message(self):
+        self.tracker.handle_message([b'message', b'__redis__:invalidate', None])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_subscribe_reply_is_ignored(self):
+        self.tracker.handle_message([b'subscribe', b'__redis__:invalidate', 1])
+        self.assertEqual(len(self.cache), 2)
+
+    def test_tracking_commands(self):
+        server = Mock()
+        pool = server.connection_pool
+        pool.connection_kwargs = {}
+        subscriber, tracker = Mock(), Mock()
+        pool.connection_class.side_effect = [subscriber, tracker]
+        subscriber.read_response.side_effect = [
+            42, [b'subscribe', b'__redis__:invalidate', 1],
+            [b'message', b'__redis__:invalidate', [b'a']]]
+        subscriber.can_read.side_effect = [True, ConnectionError('closed')]
+        tracker_obj = InvalidationTracker(self.cache, {'r1': server}, prefixes=['user:'])
+        tracker_obj._stop.wait = lambda timeout: tracker_obj._stop.set()
+        tracker_obj._run('r1', server)
+        self.assertEqual(subscriber.send_command.mock_calls, [
+            call('CLIENT', 'ID'), call('SUBSCRIBE', '__redis__:invalidate')])
+        self.assertEqual(tracker.send_command.mock_calls, [
+            call('CLIENT', 'TRACKING', 'ON', 'REDIRECT', 42, 'BCAST', 'PREFIX', 'user:')])
+        # the connection broke, so the whole cache was dropped
+        self.assertEqual(len(self.cache), 0)
+        self.assertTrue(subscriber.disconnect.called)
+        self.assertTrue(tracker.disconnect.called)
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+import six
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock
+
+
+class ShardedPipelineTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'password': '', 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'password': '', 'db': 0},
+            {'name': 'r3', 'host': 'localhost', 'port': 3, 'password': '', 'db': 0},
+            {'name': 'r4', 'host': 'localhost', 'port': 4, 'password': '', 'db': 0},
+        ]
+        self.sharded_redis = ShardedRedis(servers)
+        self.mock_servers = {}
+        for name in ['r1', 'r2', 'r3', 'r4']:
+            mock_server = Mock(spec=Redis)
+            mock_pipe = mock_server.pipeline.return_value
+            # echo the queued keys back so the result order can be checked
+            mock_pipe.execute.side_effect = (
+                lambda raise_on_error, pipe=mock_pipe:
+                    [c[1][0] for c in pipe.mock_calls if c[0] == 'set'])
+            self.mock_servers[name] = mock_server
+        self.sharded_redis.connections = self.mock_servers
+
+    def test_results_in_call_order(self):
+        keys = ['key%s' % i for i in range(20)]
+        pipe = self.sharded_redis.pipeline()
+        for key in keys:
+            pipe.set(key, 1)
+        self.assertEqual(len(pipe), 20)
+        self.assertEqual(pipe.execute(), keys)
+        self.assertEqual(len(pipe), 0)
+
+    def test_one_pipeline_per_server(self):
+        keys = ['key%s' % i for i in range(20)]
+        pipe = self.sharded_redis.pipeline()
+        for key in keys:
+            pipe.set(key, 1)
+        pipe.execute()
+        for name, mock_server in self.mock_servers.items():
+            expected = [call.set(k, 1) for k in keys
+                        if self.sharded_redis.get_server_name(k) == name]
+            mock_pipe = mock_server.pipeline.return_value
+            mock_server.pipeline.assert_called_once_with(transaction=False)
+            self.assertEqual(mock_pipe.mock_calls,
+                             expected + [call.execute(raise_on_error=False)])
+
+    def test_tag_and_in_methods(self):
+        pipe = self.sharded_redis.pipeline()
+        pipe.tag_mget(['a{foo}', 'b{foo}'])
+        pipe.hset_in('myhash', 'field', 'value')
+        pipe.blpop_in()
+        self.assertEqual(pipe.command_stack, [
+            (self.sharded_redis.get_server_name('foo'), 'mget', (['a{foo}', 'b{foo}'],), {}),
+            (self.sharded_redis.get_server_name('field'), 'hset',
+                ('myhash', 'field', 'value'), {}),
+            (self.sharded_redis.get_server_name('queue'), 'blpop', (), {}),
+        ])
+
+    def test_empty_pipeline(self):
+        self.assertEqual(self.sharded_redis.pipeline().execute(), [])
+        for mock_server in self.mock_servers.values():
+            self.assertFalse(mock_server.pipeline.called)
+
+    def test_raise_on_error(self):
+        error = ResponseError('WRONGTYPE')
+        for mock_server in self.mock_servers.values():
+            mock_server.pipeline.return_value.execute.side_effect = None
+            mock_server.pipeline.return_value.execute.return_value = [error]
+        pipe = self.sharded_redis.pipeline()
+        pipe.get('key1')
+        with self.assertRaises(ResponseError):
+            pipe.execute()
+        pipe.get('key1')
+        self.assertEqual(pipe.execute(raise_on_error=False), [error])
+
+    def test_unsupported_method(self):
+        pipe = self.sharded_redis.pipeline()
+        expected_rx = r'method \'unsupported_method\' cannot be sharded'
+        with six.assertRaisesRegex(self, NotImplementedError, expected_rx):
+            pipe.unsupported_method('key')
+
+    def test_wrapped_get_without_key(self):
+        pipe = self.sharded_redis.pipeline()
+        expected_rx = r'method \'get\' requires a key param as the first argument'
+        with six.assertRaisesRegex(self, ValueError, expected_rx):
+            pipe.get()
+        self.assertEqual(len(pipe), 0)
+
+    def test_multi_key_command_on_one_server(self):
+        pipe = self.sharded_redis.pipeline()
+        pipe.delete('a{foo}', 'b{foo}')
+        self.assertEqual(pipe.command_stack, [
+            (self.sharded_redis.get_server_name('foo'), 'delete', ('a{foo}', 'b{foo}'), {}),
+        ])
+
+    def test_writes_move_every_key_first(self):
+        self.sharded_redis.previous = Mock(spec=ShardedRedis)
+        self.sharded_redis._migrate_keys = Mock()
+        pipe = self.sharded_redis.pipeline()
+        pipe.delete('a{foo}', 'b{foo}')
+        pipe.tag_rpoplpush('c{bar}', 'd{bar}')
+        pipe.get('key1')
+        pipe.execute()
+        self.sharded_redis._migrate_keys.assert_called_once_with(
+            ['a{foo}', 'b{foo}', 'c{bar}', 'd{bar}'])
+
+    def test_multi_key_command_on_several_servers(self):
+        pipe = self.sharded_redis.pipeline()
+        keys = ['key%s' % i for i in range(20)]
+        expected_rx = r"method 'delete' in a pipeline requires keys on the same server"
+        with six.assertRaisesRegex(self, ValueError, expected_rx):
+            pipe.delete(*keys)
+        self.assertEqual(len(pipe), 0)
@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+
+import socket
+from unittest import TestCase
+
+from redis.connection import Connection
+
+from redis_shard.shard import ShardedRedis
+from .mock import patch
+
+
+def _bulk(value):
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _message(*parts):
+    return b'*%d\r\n' % len(parts) + b''.join(_bulk(part) for part in parts)
+
+
+class ShardedPubSubTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+            {'name': 'r3', 'host': 'localhost', 'port': 3, 'db': 0},
+        ]
+        self.sharded_redis = ShardedRedis(servers)
+        # the server end of every connection made, by server name
+        self.peers = {}
+        ports = dict((s['port'], s['name']) for s in servers)
+
+        def connect(connection):
+            client, server = socket.socketpair()
+            self.peers.setdefault(ports[connection.port], []).append(server)
+            return client
+        patcher = patch.object(Connection, '_connect', autospec=True, side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pubsub = self.sharded_redis.pubsub(reconnect_interval=0.05)
+        self.addCleanup(self.pubsub.close)
+        self.addCleanup(self._close_peers)
+
+    def _close_peers(self):
+        for peers in self.peers.values():
+            for peer in peers:
+                peer.close()
+
+    def _channel_on(self, name):
+        for n in range(1000):
+            channel = 'channel%d' % n
+            if self.sharded_redis.get_server_name(channel) == name:
+                return channel
+
+    def _received(self, name):
+        peer = self.peers[name][-1]
+        peer.settimeout(1)
+        return peer.recv(65536)
+
+    def test_subscribe_on_owning_server(self):
+        c1, c2 = self._channel_on('r1'), self._channel_on('r2')
+        self.pubsub.subscribe(c1, c2)
+        self.assertEqual(sorted(self.pubsub.pubsubs), ['r1', 'r2'])
+        received = self._received('r1')
+        self.assertIn(b'SUBSCRIBE', received)
+        self.assertIn(c1.encode(), received)
+        received = self._received('r2')
+        self.assertIn(c2.encode(), received)
+        self.assertNotIn(c1.encode(), received)
+
+    def test_psubscribe_on_every_server(self):
+        self.pubsub.psubscribe('user:*')
+        self.assertEqual(sorted(self.pubsub.pubsubs), ['r1', 'r2', 'r3'])
+        for name in ('r1', 'r2', 'r3'):
+            self.assertIn(b'user:*', self._received(name))
+
+    def test_get_messages_from_all_servers(self):
+        c1, c3 = self._channel_on('r1'), self._channel_on('r3')
+        self.pubsub = self.sharded_redis.pubsub(ignore_subscribe_messages=True)
+        self.addCleanup(self.pubsub.close)
+        self.pubsub.subscribe(c1, c3)
+        self.peers['r1'][-1].sendall(
+            _message(b'subscribe', c1.encode(), b'1') + _message(b'message', c1.encode(), b'a'))
+        self.peers['r3'][-1].sendall(
+            _message(b'message', c3.encode(), b'b') + _message(b'message', c3.encode(), b'c'))
+        messages = []
+        while len(messages) < 3:
+            batch = self.pubsub.get_messages(timeout=1)
+            self.assertTrue(batch)
+            messages.extend(batch)
+        self.assertEqual(sorted(m['data'] for m in messages), [b'a', b'b', b'c'])
+        self.assertIsNone(self.pubsub.get_message())
+
+    def test_get_messages_batch_limit(self):
+        c1 = self._channel_on('r1')
+        self.pubsub.subscribe(c1)
+        self.peers['r1'][-1].sendall(b''.join(
+            _message(b'message', c1.encode(), str(i).encode()) for i in range(5)))
+        first = self.pubsub.get_messages(max_messages=3, timeout=1)
+        self.assertEqual([m['data'] for m in first], [b'0', b'1', b'2'])
+        rest = self.pubsub.get_messages(max_messages=3, timeout=1)
+        self.assertEqual([m['data'] for m in rest], [b'3', b'4'])
+
+    def test_handler(self):
+        c2 = self._channel_on('r2')
+        received = []
+        self.pubsub.subscribe(**{c2: received.append})
+        self.peers['r2'][-1].sendall(_message(b'message', c2.encode(), b'x'))
+        self.assertEqual(self.pubsub.get_messages(timeout=0.2), [])
+        self.assertEqual([m['data'] for m in received], [b'x'])
+
+    def test_resubscribe_on_reconnect(self):
+        c1 = self._channel_on('r1')
+        self.pubsub.subscribe(c1)
+        self.pubsub.psubscribe('user:*')
+        self._received('r1')
+        self.peers['r1'][-1].close()
+        self.assertEqual(self.pubsub.get_messages(timeout=0.01), [])
+        self.assertEqual(len(self.peers['r1']), 2)
+        resubscribed = self._received('r1')
+        self.assertIn(c1.encode(), resubscribed)
+        self.assertIn(b'user:*', resubscribed)
+        self.peers['r1'][-1].sendall(_message(b'message', c1.encode(), b'again'))
+        message = self.pubsub.get_message(timeout=1)
+        self.assertEqual(message['data'], b'again')
+
+    def test_unsubscribe(self):
+        c1, c2 = self._channel_on('r1'), self._channel_on('r2')
+        self.pubsub.subscribe(c1, c2)
+        self.assertTrue(self.pubsub.subscribed)
+        self._received('r1')
+        self.pubsub.unsubscribe(c1)
+        self.assertIn(b'UNSUBSCRIBE', self._received('r1'))
+        self.pubsub.unsubscribe()
+        # channels are dropped once the servers confirm
+        self.peers['r1'][-1].sendall(_message(b'unsubscribe', c1.encode(), b'0'))
+        self.peers['r2'][-1].sendall(_message(b'unsubscribe', c2.encode(), b'0'))
+        messages = []
+        while len(messages) < 2:
+            batch = self.pubsub.get_messages(timeout=1)
+            self.assertTrue(batch)
+            messages.extend(batch)
+        self.assertEqual([m['type'] for m in messages], ['unsubscribe'] * 2)
+        self.assertFalse(self.pubsub.subscribed)
+        self.assertEqual(list(self.pubsub.listen()), [])
+
+    def test_not_subscribed(self):
+        self.assertRaises(RuntimeError, self.pubsub.get_message)
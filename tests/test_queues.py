@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+import six
+from redis import Redis
+
+from redis_shard.queues import ShardedQueue
+from redis_shard.shard import ShardedRedis
+from .mock import Mock
+
+
+def _mock_server(lists):
+    server = Mock(spec=Redis)
+    server.rpush.side_effect = lambda key, *values: len(
+        lists.setdefault(key, []).extend(values) or lists[key])
+
+    def lpop(key, count=None):
+        items = lists.get(key, [])
+        popped, lists[key] = items[:count], items[count:]
+        return popped or None
+    server.lpop.side_effect = lpop
+    server.llen.side_effect = lambda key: len(lists.get(key, []))
+    server.delete.return_value = 1
+    pipe = server.pipeline.return_value
+    pipe.execute.side_effect = lambda raise_on_error: [
+        server.rpush(*c[1]) for c in pipe.mock_calls if c[0] == 'rpush']
+    return server
+
+
+class ShardedQueueTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+            {'name': 'r3', 'host': 'localhost', 'port': 3, 'db': 0},
+        ]
+        self.sharded_redis = ShardedRedis(servers)
+        self.lists = {}
+        self.mock_servers = dict(
+            (name, _mock_server(self.lists)) for name in ['r1', 'r2', 'r3'])
+        self.sharded_redis.connections = self.mock_servers
+        self.queue = ShardedQueue(self.sharded_redis, 'jobs')
+
+    def test_a_list_per_server(self):
+        self.assertEqual(sorted(self.queue.keys), ['r1', 'r2', 'r3'])
+        for name, key in self.queue.keys.items():
+            self.assertTrue(key.startswith('{jobs:'))
+            self.assertEqual(self.sharded_redis.get_server_name(key), name)
+
+    def test_no_list_for_a_server(self):
+        with six.assertRaisesRegex(self, ValueError, "no list of queue 'jobs' maps to servers"):
+            ShardedQueue(self.sharded_redis, 'jobs', max_probes=1)
+
+    def test_put_round_robin(self):
+        for i in range(6):
+            self.queue.put('job%d' % i)
+        self.assertEqual(self.queue.depths(), {'r1': 2, 'r2': 2, 'r3': 2})
+        self.assertEqual(len(self.queue), 6)
+
+    def test_put_by_key(self):
+        for i in range(3):
+            self.queue.put('job%d' % i, key='user:1')
+        name = self.sharded_redis.get_server_name('user:1')
+        self.assertEqual(self.lists[self.queue.keys[name]], ['job0', 'job1', 'job2'])
+
+    def test_put_many(self):
+        self.queue.put_many(['job%d' % i for i in range(7)])
+        self.assertEqual(self.queue.depths(), {'r1': 3, 'r2': 2, 'r3': 2})
+        for name, mock_server in self.mock_servers.items():
+            pipe = mock_server.pipeline.return_value
+            self.assertEqual(len([c for c in pipe.mock_calls if c[0] == 'rpush']), 1)
+
+    def test_get_batches(self):
+        self.queue.put_many([])
+        for i in range(9):
+            self.queue.put('job%d' % i)
+        items = self.queue.get(count=4)
+        self.assertEqual(len(items), 4)
+        items += self.queue.get(count=10)
+        self.assertEqual(sorted(items), ['job%d' % i for i in range(9)])
+        self.assertEqual(self.queue.get(count=10), [])
+
+    def test_get_is_fair(self):
+        for i in range(30):
+            self.queue.put('job%d' % i)
+        self.queue.get(count=1)
+        self.queue.get(count=1)
+        self.queue.get(count=1)
+        self.assertEqual(self.queue.depths(), {'r1': 9, 'r2': 9, 'r3': 9})
+
+    def test_get_blocks_when_empty(self):
+        self.sharded_redis.blpop = Mock(return_value=(b'{jobs:0}', b'job'))
+        self.assertEqual(self.queue.get(timeout=2), [b'job'])
+        keys, timeout = self.sharded_redis.blpop.call_args[0]
+        self.assertEqual(sorted(keys), sorted(self.queue.keys.values()))
+        self.assertEqual(timeout, 2)
+        self.sharded_redis.blpop.return_value = None
+        self.assertEqual(self.queue.get(timeout=1), [])
+
+    def test_clear(self):
+        self.queue.clear()
+        deleted = [k for s in self.mock_servers.values() for c in s.delete.mock_calls for k in c[1]]
+        self.assertEqual(sorted(deleted), sorted(self.queue.keys.values()))
@@ -0,0 +1,161 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+import six
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from redis_shard.replicas import LatencySelector, ReplicaSet, RoundRobinSelector
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock
+
+
+class SelectorTests(TestCase):
+    def test_round_robin(self):
+        selector = RoundRobinSelector(3)
+        self.assertEqual([selector.select() for _ in range(7)], [0, 1, 2, 0, 1, 2, 0])
+
+    def test_latency_tries_unmeasured_replicas_first(self):
+        selector = LatencySelector(2)
+        self.assertEqual(selector.select(), 0)
+        selector.record(0, 0.01)
+        self.assertEqual(selector.select(), 1)
+
+    def test_latency_picks_fastest(self):
+        selector = LatencySelector(3, probe_every=0)
+        for index, latency in enumerate([0.005, 0.001, 0.002]):
+            selector.record(index, latency)
+        self.assertEqual(selector.select(), 1)
+        # the average follows the latest samples
+        for _ in range(20):
+            selector.record(1, 0.01)
+        self.assertEqual(selector.select(), 2)
+
+    def test_latency_probes(self):
+        selector = LatencySelector(2, probe_every=10)
+        selector.record(0, 0.001)
+        selector.record(1, 0.5)
+        picks = [selector.select() for _ in range(20)]
+        self.assertEqual(picks.count(1), 1)
+        self.assertEqual(picks[9], 0)
+        self.assertEqual(picks[19], 1)
+
+    def test_unknown_selector(self):
+        with six.assertRaisesRegex(self, ValueError, "unknown replica selector 'fastest'"):
+            ReplicaSet('r1', [('r1:replica0', Mock())], selector='fastest')
+
+
+class ShardedReplicaTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0,
+             'replicas': [{'host': 'localhost', 'port': 11},
+                          {'host': 'localhost', 'port': 12, 'name': 'r1b'}]},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ]
+        self.sharded_redis = ShardedRedis(servers)
+        self.primaries = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2'])
+        self.sharded_redis.connections = self.primaries
+        self.replica_set = self.sharded_redis.replicas['r1']
+        self.replicas = self.replica_set.connections = [Mock(spec=Redis), Mock(spec=Redis)]
+        self.key = next(k for k in ('key%d' % i for i in range(100))
+                        if self.sharded_redis.get_server_name(k) == 'r1')
+
+    def test_replica_config(self):
+        self.assertEqual(list(self.sharded_redis.replicas), ['r1'])
+        self.assertEqual(self.replica_set.names, ['r1:replica0', 'r1b'])
+        sharded_redis = ShardedRedis([
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 3,
+             'replicas': [{'host': 'localhost', 'port': 11}]}])
+        replica = sharded_redis.replicas['r1'].connections[0]
+        self.assertEqual(replica.connection_pool.connection_kwargs['port'], 11)
+        self.assertEqual(replica.connection_pool.connection_kwargs['db'], 3)
+
+    def test_replicas_do_not_change_routing(self):
+        sharded_redis = ShardedRedis([
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0}])
+        for i in range(100):
+            key = 'key%d' % i
+            self.assertEqual(sharded_redis.get_server_name(key),
+                             self.sharded_redis.get_server_name(key))
+
+    def test_reads_go_to_replicas(self):
+        self.replicas[0].get.return_value = b'a'
+        self.replicas[1].get.return_value = b'b'
+        self.assertEqual([self.sharded_redis.get(self.key) for _ in range(3)], [b'a', b'b', b'a'])
+        self.assertFalse(self.primaries['r1'].get.called)
+
+    def test_writes_go_to_primary(self):
+        self.sharded_redis.set(self.key, 1)
+        self.primaries['r1'].set.assert_called_once_with(self.key, 1)
+        for replica in self.replicas:
+            self.assertFalse(replica.set.called)
+
+    def test_server_without_replicas(self):
+        key = next(k for k in ('key%d' % i for i in range(100))
+                   if self.sharded_redis.get_server_name(k) == 'r2')
+        self.sharded_redis.get(key)
+        self.primaries['r2'].get.assert_called_once_with(key)
+
+    def test_primary_only(self):
+        with self.sharded_redis.primary_only():
+            self.assertTrue(self.sharded_redis.reading_from_primary)
+            with self.sharded_redis.primary_only():
+                self.sharded_redis.get(self.key)
+            self.sharded_redis.hgetall(self.key)
+        self.assertFalse(self.sharded_redis.reading_from_primary)
+        self.assertEqual(self.primaries['r1'].mock_calls,
+                         [call.get(self.key), call.hgetall(self.key)])
+        self.assertFalse(self.replicas[0].get.called)
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        self.replicas[0].get.side_effect = ConnectionError()
+        self.primaries['r1'].get.return_value = b'value'
+        self.assertEqual(self.sharded_redis.get(self.key), b'value')
+
+    def test_mget(self):
+        self.replicas[0].mget.return_value = [b'a']
+        self.primaries['r2'].mget.return_value = [None]
+        self.assertEqual(self.sharded_redis.mget([self.key]), [b'a'])
+        with self.sharded_redis.primary_only():
+            self.primaries['r1'].mget.return_value = [b'b']
+            self.assertEqual(self.sharded_redis.mget([self.key]), [b'b'])
+
+    def test_exists(self):
+        self.replicas[0].exists.return_value = 1
+        self.assertEqual(self.sharded_redis.exists(self.key), 1)
+        self.assertFalse(self.primaries['r1'].exists.called)
+        with self.sharded_redis.primary_only():
+            self.primaries['r1'].exists.return_value = 0
+            self.assertEqual(self.sharded_redis.exists(self.key), 0)
+        self.replicas[0].exists.assert_called_once_with(self.key)
+
+    def test_read_pipeline_goes_to_replica(self):
+        replica_pipe = self.replicas[0].pipeline.return_value
+        replica_pipe.execute.return_value = [b'a']
+        pipe = self.sharded_redis.pipeline()
+        pipe.get(self.key)
+        self.assertEqual(pipe.execute(), [b'a'])
+        self.assertFalse(self.primaries['r1'].pipeline.called)
+
+    def test_pipelines_with_writes_go_to_primary(self):
+        primary_pipe = self.primaries['r1'].pipeline.return_value
+        primary_pipe.execute.return_value = [True, b'1']
+        pipe = self.sharded_redis.pipeline()
+        pipe.set(self.key, 1).get(self.key)
+        self.assertEqual(pipe.execute(), [True, b'1'])
+        self.assertFalse(self.replicas[0].pipeline.called)
+
+    def test_primary_only_pipelines(self):
+        primary_pipe = self.primaries['r1'].pipeline.return_value
+        primary_pipe.execute.return_value = [b'1']
+        pipe = self.sharded_redis.pipeline(primary_only=True)
+        self.assertEqual(pipe.get(self.key).execute(), [b'1'])
+        with self.sharded_redis.primary_only():
+            self.assertEqual(self.sharded_redis.pipeline().get(self.key).execute(), [b'1'])
+        self.assertEqual(self.sharded_redis.pipeline(transaction=True).get(self.key).execute(),
+                         [b'1'])
+        self.assertEqual(self.primaries['r1'].pipeline.call_count, 3)
+        self.assertFalse(self.replicas[0].pipeline.called)
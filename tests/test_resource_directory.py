@@ -3,7 +3,8 @@ from __future__ import absolute_import
 import hashlib
 
 from unittest import TestCase
-from redis_shard.resource_directory import ResourceDirectory
+from redis_shard.resource_directory import (
+    ResourceDirectory, SlotResourceDirectory, crc16, directory_from_servers)
 
 
 class ServerDirectoryTests(TestCase):
@@ -21,6 +22,12 @@ class ServerDirectoryTests(TestCase):
             self.names[expected],
             self.resource_dir.get_name(key))
 
+    def test_bytes_and_unicode_keys_agree(self):
+        for x in range(10):
+            key = u'key%s' % x
+            self.assertEqual(self.resource_dir.get_name(key),
+                             self.resource_dir.get_name(key.encode('utf-8')))
+
     def test_with_one_resource(self):
         """All keys should point to sole resource."""
         names = ['r1']
@@ -29,3 +36,51 @@ class ServerDirectoryTests(TestCase):
         for x in range(10):
             key = 'key%s' % x
             self.assertEqual('r1', resource_dir.get_name(key))
+
+
+class SlotResourceDirectoryTests(TestCase):
+    def setUp(self):
+        self.names = ['r1', 'r2', 'r3', 'r4']
+
+    def test_crc16(self):
+        self.assertEqual(crc16(b'123456789'), 0x31C3)
+
+    def test_crc16_matches_redis_cluster_slots(self):
+        resource_dir = SlotResourceDirectory(self.names, hash_mode='crc16')
+        self.assertEqual(resource_dir.get_slot('foo'), 12182)
+        self.assertEqual(resource_dir.get_slot('bar'), 5061)
+        self.assertEqual(resource_dir.get_slot(u'foo'), resource_dir.get_slot(b'foo'))
+
+    def test_unweighted_matches_modulo_layout(self):
+        modulo_dir = ResourceDirectory(self.names)
+        slot_dir = SlotResourceDirectory(self.names)
+        for x in range(200):
+            key = 'key%s' % x
+            self.assertEqual(modulo_dir.get_name(key), slot_dir.get_name(key))
+
+    def test_weighted_slots(self):
+        resource_dir = SlotResourceDirectory(['r1', 'r2', 'r3'], weights=[1, 2, 1], num_slots=16)
+        self.assertEqual(resource_dir.slots.count('r1'), 4)
+        self.assertEqual(resource_dir.slots.count('r2'), 8)
+        self.assertEqual(resource_dir.slots.count('r3'), 4)
+        # slots of one resource are spread out rather than contiguous
+        self.assertEqual(resource_dir.slots[:4], ['r2', 'r1', 'r3', 'r2'])
+
+    def test_invalid_config(self):
+        with self.assertRaises(ValueError):
+            SlotResourceDirectory(self.names, hash_mode='md5')
+        with self.assertRaises(ValueError):
+            SlotResourceDirectory(self.names, weights=[1, 1])
+        with self.assertRaises(ValueError):
+            SlotResourceDirectory(self.names, weights=[1, 1, 0, 1])
+        with self.assertRaises(ValueError):
+            SlotResourceDirectory(self.names, num_slots=2)
+
+    def test_directory_from_servers(self):
+        servers = [{'name': 'r1'}, {'name': 'r2', 'weight': 3}]
+        resource_dir = directory_from_servers(servers, SlotResourceDirectory, num_slots=8)
+        self.assertEqual(resource_dir.weights, [1, 3])
+        self.assertEqual(resource_dir.slots.count('r2'), 6)
+        with self.assertRaises(ValueError):
+            directory_from_servers(servers)
+        self.assertIsInstance(directory_from_servers(servers[:1]), ResourceDirectory)
@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+
+import hashlib
+from unittest import TestCase
+
+import six
+from redis import Redis
+from redis.exceptions import NoScriptError
+
+from redis_shard.near_cache import NearCache
+from redis_shard.shard import ShardedRedis
+from .mock import call, Mock
+
+LUA = "return redis.call('incrby', KEYS[1], ARGV[1])"
+SHA = hashlib.sha1(LUA.encode('utf-8')).hexdigest()
+
+
+class ShardedScriptTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+            {'name': 'r3', 'host': 'localhost', 'port': 3, 'db': 0},
+        ]
+        self.sharded_redis = ShardedRedis(servers)
+        self.mock_servers = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2', 'r3'])
+        self.sharded_redis.connections = self.mock_servers
+        self.script = self.sharded_redis.register_script(LUA)
+        self.name = self.sharded_redis.get_server_name('user')
+        self.server = self.mock_servers[self.name]
+
+    def test_register(self):
+        self.assertEqual(self.script.sha, SHA)
+        self.assertIs(self.sharded_redis.register_script(LUA), self.script)
+        self.assertEqual(list(self.sharded_redis.scripts), [SHA])
+
+    def test_evalsha_on_tag_server(self):
+        self.server.evalsha.return_value = 3
+        self.assertEqual(self.script(keys=['a{user}', 'b{user}'], args=[1]), 3)
+        self.server.evalsha.assert_called_once_with(SHA, 2, 'a{user}', 'b{user}', 1)
+        self.assertEqual(self.script.loaded, set([self.name]))
+
+    def test_noscript_loads_on_that_server_only(self):
+        self.server.evalsha.side_effect = [NoScriptError('NOSCRIPT'), 3]
+        self.assertEqual(self.script(keys=['{user}'], args=[1]), 3)
+        self.server.script_load.assert_called_once_with(LUA)
+        self.assertEqual(len(self.server.evalsha.mock_calls), 2)
+        for name, server in self.mock_servers.items():
+            if name != self.name:
+                self.assertFalse(server.script_load.called)
+
+    def test_keys_on_several_servers(self):
+        keys = ['key%d' % i for i in range(10)]
+        with six.assertRaisesRegex(self, ValueError, "must be on the same server"):
+            self.script(keys=keys)
+        with six.assertRaisesRegex(self, ValueError, "requires at least one key"):
+            self.script(args=[1])
+
+    def test_invalidates_near_cache(self):
+        self.sharded_redis.near_cache = cache = NearCache()
+        cache.set('{user}', 'get', ('{user}',), b'1', cache.generation)
+        self.script(keys=['{user}'], args=[1])
+        self.assertEqual(len(cache), 0)
+
+    def test_pipeline(self):
+        self.server.pipeline.return_value.execute.return_value = [3, 5]
+        self.server.script_exists.return_value = [False]
+        pipe = self.sharded_redis.pipeline()
+        self.script(keys=['{user}'], args=[1], client=pipe)
+        self.script(keys=['{user}'], args=[2], client=pipe)
+        self.assertFalse(self.server.script_load.called)
+        self.assertEqual(pipe.execute(), [3, 5])
+        self.server.script_exists.assert_called_once_with(SHA)
+        self.server.script_load.assert_called_once_with(LUA)
+        self.assertEqual(self.server.pipeline.return_value.mock_calls[:2], [
+            call.evalsha(SHA, 1, '{user}', 1), call.evalsha(SHA, 1, '{user}', 2)])
+        self.assertEqual(self.script.loaded, set([self.name]))
+
+    def test_pipeline_after_script_flush(self):
+        self.script.loaded.add(self.name)
+        # the server restarted: the script is gone although it was loaded
+        self.server.script_exists.return_value = [False]
+        self.server.pipeline.return_value.execute.return_value = [3]
+        pipe = self.sharded_redis.pipeline()
+        self.script(keys=['{user}'], args=[1], client=pipe)
+        self.assertEqual(pipe.execute(), [3])
+        self.server.script_load.assert_called_once_with(LUA)
+
+    def test_pipeline_script_loaded(self):
+        self.server.script_exists.return_value = [True]
+        self.server.pipeline.return_value.execute.return_value = [3]
+        pipe = self.sharded_redis.pipeline()
+        self.script(keys=['{user}'], args=[1], client=pipe)
+        self.assertEqual(pipe.execute(), [3])
+        self.assertFalse(self.server.script_load.called)
+        self.assertEqual(self.script.loaded, set([self.name]))
+
+    def test_pipeline_noscript_reply_forgets_server(self):
+        self.server.script_exists.return_value = [True]
+        self.server.pipeline.return_value.execute.return_value = [NoScriptError('NOSCRIPT')]
+        pipe = self.sharded_redis.pipeline()
+        self.script(keys=['{user}'], args=[1], client=pipe)
+        self.assertRaises(NoScriptError, pipe.execute)
+        self.assertEqual(self.script.loaded, set())
+
+    def test_preload_scripts(self):
+        other = self.sharded_redis.register_script("return 1")
+        self.sharded_redis.preload_scripts()
+        for server in self.mock_servers.values():
+            self.assertEqual(server.pipeline.return_value.mock_calls, [
+                call.script_load(LUA), call.script_load("return 1"), call.execute()])
+        self.assertEqual(self.script.loaded, set(['r1', 'r2', 'r3']))
+        self.assertEqual(other.loaded, set(['r1', 'r2', 'r3']))
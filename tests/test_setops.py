@@ -0,0 +1,207 @@
+from __future__ import absolute_import
+
+import functools
+from unittest import TestCase
+
+import six
+from redis import Redis
+
+from redis_shard.setops import SetOperations
+from redis_shard.shard import ShardedRedis
+from .mock import Mock
+
+
+class FakeSetServer(object):
+    """Just enough of a redis server for the set operations, with sets and
+    sorted sets kept in ``data``.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def _scan(self, items, cursor, count):
+        end = cursor + count
+        return (end if end < len(items) else 0), items[cursor:end]
+
+    def sscan(self, key, cursor=0, count=None):
+        return self._scan(sorted(self.data.get(key, ())), cursor, count)
+
+    def zscan(self, key, cursor=0, count=None):
+        return self._scan(sorted(self.data.get(key, {}).items()), cursor, count)
+
+    def scard(self, key):
+        return len(self.data.get(key, ()))
+
+    zcard = scard
+
+    def smismember(self, key, members):
+        return [int(m in self.data.get(key, ())) for m in members]
+
+    def zmscore(self, key, members):
+        return [self.data.get(key, {}).get(m) for m in members]
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(members)
+
+    def zadd(self, key, mapping, gt=False, lt=False):
+        zset = self.data.setdefault(key, {})
+        for member, score in mapping.items():
+            old = zset.get(member)
+            if old is None or (not gt and not lt) or (gt and score > old) or (lt and score < old):
+                zset[member] = score
+
+    def zunionstore(self, dest, keys, aggregate=None):
+        combine = {None: sum, 'SUM': sum, 'MIN': min, 'MAX': max}[aggregate]
+        members = set(m for key in keys for m in self.data.get(key, {}))
+        self.data[dest] = dict(
+            (m, combine([self.data[key][m] for key in keys if m in self.data.get(key, {})]))
+            for m in members)
+        return len(members)
+
+    def rename(self, key, new_key):
+        self.data[new_key] = self.data.pop(key)
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def pipeline(self, transaction=True):
+        server = self
+
+        class Pipeline(object):
+            def __init__(self):
+                self.commands = []
+
+            def __getattr__(self, method):
+                return lambda *args, **kwargs: self.commands.append((method, args, kwargs))
+
+            def execute(self):
+                return [getattr(server, m)(*a, **kw) for m, a, kw in self.commands]
+        return Pipeline()
+
+
+class SetOperationTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r%d' % i, 'host': 'localhost', 'port': i, 'db': 0} for i in range(1, 5)]
+        self.sharded_redis = ShardedRedis(servers)
+        self.data = {}
+        self.sharded_redis.connections = dict(
+            (name, FakeSetServer(self.data)) for name in self.sharded_redis.server_names)
+        # keys spread over different servers
+        self.keys = []
+        names = set()
+        for i in range(100):
+            key = 'set%d' % i
+            name = self.sharded_redis.get_server_name(key)
+            if name not in names:
+                names.add(name)
+                self.keys.append(key)
+        a, b, c = self.keys[:3]
+        self.data.update({
+            a: set('abcdefgh'),
+            b: set('bdfhjl'),
+            c: set('dhlp'),
+        })
+        self.operations = SetOperations(self.sharded_redis, chunk_size=3)
+
+    def test_sinter(self):
+        a, b, c = self.keys[:3]
+        self.assertEqual(self.operations.sinter([a, b, c]), set('dh'))
+        self.assertEqual(self.sharded_redis.sinter(a, b), set('bdfh'))
+        self.assertEqual(self.sharded_redis.sinter([a, 'missing']), set())
+
+    def test_sunion(self):
+        a, b, c = self.keys[:3]
+        self.assertEqual(self.operations.sunion([a, b, c]), set('abcdefghjlp'))
+        self.assertEqual(self.sharded_redis.sunion([b, c]), set('bdfhjlp'))
+
+    def test_sdiff(self):
+        a, b, c = self.keys[:3]
+        self.assertEqual(self.operations.sdiff([a, b, c]), set('aceg'))
+        self.assertEqual(self.sharded_redis.sdiff([c, a]), set('lp'))
+
+    def test_store(self):
+        a, b, c = self.keys[:3]
+        self.assertEqual(self.sharded_redis.sinterstore('dest', [a, b]), 4)
+        self.assertEqual(self.data['dest'], set('bdfh'))
+        self.assertEqual(self.sharded_redis.sunionstore('dest', [b, c]), 7)
+        self.assertEqual(self.data['dest'], set('bdfhjlp'))
+        self.assertEqual(self.sharded_redis.sdiffstore(a, [a, b]), 4)
+        self.assertEqual(self.data[a], set('aceg'))
+        self.assertEqual(sorted(k for k in self.data if k.startswith('redis-shard:tmp:')), [])
+
+    def test_empty_store_deletes_destination(self):
+        a, b = self.keys[:2]
+        self.data['dest'] = set('x')
+        self.assertEqual(self.sharded_redis.sinterstore('dest', [a, 'missing']), 0)
+        self.assertNotIn('dest', self.data)
+
+    def test_temp_key_on_destination_server(self):
+        key = self.operations._temp_key('dest')
+        self.assertEqual(self.sharded_redis.get_server_name(key),
+                         self.sharded_redis.get_server_name('dest'))
+
+    def test_zunionstore(self):
+        a, b = self.keys[:2]
+        self.data[a] = {'x': 1.0, 'y': 2.0, 'z': 3.0, 'w': 1.0}
+        self.data[b] = {'y': 5.0, 'z': 1.0}
+        self.assertEqual(self.sharded_redis.zunionstore('dest', [a, b]), 4)
+        self.assertEqual(self.data['dest'], {'x': 1.0, 'y': 7.0, 'z': 4.0, 'w': 1.0})
+        self.sharded_redis.zunionstore('dest', {a: 2, b: 1}, aggregate='max')
+        self.assertEqual(self.data['dest'], {'x': 2.0, 'y': 5.0, 'z': 6.0, 'w': 2.0})
+        self.sharded_redis.zunionstore('dest', [a, b], aggregate='MIN')
+        self.assertEqual(self.data['dest'], {'x': 1.0, 'y': 2.0, 'z': 1.0, 'w': 1.0})
+
+    def test_zunionstore_with_members_scanned_twice(self):
+        a, b = self.keys[:2]
+        self.data[a] = {'x': 1.0, 'y': 2.0, 'z': 3.0, 'w': 1.0}
+        self.data[b] = {'y': 5.0, 'z': 1.0}
+        zscan = FakeSetServer.zscan
+
+        def zscan_twice(server, key, cursor=0, count=None):
+            # as while the sorted set is rehashed, pages repeat the first member
+            next_cursor, members = zscan(server, key, cursor, count)
+            return next_cursor, members + members[:1]
+        for server in self.sharded_redis.connections.values():
+            server.zscan = functools.partial(zscan_twice, server)
+        self.sharded_redis.zunionstore('dest', {a: 1, b: 2})
+        self.assertEqual(self.data['dest'], {'x': 1.0, 'y': 12.0, 'z': 5.0, 'w': 1.0})
+        self.assertEqual(sorted(self.data), sorted([a, b, 'dest'] + self.keys[2:3]))
+
+    def test_zinterstore(self):
+        a, b, c = self.keys[:3]
+        self.data[a] = {'x': 1.0, 'y': 2.0, 'z': 3.0, 'w': 1.0}
+        self.data[b] = {'y': 5.0, 'z': 1.0}
+        self.data[c] = {'y': 1.0, 'z': 1.0, 'v': 1.0}
+        self.assertEqual(self.sharded_redis.zinterstore('dest', {a: 1, b: 2, c: 3}), 2)
+        self.assertEqual(self.data['dest'], {'y': 15.0, 'z': 8.0})
+        self.sharded_redis.zinterstore('dest', [a, b], aggregate='MAX')
+        self.assertEqual(self.data['dest'], {'y': 5.0, 'z': 3.0})
+
+    def test_bad_arguments(self):
+        with six.assertRaisesRegex(self, ValueError, "aggregate must be one of"):
+            self.sharded_redis.zunionstore('dest', self.keys[:2], aggregate='avg')
+        with six.assertRaisesRegex(self, ValueError, "requires at least one key"):
+            self.sharded_redis.zinterstore('dest', [])
+        with six.assertRaisesRegex(self, ValueError, "at least one key"):
+            self.sharded_redis.sinter([])
+
+
+class NativeSetOperationTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r%d' % i, 'host': 'localhost', 'port': i, 'db': 0} for i in range(1, 5)]
+        self.sharded_redis = ShardedRedis(servers)
+        self.mock_servers = dict(
+            (name, Mock(spec=Redis)) for name in self.sharded_redis.server_names)
+        self.sharded_redis.connections = self.mock_servers
+        self.server = self.mock_servers[self.sharded_redis.get_server_name('{tag}')]
+
+    def test_keys_on_one_server(self):
+        self.sharded_redis.sinter('a{tag}', 'b{tag}')
+        self.server.sinter.assert_called_once_with(['a{tag}', 'b{tag}'])
+        self.sharded_redis.sunionstore('c{tag}', ['a{tag}', 'b{tag}'])
+        self.server.sunionstore.assert_called_once_with('c{tag}', ['a{tag}', 'b{tag}'])
+        self.sharded_redis.zunionstore('c{tag}', {'a{tag}': 2}, aggregate='MAX')
+        self.server.zunionstore.assert_called_once_with(
+            'c{tag}', {'a{tag}': 2}, aggregate='MAX')
@@ -1,12 +1,22 @@
 from __future__ import absolute_import
 
-from unittest import TestCase
+import functools
+import gc
+import os
+import threading
+import time
+import weakref
+from unittest import TestCase, skipUnless
 
 import six
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError, ResponseError
 
-from redis_shard.shard import ShardedRedis
-from .mock import call, Mock, patch
+from redis_shard import pools
+from redis_shard.exceptions import BroadcastError
+from redis_shard.resource_directory import SlotResourceDirectory
+from redis_shard.shard import ShardedRedis, hash_tag
+from .mock import call, Mock
 
 
 class ShardedRedisTests(TestCase):
@@ -19,17 +29,89 @@ class ShardedRedisTests(TestCase):
         ]
         self.sharded_redis = ShardedRedis(servers)
 
-    def test_post_redis_2_4_no_connection_pool(self):
-        with patch('redis_shard.shard.redis') as mock_redis:
-            mock_redis.__version__ = '2.4.0'
-            shared_redis = ShardedRedis([])
-        self.assertIsNone(shared_redis.pool)
+    def test_pool_per_server(self):
+        pools = [self.sharded_redis.connections[name].connection_pool
+                 for name in self.sharded_redis.server_names]
+        self.assertEqual(len(set(map(id, pools))), 4)
+        self.assertEqual([pool.connection_kwargs['port'] for pool in pools], [1, 2, 3, 4])
+        self.assertEqual([pool._created_connections for pool in pools], [0] * 4)
 
-    def test_pre_redis_2_4_connection_pool(self):
-        with patch('redis_shard.shard.redis') as mock_redis:
-            mock_redis.__version__ = '2.3.9'
-            shared_redis = ShardedRedis([])
-        self.assertEqual(shared_redis.pool, mock_redis.ConnectionPool.return_value)
+    def test_pool_options(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0, 'max_connections': 8,
+             'blocking_pool': True, 'pool_timeout': 0.5,
+             'replicas': [{'host': 'localhost', 'port': 11, 'socket_timeout': 2.0}]},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0, 'socket_keepalive': False},
+        ]
+        sharded_redis = ShardedRedis(servers, pool_options={
+            'socket_timeout': 1.0, 'socket_keepalive': True, 'health_check_interval': 30})
+        r1 = sharded_redis.connections['r1'].connection_pool
+        self.assertIsInstance(r1, BlockingConnectionPool)
+        self.assertEqual((r1.max_connections, r1.timeout), (8, 0.5))
+        self.assertEqual(r1.connection_kwargs['socket_timeout'], 1.0)
+        self.assertEqual(r1.connection_kwargs['health_check_interval'], 30)
+        r2 = sharded_redis.connections['r2'].connection_pool
+        self.assertNotIsInstance(r2, BlockingConnectionPool)
+        self.assertIs(r2.connection_kwargs['socket_keepalive'], False)
+        replica = sharded_redis.replicas['r1'].connections[0].connection_pool
+        self.assertIsInstance(replica, BlockingConnectionPool)
+        self.assertEqual(replica.max_connections, 8)
+        self.assertEqual(replica.connection_kwargs['socket_timeout'], 2.0)
+
+    def test_pool_options_invalid(self):
+        servers = [{'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0, 'pool_timeout': 1}]
+        with six.assertRaisesRegex(self, ValueError, r"^pool_timeout requires blocking_pool$"):
+            ShardedRedis(servers)
+        with six.assertRaisesRegex(self, ValueError, r"^unknown pool options max_conn$"):
+            ShardedRedis(servers[:0], pool_options={'max_conn': 2})
+
+    def test_after_fork(self):
+        sharded_redis = self.sharded_redis
+        pool = sharded_redis.connections['r1'].connection_pool
+        connection = pool.make_connection()
+        pool._in_use_connections.add(connection)
+        executor = sharded_redis.executor
+        self.addCleanup(executor.shutdown)
+        sharded_redis._after_fork()
+        self.assertEqual(pool._created_connections, 0)
+        self.assertNotIn(connection, pool._in_use_connections)
+        self.assertIsNot(sharded_redis.executor, executor)
+        sharded_redis.close()
+
+    def test_after_fork_keeps_no_client_alive(self):
+        sharded_redis = ShardedRedis([])
+        self.assertIn(sharded_redis, pools._clients)
+        ref = weakref.ref(sharded_redis)
+        del sharded_redis
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_after_fork_despite_failing_client(self):
+        failing = ShardedRedis([{'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0}])
+        failing.connections = {'r1': Mock(spec=Redis)}
+        pool = self.sharded_redis.connections['r1'].connection_pool
+        pool.make_connection()
+        pools._after_fork_in_child()
+        self.assertEqual(pool._created_connections, 0)
+
+    @skipUnless(hasattr(os, 'register_at_fork') and hasattr(os, 'fork'), "requires os.fork")
+    def test_reset_in_forked_child(self):
+        pool = self.sharded_redis.connections['r1'].connection_pool
+        pool.make_connection()
+        executor = self.sharded_redis.executor
+        self.addCleanup(self.sharded_redis.close)
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            reset = pool._created_connections == 0 and self.sharded_redis._executor is None
+            os.write(write_end, b'1' if reset else b'0')
+            os._exit(0)
+        os.close(write_end)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_end, 1), b'1')
+        os.close(read_end)
+        self.assertEqual(pool._created_connections, 1)
+        self.assertIs(self.sharded_redis.executor, executor)
 
     def test_duplicate_server_name(self):
         servers = [
@@ -42,10 +124,59 @@ class ShardedRedisTests(TestCase):
     def test_directory_set_up_correctly(self):
         self.assertEqual(4, self.sharded_redis.directory.num_resources)
 
+    def test_slot_directory(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0, 'weight': 1},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0, 'weight': 3},
+        ]
+        sharded_redis = ShardedRedis(servers, directory_class=SlotResourceDirectory,
+                                     directory_options={'hash_mode': 'crc16'})
+        self.assertEqual(sharded_redis.directory.weights, [1, 3])
+        self.assertEqual(sharded_redis.get_server_name('a{foo}'),
+                         sharded_redis.directory.slots[12182])
+
+    def test_weights_require_slot_directory(self):
+        servers = [{'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0, 'weight': 2}]
+        with six.assertRaisesRegex(self, ValueError, r"server weights require"):
+            ShardedRedis(servers)
+
     def test_key_hashing_respects_braces(self):
         self.assertEqual(self.sharded_redis.get_server_name('asdl{key1}asdlkfj'),
                 self.sharded_redis.get_server_name('key1'))
 
+    def test_hash_tag(self):
+        self.assertEqual(hash_tag('asdl{key1}asdlkfj'), 'key1')
+        self.assertEqual(hash_tag('{key1}'), 'key1')
+        self.assertEqual(hash_tag('key1'), 'key1')
+        self.assertEqual(hash_tag(b'a{key1}b'), b'key1')
+        # the first "{" and the first "}" after it, like Redis Cluster
+        self.assertEqual(hash_tag('a{b}c{d}e'), 'b')
+        self.assertEqual(hash_tag('a{b}}'), 'b')
+        self.assertEqual(hash_tag('a{{b}'), '{b')
+        # no tag: the whole key is hashed
+        self.assertEqual(hash_tag('a{}b{c}'), 'a{}b{c}')
+        self.assertEqual(hash_tag('a}b{c'), 'a}b{c')
+
+    def test_get_server_names(self):
+        keys = ['key%s' % i for i in range(20)] + ['a{key1}', 'b{key1}']
+        groups = self.sharded_redis.get_server_names(keys)
+        self.assertEqual(sorted(k for group in groups.values() for k in group), sorted(keys))
+        for name, group in groups.items():
+            for key in group:
+                self.assertEqual(self.sharded_redis.get_server_name(key), name)
+        self.assertIn('a{key1}', groups[self.sharded_redis.get_server_name('key1')])
+
+    def test_route_cache(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'password': '', 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'password': '', 'db': 0},
+        ]
+        sharded_redis = ShardedRedis(servers, route_cache_size=2)
+        sharded_redis.directory = Mock(wraps=sharded_redis.directory)
+        names = [sharded_redis.get_server_name(key) for key in ['a', 'b', 'a', 'a']]
+        self.assertEqual(names, [sharded_redis.directory.get_name(key) for key in 'abaa'])
+        self.assertEqual(sharded_redis.get_server_name.cache_info().hits, 2)
+
     def test_get_server(self):
         server = self.sharded_redis.get_server('test_key')
         self.assertIsInstance(server, Redis)
@@ -56,8 +187,8 @@ class ShardedRedisTests(TestCase):
         method_names = [
             'get', 'set', 'getset',
             'setnx', 'setex',
-            'incr', 'decr', 'exists',
-            'delete', 'get_type', 'type', 'rename',
+            'incr', 'decr',
+            'get_type', 'type', 'rename',
             'expire', 'ttl', 'push',
             'llen', 'lrange', 'ltrim','lpush','lpop',
             'lindex', 'pop', 'lset',
@@ -193,6 +324,24 @@ class ShardedRedisTests(TestCase):
             ])
             mock_get_server.reset_mock()
 
+    def test_wrapped_methods_are_real_methods(self):
+        for method_name in ['get', 'hset_in', 'blpop_in', 'delete']:
+            method = getattr(ShardedRedis, method_name)
+            self.assertEqual(method.__name__, method_name)
+            self.assertIn(method_name, dir(self.sharded_redis))
+
+    def test_wrapped_tag_method_name(self):
+        mock_get_server = Mock(spec=Redis)
+        mock_server = mock_get_server.return_value
+        self.sharded_redis.get_server = mock_get_server
+        result = self.sharded_redis.tag_get('a{test_key}')
+        self.assertEqual(result, mock_server.get.return_value)
+        self.assertEqual(self.sharded_redis.tag_get.__name__, 'tag_get')
+
+    def test_special_attributes_are_not_commands(self):
+        with self.assertRaises(AttributeError):
+            self.sharded_redis.__deepcopy__
+
     def test_unsupported_method(self):
         mock_get_server = Mock(spec=Redis)
         self.sharded_redis.get_server = mock_get_server
@@ -214,7 +363,7 @@ class ShardedRedisTests(TestCase):
     def test_brpop_nonstring_key(self):
         mock_get_server = Mock(spec=Redis)
         self.sharded_redis.get_server = mock_get_server
-        expected_rx = r'The key must be single string;mutiple keys cannot be sharded'
+        expected_rx = r'The key must be a string or a list of strings'
         with six.assertRaisesRegex(self, NotImplementedError, expected_rx):
             self.sharded_redis.brpop(123)
         self.assertFalse(mock_get_server.called)
@@ -232,11 +381,126 @@ class ShardedRedisTests(TestCase):
     def test_blpop_nonstring_key(self):
         mock_get_server = Mock(spec=Redis)
         self.sharded_redis.get_server = mock_get_server
-        expected_rx = r'The key must be single string;mutiple keys cannot be sharded'
+        expected_rx = r'The key must be a string or a list of strings'
         with six.assertRaisesRegex(self, NotImplementedError, expected_rx):
             self.sharded_redis.blpop(123)
         self.assertFalse(mock_get_server.called)
 
+    def test_blpop_keys_on_one_server(self):
+        mock_get_server = Mock(spec=Redis)
+        self.sharded_redis.get_server = mock_get_server
+        self.sharded_redis.blpop(['a{q}', 'b{q}'], timeout=5)
+        mock_get_server.return_value.blpop.assert_called_once_with(['a{q}', 'b{q}'], 5)
+
+    def _blocking_clients(self):
+        """Mock the dedicated client blocking on each server. Unblocking a
+        client sets ``self.unblocked[name]``, once its pop is blocked.
+        """
+        self.mock_servers = self._mock_connections()
+        self.keys = {}
+        for i in range(100):
+            self.keys.setdefault(self.sharded_redis.get_server_name('q%d' % i), 'q%d' % i)
+        self.blocked = {}
+        self.unblocked = {}
+        self.closed = {}
+        clients = {}
+        for i, (name, mock_server) in enumerate(sorted(self.mock_servers.items())):
+            clients[name] = Mock(spec=Redis)
+            clients[name].client_id.return_value = i
+            self.closed[name] = threading.Event()
+            clients[name].close.side_effect = self.closed[name].set
+            self.blocked[name] = threading.Event()
+            self.unblocked[name] = threading.Event()
+            mock_server.client_unblock.side_effect = functools.partial(
+                lambda name, client_id: self.blocked[name].is_set() and
+                self.unblocked[name].set(), name)
+        self.sharded_redis._blocking_client = clients.get
+        return clients
+
+    def _block(self, name, delay=0):
+        """Return a pop of server ``name`` blocking after ``delay`` seconds
+        until it is unblocked or times out.
+        """
+        def pop(keys, timeout):
+            time.sleep(delay)
+            self.blocked[name].set()
+            self.unblocked[name].wait(timeout or None)
+        return pop
+
+    def _pushed_back(self, name, method='lpush'):
+        pushed = threading.Event()
+        getattr(self.mock_servers[name], method).side_effect = lambda *args: pushed.set()
+        return pushed
+
+    def test_blpop_across_servers(self):
+        clients = self._blocking_clients()
+        clients['r1'].blpop.return_value = (b'q', b'item')
+        for name in ['r2', 'r3', 'r4']:
+            clients[name].blpop.side_effect = self._block(name)
+        keys = [self.keys[name] for name in ['r1', 'r2', 'r3', 'r4']]
+        self.assertEqual(self.sharded_redis.blpop(keys, timeout=3), (b'q', b'item'))
+        for name in ['r2', 'r3', 'r4']:
+            self.assertTrue(self.unblocked[name].wait(1))
+            self.assertTrue(self.closed[name].wait(1))
+            clients[name].blpop.assert_called_once_with([self.keys[name]], 3)
+            self.mock_servers[name].client_unblock.assert_called_with(
+                clients[name].client_id.return_value)
+            self.assertFalse(self.mock_servers[name].lpush.called)
+        self.assertTrue(clients['r1'].close.called)
+
+    def test_blpop_unblocks_pops_blocking_late(self):
+        clients = self._blocking_clients()
+        clients['r1'].blpop.return_value = (b'q', b'item')
+        # the BLPOP of r2 reaches the server after the first CLIENT UNBLOCK
+        clients['r2'].blpop.side_effect = self._block('r2', delay=0.1)
+        start = time.time()
+        self.assertEqual(self.sharded_redis.blpop([self.keys['r1'], self.keys['r2']], timeout=0),
+                         (b'q', b'item'))
+        self.assertLess(time.time() - start, 0.1)
+        self.assertTrue(self.unblocked['r2'].wait(1))
+        self.assertTrue(self.closed['r2'].wait(1))
+        self.assertGreater(self.mock_servers['r2'].client_unblock.call_count, 1)
+
+    def test_blpop_pushes_back_items_popped_late(self):
+        clients = self._blocking_clients()
+        first = threading.Event()
+        clients['r1'].blpop.side_effect = lambda keys, timeout: first.set() or (b'q1', b'a')
+        clients['r2'].blpop.side_effect = lambda keys, timeout: first.wait(5) and (b'q2', b'b')
+        clients['r3'].blpop.return_value = None
+        clients['r4'].blpop.return_value = None
+        pushed = self._pushed_back('r2')
+        keys = [self.keys[name] for name in ['r1', 'r2', 'r3', 'r4']]
+        self.assertEqual(self.sharded_redis.blpop(keys), (b'q1', b'a'))
+        self.assertTrue(pushed.wait(1))
+        self.mock_servers['r2'].lpush.assert_called_once_with(b'q2', b'b')
+
+    def test_brpop_across_servers_pushes_back_to_tail(self):
+        clients = self._blocking_clients()
+        first = threading.Event()
+        clients['r1'].brpop.side_effect = lambda keys, timeout: first.set() or (b'q1', b'a')
+        clients['r2'].brpop.side_effect = lambda keys, timeout: first.wait(5) and (b'q2', b'b')
+        pushed = self._pushed_back('r2', 'rpush')
+        self.assertEqual(self.sharded_redis.brpop([self.keys['r1'], self.keys['r2']]),
+                         (b'q1', b'a'))
+        self.assertTrue(pushed.wait(1))
+        self.mock_servers['r2'].rpush.assert_called_once_with(b'q2', b'b')
+
+    def test_blpop_across_servers_timeout(self):
+        clients = self._blocking_clients()
+        for client in clients.values():
+            client.blpop.return_value = None
+        self.assertIsNone(self.sharded_redis.blpop(list(self.keys.values()), timeout=1))
+        for mock_server in self.mock_servers.values():
+            self.assertFalse(mock_server.client_unblock.called)
+
+    def test_blpop_across_servers_error(self):
+        clients = self._blocking_clients()
+        clients['r1'].blpop.side_effect = ConnectionError('down')
+        clients['r2'].blpop.side_effect = self._block('r2')
+        with six.assertRaisesRegex(self, ConnectionError, 'down'):
+            self.sharded_redis.blpop([self.keys['r1'], self.keys['r2']])
+        self.assertTrue(self.unblocked['r2'].wait(1))
+
     def test_keys(self):
         mock_servers = {}
         for name in ['r1', 'r2', 'r3', 'r4']:
@@ -265,3 +529,293 @@ class ShardedRedisTests(TestCase):
         self.sharded_redis.flushdb()
         for mock_server in mock_servers.values():
             self.assertEqual(mock_server.mock_calls, [call.flushdb()])
+
+    def _mock_connections(self):
+        mock_servers = {}
+        for name in ['r1', 'r2', 'r3', 'r4']:
+            mock_servers[name] = Mock(spec=Redis)
+        self.sharded_redis.connections = mock_servers
+        return mock_servers
+
+    def test_mget(self):
+        mock_servers = self._mock_connections()
+        for mock_server in mock_servers.values():
+            mock_server.mget.side_effect = lambda keys: ['v_' + k for k in keys]
+        keys = ['key%s' % i for i in range(20)]
+        self.assertEqual(self.sharded_redis.mget(keys), ['v_' + k for k in keys])
+        self.assertEqual(self.sharded_redis.mget('key1', 'key2'), ['v_key1', 'v_key2'])
+        for name, mock_server in mock_servers.items():
+            shard_keys = [k for k in keys if self.sharded_redis.get_server_name(k) == name]
+            self.assertEqual(mock_server.mget.mock_calls[0], call(shard_keys))
+
+    def test_mget_nonstring_key(self):
+        self._mock_connections()
+        with six.assertRaisesRegex(self, ValueError, r'keys must be strings'):
+            self.sharded_redis.mget(['key1', 123])
+
+    def test_mset(self):
+        mock_servers = self._mock_connections()
+        for mock_server in mock_servers.values():
+            mock_server.mset.return_value = True
+        mapping = dict(('key%s' % i, i) for i in range(20))
+        self.assertTrue(self.sharded_redis.mset(mapping))
+        for name, mock_server in mock_servers.items():
+            self.assertEqual(mock_server.mset.mock_calls, [call(dict(
+                (k, v) for k, v in mapping.items()
+                if self.sharded_redis.get_server_name(k) == name))])
+
+    def test_mset_empty(self):
+        with six.assertRaisesRegex(self, ValueError, r"method 'mset' requires at least one key"):
+            self.sharded_redis.mset({})
+
+    def test_multi_key_sum_methods(self):
+        keys = ['key%s' % i for i in range(20)]
+        for method_name in ['delete', 'exists', 'touch', 'unlink']:
+            mock_servers = self._mock_connections()
+            for mock_server in mock_servers.values():
+                getattr(mock_server, method_name).side_effect = lambda *keys: len(keys)
+            self.assertEqual(getattr(self.sharded_redis, method_name)(*keys), 20)
+            for name, mock_server in mock_servers.items():
+                shard_keys = [k for k in keys if self.sharded_redis.get_server_name(k) == name]
+                self.assertEqual(getattr(mock_server, method_name).mock_calls,
+                                 [call(*shard_keys)])
+
+    def test_multi_key_sum_without_keys(self):
+        expected_rx = r"method 'delete' requires at least one key"
+        with six.assertRaisesRegex(self, ValueError, expected_rx):
+            self.sharded_redis.delete()
+
+    def _mock_scan_connections(self, pages=2):
+        mock_servers = self._mock_connections()
+        for name, mock_server in mock_servers.items():
+            def scan(cursor, name=name, **kwargs):
+                next_cursor = 0 if cursor + 1 >= pages else cursor + 1
+                return next_cursor, ['key_{0}_{1}_{2}'.format(name, cursor, i) for i in range(3)]
+            mock_server.scan.side_effect = scan
+        return mock_servers
+
+    def test_scan_iter(self):
+        mock_servers = self._mock_scan_connections()
+        result = list(self.sharded_redis.scan_iter(match='key_*', count=100))
+        self.assertEqual(set(result), set(
+            'key_{0}_{1}_{2}'.format(name, cursor, i)
+            for name in mock_servers for cursor in range(2) for i in range(3)))
+        self.assertEqual(len(result), 24)
+        for mock_server in mock_servers.values():
+            self.assertEqual(mock_server.scan.mock_calls, [
+                call(0, match='key_*', count=100),
+                call(1, match='key_*', count=100),
+            ])
+
+    def test_scan_iter_small_buffer(self):
+        self._mock_scan_connections(pages=5)
+        result = list(self.sharded_redis.scan_iter(buffer_size=1))
+        self.assertEqual(len(result), 60)
+
+    def test_scan_iter_type(self):
+        mock_servers = self._mock_scan_connections(pages=1)
+        list(self.sharded_redis.scan_iter(_type='hash'))
+        for mock_server in mock_servers.values():
+            self.assertEqual(mock_server.scan.mock_calls, [call(0, _type='hash')])
+
+    def test_scan_iter_tag_pattern(self):
+        mock_servers = self._mock_scan_connections(pages=1)
+        name = self.sharded_redis.get_server_name('foo')
+        result = list(self.sharded_redis.scan_iter(match='user{foo}*'))
+        self.assertEqual(result, ['key_{0}_0_{1}'.format(name, i) for i in range(3)])
+        for other, mock_server in mock_servers.items():
+            self.assertEqual(mock_server.scan.called, other == name)
+
+    def test_scan_iter_glob_before_tag_scans_all_servers(self):
+        # '*{foo}*' matches 'x{bar}y{foo}z', whose tag is bar
+        mock_servers = self._mock_scan_connections(pages=1)
+        list(self.sharded_redis.scan_iter(match='*{foo}*'))
+        for mock_server in mock_servers.values():
+            self.assertTrue(mock_server.scan.called)
+
+    def test_scan_iter_glob_in_tag_scans_all_servers(self):
+        mock_servers = self._mock_scan_connections(pages=1)
+        list(self.sharded_redis.scan_iter(match='*{fo*}*'))
+        for mock_server in mock_servers.values():
+            self.assertTrue(mock_server.scan.called)
+
+    def test_scan_iter_error(self):
+        mock_servers = self._mock_scan_connections()
+        mock_servers['r3'].scan.side_effect = ConnectionError('boom')
+        with self.assertRaises(ConnectionError):
+            list(self.sharded_redis.scan_iter())
+
+    def test_scan_iter_close_early(self):
+        self._mock_scan_connections(pages=1000)
+        keys = self.sharded_redis.scan_iter(buffer_size=2)
+        self.assertTrue(next(keys).startswith('key_'))
+        keys.close()
+
+    def test_broadcast(self):
+        mock_servers = self._mock_connections()
+        for name, mock_server in mock_servers.items():
+            mock_server.info.return_value = {'name': name}
+        result = self.sharded_redis.broadcast('info', 'memory')
+        self.assertEqual(result, dict((name, {'name': name}) for name in mock_servers))
+        for mock_server in mock_servers.values():
+            self.assertEqual(mock_server.mock_calls, [call.info('memory')])
+
+    def test_broadcast_collects_errors(self):
+        mock_servers = self._mock_connections()
+        error = ConnectionError('boom')
+        mock_servers['r2'].dbsize.side_effect = error
+        for name in ['r1', 'r3', 'r4']:
+            mock_servers[name].dbsize.return_value = 1
+        with self.assertRaises(BroadcastError) as ctx:
+            self.sharded_redis.broadcast('dbsize')
+        self.assertEqual(ctx.exception.results, {'r1': 1, 'r3': 1, 'r4': 1})
+        self.assertEqual(ctx.exception.errors, {'r2': error})
+        result = self.sharded_redis.broadcast('dbsize', return_exceptions=True)
+        self.assertEqual(result, {'r1': 1, 'r2': error, 'r3': 1, 'r4': 1})
+
+    def test_map_shards(self):
+        mock_servers = self._mock_connections()
+        result = self.sharded_redis.map_shards(lambda server: server)
+        self.assertEqual(result, mock_servers)
+
+    def test_dbsize(self):
+        mock_servers = self._mock_connections()
+        for mock_server in mock_servers.values():
+            mock_server.dbsize.return_value = 3
+        self.assertEqual(self.sharded_redis.dbsize(), 12)
+
+    def test_custom_executor(self):
+        mock_servers = self._mock_connections()
+        executor = Mock()
+        executor.submit.side_effect = lambda fn: Mock(**{'result.return_value': fn()})
+        sharded_redis = ShardedRedis([], executor=executor)
+        sharded_redis.server_names = self.sharded_redis.server_names
+        sharded_redis.connections = mock_servers
+        sharded_redis.flushdb()
+        self.assertEqual(executor.submit.call_count, 4)
+        self.assertIs(sharded_redis.executor, executor)
+        sharded_redis.close()
+        self.assertFalse(executor.shutdown.called)
+        self.assertIs(sharded_redis.executor, executor)
+
+    def test_default_executor_size(self):
+        self.assertEqual(self.sharded_redis.executor._max_workers, 4)
+        sharded_redis = ShardedRedis([], max_workers=16)
+        self.assertEqual(sharded_redis.executor._max_workers, 16)
+        sharded_redis.close()
+        self.assertIsNone(sharded_redis._executor)
+
+    def _dual_read_redis(self):
+        previous = ShardedRedis([
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ])
+        previous.connections = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2'])
+        self.sharded_redis.previous = previous
+        self._mock_connections()
+        moved = [k for k in ('key%s' % i for i in range(20)) if self.sharded_redis._moved(k)]
+        kept = [k for k in ('key%s' % i for i in range(20)) if not self.sharded_redis._moved(k)]
+        return previous, moved[0], kept[0]
+
+    def _old_pipe(self, previous, key, replies):
+        old_server = previous.get_server(key)
+        old_server.pipeline.return_value.execute.return_value = replies
+        return old_server
+
+    def test_read_of_moved_key_on_new_server(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        new_pipe = self.sharded_redis.get_server(moved_key).pipeline.return_value
+        # replies meaning "no such key" of a key which exists are kept
+        new_pipe.execute.return_value = [1, 0]
+        self.assertEqual(self.sharded_redis.llen(moved_key), 0)
+        self.assertEqual(new_pipe.mock_calls, [
+            call.exists(moved_key), call.llen(moved_key), call.execute()])
+        self.sharded_redis.get_server(kept_key).get.return_value = None
+        self.assertEqual(self.sharded_redis.get(kept_key), None)
+        self.sharded_redis.get_server(kept_key).setnx.return_value = True
+        self.sharded_redis.setnx(kept_key, 1)
+        for mock_server in previous.connections.values():
+            self.assertEqual(mock_server.mock_calls, [])
+
+    def test_read_of_key_not_moved_yet(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        old_server = self._old_pipe(previous, moved_key, [b'dump', -1])
+        new_server = self.sharded_redis.get_server(moved_key)
+        new_server.pipeline.return_value.execute.side_effect = [[0, -2], [True]]
+        new_server.ttl.return_value = -1
+        self.assertEqual(self.sharded_redis.ttl(moved_key), -1)
+        new_server.pipeline.return_value.restore.assert_called_once_with(
+            moved_key, 0, b'dump', replace=False)
+        old_server.delete.assert_called_once_with(moved_key)
+        new_server.ttl.assert_called_once_with(moved_key)
+
+    def test_read_of_missing_key(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        old_server = self._old_pipe(previous, moved_key, [None, -2])
+        new_server = self.sharded_redis.get_server(moved_key)
+        new_server.pipeline.return_value.execute.return_value = [0, None]
+        self.assertIsNone(self.sharded_redis.get(moved_key))
+        self.assertFalse(old_server.delete.called)
+        self.assertFalse(new_server.get.called)
+
+    def test_exists_moves_keys_first(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        old_server = self._old_pipe(previous, moved_key, [b'dump', -1])
+        new_server = self.sharded_redis.get_server(moved_key)
+        new_server.pipeline.return_value.execute.return_value = [True]
+        for mock_server in self.sharded_redis.connections.values():
+            mock_server.exists.side_effect = lambda *keys: len(keys)
+        self.assertEqual(self.sharded_redis.exists(moved_key, kept_key), 2)
+        old_server.delete.assert_called_once_with(moved_key)
+
+    def test_tag_write_moves_every_key_first(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        tag = moved_key
+        keys = ['a{%s}' % tag, 'b{%s}' % tag]
+        old_server = self._old_pipe(previous, tag, [None, -2, None, -2])
+        self.sharded_redis.tag_delete(*keys)
+        self.assertEqual(old_server.pipeline.return_value.dump.mock_calls,
+                         [call(key) for key in keys])
+
+    def test_write_moves_key_first(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        old_server = self._old_pipe(previous, moved_key, [b'dump', 5000])
+        new_server = self.sharded_redis.get_server(moved_key)
+        restore_pipe = new_server.pipeline.return_value
+        restore_pipe.execute.return_value = [True]
+        order = []
+        restore_pipe.execute.side_effect = lambda raise_on_error: order.append('restore') or [True]
+        new_server.hset.side_effect = lambda *args: order.append('hset') or 1
+        self.assertEqual(self.sharded_redis.hset(moved_key, 'f', 'v'), 1)
+        old_server.pipeline.return_value.dump.assert_called_once_with(moved_key)
+        restore_pipe.restore.assert_called_once_with(moved_key, 5000, b'dump', replace=False)
+        old_server.delete.assert_called_once_with(moved_key)
+        self.assertEqual(order, ['restore', 'hset'])
+
+    def test_write_of_key_already_moved(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        old_server = self._old_pipe(previous, moved_key, [None, -2])
+        new_server = self.sharded_redis.get_server(moved_key)
+        new_server.delete.return_value = 1
+        self.assertEqual(self.sharded_redis.delete(moved_key), 1)
+        self.assertFalse(new_server.pipeline.called)
+        self.assertFalse(old_server.delete.called)
+        new_server.delete.assert_called_once_with(moved_key)
+
+    def test_busy_key_is_kept_on_write(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        old_server = self._old_pipe(previous, moved_key, [b'dump', -1])
+        new_server = self.sharded_redis.get_server(moved_key)
+        new_server.pipeline.return_value.execute.return_value = [
+            ResponseError('BUSYKEY Target key name already exists.')]
+        self.sharded_redis.incr(moved_key)
+        old_server.delete.assert_called_once_with(moved_key)
+        new_server.incr.assert_called_once_with(moved_key)
+
+    def test_dual_read_mget(self):
+        previous, moved_key, kept_key = self._dual_read_redis()
+        for mock_server in self.sharded_redis.connections.values():
+            mock_server.mget.side_effect = lambda keys: [None for k in keys]
+        previous.get_server(moved_key).mget.return_value = [b'old']
+        self.assertEqual(self.sharded_redis.mget([moved_key, kept_key]), [b'old', None])
+        self.assertEqual(previous.get_server(moved_key).mget.mock_calls, [call([moved_key])])
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from redis_shard.shard import ShardedRedis
+from redis_shard.stats import (
+    BLOCKING, COMMAND, FANOUT, PIPELINE, CommandEvent, LatencyHistogram, ShardStats,
+    payload_size)
+from .mock import Mock
+
+
+class LatencyHistogramTests(TestCase):
+    def test_empty(self):
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for _ in range(98):
+            histogram.record(0.0003)
+        histogram.record(0.02)
+        histogram.record(30)
+        self.assertEqual(histogram.total, 100)
+        self.assertEqual(histogram.percentile(50), 0.0005)
+        self.assertEqual(histogram.percentile(99), 0.025)
+        self.assertEqual(histogram.percentile(100), float('inf'))
+
+
+class ShardStatsTests(TestCase):
+    def test_aggregates_events(self):
+        stats = ShardStats()
+        stats(CommandEvent('r1', 'get', COMMAND, 0.001, None, 3, 10))
+        stats(CommandEvent('r1', 'get', COMMAND, 0.002, ConnectionError(), 3, 0))
+        stats(CommandEvent('r2', 'keys', FANOUT, 0.1, None, 1, 100))
+        self.assertEqual(stats.snapshot(), {
+            'r1': {'get': {COMMAND: {'calls': 2, 'errors': 1, 'bytes_out': 6,
+                                     'bytes_in': 10, 'p50': 0.001, 'p99': 0.0025}}},
+            'r2': {'keys': {FANOUT: {'calls': 1, 'errors': 0, 'bytes_out': 1,
+                                     'bytes_in': 100, 'p50': 0.1, 'p99': 0.1}}},
+        })
+        self.assertEqual(stats.histogram('r1', 'get').total, 2)
+        self.assertIsNone(stats.histogram('r1', 'set'))
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+    def test_payload_size(self):
+        self.assertEqual(payload_size(b'abc'), 3)
+        self.assertEqual(payload_size([b'ab', None, u'c']), 3)
+        self.assertEqual(payload_size({'k': 'vv'}), 3)
+        self.assertEqual(payload_size(12), 0)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        servers = [
+            {'name': 'r1', 'host': 'localhost', 'port': 1, 'db': 0},
+            {'name': 'r2', 'host': 'localhost', 'port': 2, 'db': 0},
+        ]
+        self.events = []
+        self.sharded_redis = ShardedRedis(servers, listeners=[self.events.append])
+        self.mock_servers = dict((name, Mock(spec=Redis)) for name in ['r1', 'r2'])
+        self.sharded_redis.connections = self.mock_servers
+
+    def test_command(self):
+        name = self.sharded_redis.get_server_name('key1')
+        self.mock_servers[name].get.return_value = b'value'
+        self.sharded_redis.get('key1')
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertEqual((event.server_name, event.command, event.kind, event.error,
+                          event.bytes_out, event.bytes_in),
+                         (name, 'get', COMMAND, None, 4, 5))
+        self.assertGreaterEqual(event.duration, 0)
+
+    def test_command_error(self):
+        name = self.sharded_redis.get_server_name('key1')
+        error = ConnectionError('boom')
+        self.mock_servers[name].get.side_effect = error
+        with self.assertRaises(ConnectionError):
+            self.sharded_redis.get('key1')
+        self.assertIs(self.events[0].error, error)
+
+    def test_fanout(self):
+        self.sharded_redis.flushdb()
+        self.assertEqual(sorted((e.server_name, e.command, e.kind) for e in self.events),
+                         [('r1', 'flushdb', FANOUT), ('r2', 'flushdb', FANOUT)])
+
+    def test_blocking(self):
+        self.sharded_redis.blpop('key1', 1)
+        self.assertEqual([(e.command, e.kind) for e in self.events], [('blpop', BLOCKING)])
+        del self.events[:]
+        self.sharded_redis.blpop_in('queue', 1)
+        self.assertEqual([(e.command, e.kind) for e in self.events], [('blpop_in', BLOCKING)])
+
+    def test_pipeline(self):
+        for mock_server in self.mock_servers.values():
+            mock_server.pipeline.return_value.execute.return_value = [True]
+        pipe = self.sharded_redis.pipeline()
+        pipe.set('key1', 1)
+        pipe.execute()
+        self.assertEqual([(e.command, e.kind) for e in self.events], [('pipeline', PIPELINE)])
+
+    def test_disabled(self):
+        self.sharded_redis.listeners = []
+        self.sharded_redis._timed = Mock()
+        self.sharded_redis.get('key1')
+        self.assertFalse(self.sharded_redis._timed.called)